@@ -0,0 +1,152 @@
+import os
+import time
+import heapq
+import asyncio
+import itertools
+from collections import OrderedDict
+
+# Допуск фото до розпізнавання: ліміт на користувача (token bucket), загальна межа
+# одночасних задач, черга з пріоритетами і скасування застарілих запитів того самого користувача.
+# Скільки фото користувач може надіслати підряд і з якою швидкістю (фото/с) відновлюється ліміт
+ADMISSION_BURST = float(os.environ.get("ADMISSION_BURST", "3"))
+ADMISSION_RATE = float(os.environ.get("ADMISSION_RATE", "0.2"))
+# Скільки фото обробляється одночасно і скільки може чекати в черзі
+ADMISSION_MAX_ACTIVE = int(os.environ.get("ADMISSION_MAX_ACTIVE", "16"))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "200"))
+# Скільки користувачів тримати в таблиці лімітів (найдавніші відкидаються — їхні відра вже повні)
+ADMISSION_MAX_USERS = int(os.environ.get("ADMISSION_MAX_USERS", "100000"))
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+
+class Superseded(Exception):
+    # Користувач надіслав нове фото — попередній запит більше не потрібен
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Ticket:
+    def __init__(self, user_id, priority, seq):
+        self.user_id = user_id
+        self.priority = priority
+        self.seq = seq
+        self.granted = asyncio.get_running_loop().create_future()
+        self.cancelled = asyncio.Event()
+        self.active = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionController:
+    def __init__(self, max_active=ADMISSION_MAX_ACTIVE, max_queue=ADMISSION_MAX_QUEUE, rate=ADMISSION_RATE,
+                 burst=ADMISSION_BURST, max_users=ADMISSION_MAX_USERS):
+        self.max_active = max(1, int(max_active))
+        self.max_queue = max(0, int(max_queue))
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.max_users = max(1, int(max_users))
+        self._buckets = OrderedDict()
+        self._waiting = []
+        self._waiting_count = 0
+        self._latest = {}
+        self._active = 0
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.rate_limited = 0
+        self.rejected = 0
+        self.superseded = 0
+
+    def allow(self, user_id):
+        # Token bucket: (дозволено, через скільки секунд буде наступний жетон)
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1.0
+        if allowed:
+            tokens -= 1.0
+        self._buckets[user_id] = (tokens, now)
+        while len(self._buckets) > self.max_users:
+            self._buckets.popitem(last=False)
+        if not allowed:
+            self.rate_limited += 1
+            return False, (1.0 - tokens) / self.rate if self.rate > 0 else float("inf")
+        return True, 0.0
+
+    def enqueue(self, user_id, priority=PRIORITY_NORMAL):
+        # Повертає (квиток, чи скасовано попередній запит користувача)
+        previous = self._latest.get(user_id)
+        if previous is not None:
+            self._cancel(previous)
+        if self._waiting_count >= self.max_queue and self._active >= self.max_active:
+            self.rejected += 1
+            raise QueueFull()
+        ticket = Ticket(user_id, priority, next(self._seq))
+        self._latest[user_id] = ticket
+        heapq.heappush(self._waiting, ticket)
+        self._waiting_count += 1
+        self._dispatch()
+        return ticket, previous is not None
+
+    def position(self, ticket):
+        # Позиція в черзі (1 — наступний); 0 — уже обробляється
+        if ticket.granted.done():
+            return 0
+        return 1 + sum(1 for other in self._waiting if other < ticket and not other.cancelled.is_set())
+
+    async def wait(self, ticket):
+        await ticket.granted
+
+    async def guard(self, ticket, awaitable):
+        # Виконує awaitable, але перериває його, якщо квиток скасовано новим фото
+        task = asyncio.ensure_future(awaitable)
+        cancelled = asyncio.ensure_future(ticket.cancelled.wait())
+        done, _ = await asyncio.wait({task, cancelled}, return_when=asyncio.FIRST_COMPLETED)
+        if task in done:
+            cancelled.cancel()
+            return task.result()
+        task.cancel()
+        raise Superseded()
+
+    def release(self, ticket):
+        if ticket.active:
+            ticket.active = False
+            self._active -= 1
+        if self._latest.get(ticket.user_id) is ticket:
+            del self._latest[ticket.user_id]
+        self._dispatch()
+
+    def _cancel(self, ticket):
+        if ticket.cancelled.is_set():
+            return
+        ticket.cancelled.set()
+        self.superseded += 1
+        if not ticket.granted.done():
+            # Квиток лишається в купі й відкидається при видачі слотів
+            self._waiting_count -= 1
+            ticket.granted.set_exception(Superseded())
+
+    def _dispatch(self):
+        while self._active < self.max_active and self._waiting:
+            ticket = heapq.heappop(self._waiting)
+            if ticket.cancelled.is_set():
+                continue
+            self._waiting_count -= 1
+            ticket.active = True
+            self._active += 1
+            self.admitted += 1
+            ticket.granted.set_result(True)
+
+    def metrics(self):
+        return {
+            "active": self._active,
+            "waiting": self._waiting_count,
+            "admitted": self.admitted,
+            "rate_limited": self.rate_limited,
+            "rejected": self.rejected,
+            "superseded": self.superseded,
+        }
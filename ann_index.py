@@ -0,0 +1,194 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+from scoring import segment_ids
+
+# Наближений пошук найближчих еталонів (ANN) для великих галерей.
+# "exact" — повний перебір (еталон для порівняння), "ivf" — інвертовані списки
+# поверх сферичного k-means: запит порівнюється лише з n_probe найближчими кластерами.
+ANN_KINDS = ("exact", "ivf")
+KMEANS_SAMPLE = 50000
+KMEANS_ITERATIONS = 12
+ASSIGN_CHUNK = 65536
+
+
+def top_k(scores, k):
+    k = min(k, scores.shape[-1])
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    order = np.argpartition(-scores, k - 1)[:k]
+    return order[np.argsort(-scores[order], kind="stable")]
+
+
+class ExactSearch:
+    kind = "exact"
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def search(self, query, k):
+        scores = self.embeddings @ query
+        ids = top_k(scores, k)
+        return ids, scores[ids]
+
+    def save(self, path, fingerprint=""):
+        np.savez(path, kind=np.asarray(self.kind), fingerprint=np.asarray(fingerprint))
+
+
+def _assign(x, centroids):
+    assign = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), ASSIGN_CHUNK):
+        assign[start:start + ASSIGN_CHUNK] = np.argmax(x[start:start + ASSIGN_CHUNK] @ centroids.T, axis=1)
+    return assign
+
+
+def spherical_kmeans(x, n_clusters, iterations=KMEANS_ITERATIONS, seed=0):
+    rng = np.random.default_rng(seed)
+    sample = x if len(x) <= KMEANS_SAMPLE else x[rng.choice(len(x), KMEANS_SAMPLE, replace=False)]
+    n_clusters = max(1, min(n_clusters, len(sample)))
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _assign(sample, centroids)
+        order = np.argsort(assign, kind="stable")
+        present, starts = np.unique(assign[order], return_index=True)
+        sums = np.add.reduceat(sample[order], starts, axis=0)
+        centroids[present] = sums
+        # Порожні кластери переносимо у випадкові точки вибірки
+        empty = np.setdiff1d(np.arange(n_clusters), present)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    kind = "ivf"
+
+    def __init__(self, embeddings, centroids, list_offsets, list_ids, n_probe=8):
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.n_probe = n_probe
+
+    @classmethod
+    def build(cls, embeddings, n_lists=0, n_probe=8, seed=0):
+        if n_lists <= 0:
+            n_lists = max(1, int(np.sqrt(len(embeddings))))
+        centroids = spherical_kmeans(embeddings, n_lists, seed=seed)
+        assign = _assign(embeddings, centroids)
+        list_ids = np.argsort(assign, kind="stable").astype(np.int64)
+        counts = np.bincount(assign, minlength=len(centroids))
+        list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(embeddings, centroids, list_offsets, list_ids, n_probe)
+
+    def search(self, query, k):
+        probes = top_k(self.centroids @ query, self.n_probe)
+        starts = self.list_offsets[probes]
+        counts = self.list_offsets[probes + 1] - starts
+        candidates = self.list_ids[segment_ids(starts, counts)]
+        scores = self.embeddings[candidates] @ query
+        best = top_k(scores, k)
+        return candidates[best], scores[best]
+
+    def save(self, path, fingerprint=""):
+        np.savez(
+            path,
+            kind=np.asarray(self.kind),
+            fingerprint=np.asarray(fingerprint),
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            list_ids=self.list_ids,
+        )
+
+
+def build_ann(kind, embeddings, n_lists=0, n_probe=8):
+    if kind == "exact":
+        return ExactSearch(embeddings)
+    if kind == "ivf":
+        return IVFIndex.build(embeddings, n_lists, n_probe)
+    raise ValueError(f"Невідомий тип ANN-індексу: {kind}")
+
+
+def load_ann(path, embeddings, n_probe=8, fingerprint=None):
+    # Повертає None, якщо файл відсутній або побудований для іншої версії галереї
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        if fingerprint is not None and str(data["fingerprint"]) != fingerprint:
+            return None
+        kind = str(data["kind"])
+        if kind == "exact":
+            return ExactSearch(embeddings)
+        return IVFIndex(embeddings, data["centroids"], data["list_offsets"], data["list_ids"], n_probe)
+
+
+def load_or_build_ann(path, kind, embeddings, n_lists=0, n_probe=8, fingerprint=""):
+    ann = load_ann(path, embeddings, n_probe, fingerprint)
+    if ann is not None and ann.kind == kind:
+        return ann
+    ann = build_ann(kind, embeddings, n_lists, n_probe)
+    # Унікальна назва: кілька процесів можуть зберігати той самий індекс одночасно
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    ann.save(tmp_path, fingerprint)
+    os.replace(tmp_path, path)
+    return ann
+
+
+def recall_report(ann, embeddings, queries, k=10):
+    exact = ExactSearch(embeddings)
+    hits = 0
+    exact_time = ann_time = 0.0
+    for query in queries:
+        started = time.perf_counter()
+        expected, _ = exact.search(query, k)
+        exact_time += time.perf_counter() - started
+        started = time.perf_counter()
+        found, _ = ann.search(query, k)
+        ann_time += time.perf_counter() - started
+        hits += len(np.intersect1d(expected, found))
+    n = max(len(queries), 1)
+    return {
+        "kind": ann.kind,
+        "k": k,
+        "queries": len(queries),
+        "recall_at_k": round(hits / (n * min(k, len(embeddings))), 4) if len(embeddings) else 0.0,
+        "exact_ms": round(exact_time / n * 1000, 3),
+        "ann_ms": round(ann_time / n * 1000, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Побудова ANN-індексу та звіт recall@k проти точного пошуку")
+    parser.add_argument("--index", default="weapon_index.emb", help="Файл індексу ембедінгів")
+    parser.add_argument("--kind", default="ivf", choices=ANN_KINDS)
+    parser.add_argument("--lists", type=int, default=0, help="Кількість кластерів IVF (0 — √N)")
+    parser.add_argument("--probe", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="Значення n_probe для звіту")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200, help="Скільки еталонів взяти як запити")
+    parser.add_argument("--save", default=None, help="Зберегти ANN-індекс у файл")
+    args = parser.parse_args(argv)
+
+    from embedding_index import EmbeddingIndex
+
+    index = EmbeddingIndex.load(args.index)
+    rng = np.random.default_rng(0)
+    queries = index.embeddings[rng.choice(len(index), min(args.queries, len(index)), replace=False)]
+
+    ann = build_ann(args.kind, index.embeddings, args.lists, args.probe[0])
+    for n_probe in args.probe:
+        ann.n_probe = n_probe
+        report = recall_report(ann, index.embeddings, queries, args.k)
+        report["n_probe"] = n_probe
+        print(json.dumps(report, ensure_ascii=False))
+    if args.save:
+        ann.save(args.save, index.fingerprint())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
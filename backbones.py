@@ -0,0 +1,106 @@
+import os
+import logging
+
+# Реєстр екстракторів ознак: BACKBONE вибирає модель, ваги читаються з локального файлу.
+# Кожен екстрактор має власний файл індексу (тег у назві, див. tagged_index_path), бо ембедінги
+# різних моделей несумісні. mobilenet_v2 — як і раніше, без тегу і без нормалізації входу,
+# тож наявні індекси лишаються дійсними; для решти вхід [0, 1] нормалізується всередині моделі.
+BACKBONE = os.environ.get("BACKBONE", "mobilenet_v2")
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+# kind: torchvision (arch — функція torchvision.models, weights — enum ваг, head — шар класифікатора)
+# або clip (arch — назва моделі OpenAI CLIP; використовується лише енкодер зображень).
+# experimental — не перевірено на галереї (точність, затримка, пам'ять); при використанні — попередження
+BACKBONES = {
+    "mobilenet_v2": {"kind": "torchvision", "arch": "mobilenet_v2", "weights": "MobileNet_V2_Weights",
+                     "head": "classifier", "normalize": False, "dim": 1280},
+    "mobilenet_v3_small": {"kind": "torchvision", "arch": "mobilenet_v3_small", "weights": "MobileNet_V3_Small_Weights",
+                           "head": "classifier", "normalize": True, "dim": 576},
+    "mobilenet_v3_large": {"kind": "torchvision", "arch": "mobilenet_v3_large", "weights": "MobileNet_V3_Large_Weights",
+                           "head": "classifier", "normalize": True, "dim": 960},
+    "shufflenet_v2_x1_0": {"kind": "torchvision", "arch": "shufflenet_v2_x1_0", "weights": "ShuffleNet_V2_X1_0_Weights",
+                           "head": "fc", "normalize": True, "dim": 1024},
+    "clip_vit_b32": {"kind": "clip", "arch": "ViT-B/32", "dim": 512, "experimental": True},
+    "clip_vit_b16": {"kind": "clip", "arch": "ViT-B/16", "dim": 512, "experimental": True},
+}
+
+
+def get_spec(name=BACKBONE):
+    spec = BACKBONES.get(name)
+    if spec is None:
+        raise ValueError(f"Невідомий екстрактор ознак: {name}. Доступні: {', '.join(BACKBONES)}")
+    return spec
+
+
+def default_weights_path(name=BACKBONE):
+    return f"models/{name}.pt" if get_spec(name)["kind"] == "clip" else f"models/{name}.pth"
+
+
+def backbone_tag(name=BACKBONE):
+    # Тег файлів індексу: порожній для mobilenet_v2 (історичні назви файлів)
+    return "" if name == "mobilenet_v2" else name
+
+
+def download_weights(name, weights_path):
+    spec = get_spec(name)
+    os.makedirs(os.path.dirname(weights_path) or ".", exist_ok=True)
+    if spec["kind"] == "clip":
+        # Пакет clip завантажує файл під своєю назвою (з перевіркою SHA256) у ту саму папку;
+        # переносимо його під нашу назву, а не копіюємо, щоб ваги не лежали двічі
+        from clip import clip as clip_module
+
+        downloaded = clip_module._download(clip_module._MODELS[spec["arch"]], os.path.dirname(weights_path) or ".")
+        os.replace(downloaded, weights_path)
+        return weights_path
+
+    import torch
+    from torchvision import models
+
+    tmp_path = f"{weights_path}.{os.getpid()}.tmp"
+    weights = getattr(models, spec["weights"]).IMAGENET1K_V1
+    torch.save(weights.get_state_dict(progress=False), tmp_path)
+    os.replace(tmp_path, weights_path)
+    return weights_path
+
+
+def _with_normalization(model, mean, std):
+    import torch
+
+    class Normalized(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+            self.register_buffer("mean", torch.tensor(mean).view(1, 3, 1, 1))
+            self.register_buffer("std", torch.tensor(std).view(1, 3, 1, 1))
+
+        def forward(self, images):
+            return self.model((images - self.mean) / self.std)
+
+    return Normalized()
+
+
+def build_backbone(name, weights_path):
+    # fp32-модель: зображення (N, 3, 224, 224) у діапазоні [0, 1] → ознаки (N, dim)
+    import torch
+
+    spec = get_spec(name)
+    if spec.get("experimental"):
+        logging.warning("⚠️ Екстрактор %s експериментальний: перевірте точність (benchmark.py --backbones) до використання", name)
+    if spec["kind"] == "clip":
+        import clip
+
+        model, _ = clip.load(weights_path, device="cpu", jit=False)
+        # Текстова частина не потрібна — лишаємо тільки енкодер зображень
+        return _with_normalization(model.visual.float(), CLIP_MEAN, CLIP_STD).eval()
+
+    from torchvision import models
+
+    model = getattr(models, spec["arch"])(weights=None)
+    model.load_state_dict(torch.load(weights_path, map_location="cpu"))
+    setattr(model, spec["head"], torch.nn.Identity())  # Прибираємо останній класифікатор
+    if spec["normalize"]:
+        model = _with_normalization(model, IMAGENET_MEAN, IMAGENET_STD)
+    return model.eval()
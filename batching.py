@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+from asyncio import to_thread
+
+# Мікро-пакетування запитів на розпізнавання: запити з різних обробників
+# збираються в один пакет (до max_batch_size або max_wait_ms) і проходять
+# через модель одним тензором, а результати повертаються через futures.
+# run_batch може бути звичайною функцією (виконується в потоці) або корутиною
+# (наприклад, пул процесів); max_concurrency — скільки пакетів обробляється одночасно.
+METRICS_LOG_EVERY = 100
+
+
+class BatchingEngine:
+    def __init__(self, run_batch, max_batch_size=8, max_wait_ms=30, max_concurrency=1):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000
+        self.max_concurrency = max(1, int(max_concurrency))
+        self._queue = None
+        self._worker = None
+        self._slots = None
+        self._batches = 0
+        self._requests = 0
+        self._max_batch = 0
+        self._queue_delay_total = 0.0
+        self._queue_delay_max = 0.0
+        self._run_time_total = 0.0
+
+    def _ensure_worker(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, item):
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future, time.perf_counter()))
+        return await future
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            # Новий пакет збираємо лише коли є вільний слот — інакше запити чекають у черзі
+            await self._slots.acquire()
+            batch = await self._collect()
+            # Запити, чиї обробники вже скасовані, не відправляємо в модель
+            batch = [entry for entry in batch if not entry[1].done()]
+            if not batch:
+                self._slots.release()
+                continue
+            task = asyncio.get_running_loop().create_task(self._execute(batch))
+            task.add_done_callback(lambda _: self._slots.release())
+
+    async def _execute(self, batch):
+        items = [item for item, _, _ in batch]
+        started = time.perf_counter()
+        try:
+            if asyncio.iscoroutinefunction(self.run_batch):
+                results = list(await self.run_batch(items))
+            else:
+                results = list(await to_thread(self.run_batch, items))
+        except Exception as e:
+            results = [e] * len(batch)
+        finished = time.perf_counter()
+        if len(results) != len(batch):
+            # Результати не зіставити із запитами — помилка для всього пакета, інакше частина
+            # обробників чекала б на свої futures вічно
+            logging.error("❌ Пакет із %d запитів повернув %d результатів", len(batch), len(results))
+            results = [RuntimeError(f"Пакет із {len(batch)} запитів повернув {len(results)} результатів")] * len(batch)
+
+        for (_, future, _), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        self._record(batch, started, finished)
+
+    def _record(self, batch, started, finished):
+        self._batches += 1
+        self._requests += len(batch)
+        self._max_batch = max(self._max_batch, len(batch))
+        for _, _, queued_at in batch:
+            delay = started - queued_at
+            self._queue_delay_total += delay
+            self._queue_delay_max = max(self._queue_delay_max, delay)
+        self._run_time_total += finished - started
+        if self._batches % METRICS_LOG_EVERY == 0:
+            logging.info("📊 Пакетування: %s", self.metrics())
+
+    def estimated_wait(self, ahead=0):
+        # Орієнтовний час до результату (с) за середнім часом пакета: запити в черзі плюс ahead
+        # розходяться пакетами по max_concurrency слотах; None — ще не було жодного пакета
+        if not self._batches:
+            return None
+        queued = (self._queue.qsize() if self._queue is not None else 0) + ahead
+        rounds = queued // (self.max_batch_size * self.max_concurrency) + 1
+        return self.max_wait + rounds * self._run_time_total / self._batches
+
+    def metrics(self):
+        batches = max(self._batches, 1)
+        requests = max(self._requests, 1)
+        return {
+            "batches": self._batches,
+            "requests": self._requests,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "avg_batch_size": round(self._requests / batches, 2),
+            "max_batch_size": self._max_batch,
+            "avg_queue_delay_ms": round(self._queue_delay_total / requests * 1000, 2),
+            "max_queue_delay_ms": round(self._queue_delay_max * 1000, 2),
+            "avg_batch_time_ms": round(self._run_time_total / batches * 1000, 2),
+        }
@@ -0,0 +1,381 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+from datetime import datetime
+import numpy as np
+from PIL import Image
+
+import model_manager
+import clip_recognizer
+from embedding_index import scan_reference_images
+
+# Бенчмарк конвеєра розпізнавання на вбудованому корпусі weapon_images:
+# час кожного етапу (декодування, перцептивні хеші, трансформація, прогін моделі, оцінювання, пошук у БД),
+# p50/p95/p99 та пропускна здатність для різних розмірів пакета і кількості потоків.
+STAGES = ("decode", "hashes", "transform", "forward", "scoring", "db_lookup", "total")
+
+
+def percentiles(values_ms):
+    if not values_ms:
+        return {}
+    values = np.asarray(values_ms)
+    return {
+        "count": len(values),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+    }
+
+
+def load_corpus(reference_folder, limit=0):
+    # Фото читаються в пам'ять заздалегідь, як байти з Telegram
+    entries = scan_reference_images(reference_folder)
+    if limit and len(entries) > limit:
+        rng = np.random.default_rng(0)
+        entries = [entries[i] for i in sorted(rng.choice(len(entries), limit, replace=False))]
+    corpus = []
+    for entry in entries:
+        with open(entry["path"], "rb") as f:
+            corpus.append((f.read(), entry["label"]))
+    return corpus
+
+
+def _elapsed_ms(started):
+    return (time.perf_counter() - started) * 1000
+
+
+def run_pipeline(images, reference_folder, db_path, timings, views=1):
+    # Той самий шлях, що й recognize_batch, але з замірами кожного етапу
+    started = time.perf_counter()
+    decoded = []
+    for data in images:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        decoded.append(image)
+    timings["decode"].append(_elapsed_ms(started))
+
+    # Префільтр хешів (PHASH_DUPLICATES / PHASH_PREFILTER); вимкнений — етап займає 0 мс.
+    # Дублікати тут не оминають модель: корпус складається з самих еталонів
+    stage = time.perf_counter()
+    hashes = clip_recognizer.get_hash_filter(reference_folder)
+    shortlists = None
+    if hashes is not None:
+        lookups = [
+            hashes.lookup(image, clip_recognizer.PHASH_RADIUS, clip_recognizer.PHASH_SHORTLIST,
+                          clip_recognizer.PHASH_DUPLICATE_DISTANCE)
+            for image in decoded
+        ]
+        if clip_recognizer.PHASH_PREFILTER:
+            shortlists = [shortlist for _, shortlist, _ in lookups]
+    timings["hashes"].append(_elapsed_ms(stage))
+
+    stage = time.perf_counter()
+    tensors = [clip_recognizer.load_views(image, views) for image in decoded]
+    batch = np.concatenate(tensors)
+    timings["transform"].append(_elapsed_ms(stage))
+
+    stage = time.perf_counter()
+    features = model_manager.get_backend().embed(batch)
+    timings["forward"].append(_elapsed_ms(stage))
+
+    stage = time.perf_counter()
+    rankings = clip_recognizer.rank_embeddings(
+        features, reference_folder, shortlists=shortlists, view_counts=[len(tensor) for tensor in tensors]
+    )
+    timings["scoring"].append(_elapsed_ms(stage))
+
+    stage = time.perf_counter()
+    catalog = clip_recognizer.load_weapons_db(db_path)
+    results = [clip_recognizer.format_result(ranking, catalog) for ranking in rankings]
+    timings["db_lookup"].append(_elapsed_ms(stage))
+
+    timings["total"].append(_elapsed_ms(started))
+    return rankings, results
+
+
+def bench_stages(corpus, reference_folder, db_path):
+    timings = {stage: [] for stage in STAGES}
+    correct = 0
+    for data, label in corpus:
+        rankings, _ = run_pipeline([data], reference_folder, db_path, timings)
+        correct += bool(rankings[0]) and rankings[0][0][0] == label
+    report = {stage: percentiles(values) for stage, values in timings.items()}
+    # Еталони є в індексі, тож це лише контроль, що конвеєр не зламано, а не оцінка точності
+    report["self_top1"] = round(correct / max(len(corpus), 1), 4)
+    return report
+
+
+def bench_throughput(corpus, reference_folder, db_path, batch_sizes, thread_counts):
+    backend = model_manager.get_backend()
+    images = [data for data, _ in corpus]
+    results = []
+    for threads in thread_counts:
+        backend.set_num_threads(threads)
+        for batch_size in batch_sizes:
+            timings = {stage: [] for stage in STAGES}
+            # Прогрів, щоб перший пакет не спотворював статистику
+            run_pipeline(images[:batch_size], reference_folder, db_path, {stage: [] for stage in STAGES})
+            started = time.perf_counter()
+            for start in range(0, len(images), batch_size):
+                run_pipeline(images[start:start + batch_size], reference_folder, db_path, timings)
+            elapsed = time.perf_counter() - started
+            results.append({
+                "threads": threads,
+                "batch_size": batch_size,
+                "images_per_s": round(len(images) / elapsed, 2),
+                "batch_latency": percentiles(timings["total"]),
+                "forward": percentiles(timings["forward"]),
+            })
+            print(json.dumps(results[-1]))
+    return results
+
+
+def perturb(data, rng):
+    # Імітація польового фото: поворот до ±20° і зміщений кроп 70–90% кадру
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert("RGB")
+    image = image.rotate(float(rng.uniform(-20, 20)), resample=Image.BILINEAR)
+    width, height = image.size
+    scale = rng.uniform(0.7, 0.9)
+    w, h = int(width * scale), int(height * scale)
+    left, top = int(rng.integers(0, width - w + 1)), int(rng.integers(0, height - h + 1))
+    buffer = io.BytesIO()
+    image.crop((left, top, left + w, top + h)).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def bench_tta(corpus, reference_folder, db_path, views_list):
+    # Затримка і top-1 для різної кількості ракурсів на спотворених копіях корпусу
+    rng = np.random.default_rng(0)
+    perturbed = [(perturb(data, rng), label) for data, label in corpus]
+    results = []
+    for views in views_list:
+        timings = {stage: [] for stage in STAGES}
+        correct = 0
+        for data, label in perturbed:
+            rankings, _ = run_pipeline([data], reference_folder, db_path, timings, views)
+            correct += bool(rankings[0]) and rankings[0][0][0] == label
+        results.append({
+            "views": views,
+            "perturbed_top1": round(correct / max(len(perturbed), 1), 4),
+            "latency": percentiles(timings["total"]),
+            "forward": percentiles(timings["forward"]),
+        })
+        print(json.dumps(results[-1]))
+    return results
+
+
+def bench_hierarchy(corpus, reference_folder, top_ks):
+    # Плоский пошук (k=0) проти ієрархічного з різним числом категорій на спотворених копіях корпусу:
+    # ембедінги рахуються один раз, заміряється лише оцінювання
+    rng = np.random.default_rng(0)
+    perturbed = [(perturb(data, rng), label) for data, label in corpus]
+    features = clip_recognizer.embed_images([data for data, _ in perturbed])
+    scorer = clip_recognizer.get_scorer(reference_folder)
+    router = clip_recognizer.get_router(reference_folder)
+    categories = dict(zip(scorer.label_names, scorer.label_categories))
+    always = set(clip_recognizer.ALWAYS_SCORE_CATEGORIES)
+    flat = None
+    results = []
+    for top_k in [0] + [k for k in top_ks if k > 0]:
+        timings = []
+        rankings = []
+        for row in features:
+            started = time.perf_counter()
+            rankings.append(clip_recognizer.rank_embeddings(row[None], reference_folder, category_top_k=top_k)[0])
+            timings.append(_elapsed_ms(started))
+        top1 = [ranking[0][0] if ranking else None for ranking in rankings]
+        flat = flat or top1
+        dangerous = [i for i, (_, label) in enumerate(perturbed) if categories.get(label) in always]
+        scored = [len(router.route(row, top_k)) for row in features] if top_k else [len(scorer.label_names)] * len(features)
+        results.append({
+            "category_top_k": top_k,
+            "top1": round(sum(t == label for t, (_, label) in zip(top1, perturbed)) / max(len(perturbed), 1), 4),
+            "category_top1": round(
+                sum(categories.get(t) == categories.get(label) for t, (_, label) in zip(top1, perturbed)) / max(len(perturbed), 1), 4
+            ),
+            "dangerous_category_recall": round(
+                sum(categories.get(top1[i]) == categories.get(perturbed[i][1]) for i in dangerous) / len(dangerous), 4
+            ) if dangerous else None,
+            "agreement_with_flat": round(sum(a == b for a, b in zip(top1, flat)) / max(len(top1), 1), 4),
+            "labels_scored": round(float(np.mean(scored)), 1),
+            "scoring": percentiles(timings),
+        })
+        print(json.dumps(results[-1], ensure_ascii=False))
+    return results
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def probe_backbone(reference_folder, db_path, limit=0, folds=5):
+    # Звіт для поточного BACKBONE (запускається в окремому процесі, див. bench_backbones)
+    from backbones import BACKBONE
+    from evaluate import evaluate
+
+    baseline_mb = _peak_rss_mb()
+    started = time.perf_counter()
+    backend = model_manager.get_backend()
+    load_s = time.perf_counter() - started
+    # Приріст пікової пам'яті за завантаження моделі разом із рантаймом (torch/onnxruntime)
+    load_mb = _peak_rss_mb() - baseline_mb
+    started = time.perf_counter()
+    index = clip_recognizer.get_index(reference_folder)
+    index_s = time.perf_counter() - started
+
+    corpus = load_corpus(reference_folder, limit)
+    batches = {1: [], 8: []}
+    for batch_size, timings in batches.items():
+        tensors = [clip_recognizer.load_image(data) for data, _ in corpus]
+        backend.embed(np.concatenate(tensors[:batch_size]))
+        for start in range(0, len(tensors), batch_size):
+            batch = np.concatenate(tensors[start:start + batch_size])
+            stage = time.perf_counter()
+            backend.embed(batch)
+            timings.append(_elapsed_ms(stage) / len(batch))
+    accuracy = evaluate(reference_folder, db_path, ["recognize_weapon"], folds, limit)["recognize_weapon"]
+    weights = model_manager.MODEL_WEIGHTS_PATH
+    return {
+        "backbone": BACKBONE,
+        "backend": backend.name,
+        "mode": backend.mode,
+        "dim": index.dim,
+        "weights_mb": round(os.path.getsize(weights) / 2 ** 20, 1) if os.path.exists(weights) else None,
+        "load_s": round(load_s, 3),
+        "index_s": round(index_s, 3),
+        "load_rss_mb": round(load_mb, 1),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "forward_per_image_b1": percentiles(batches[1]),
+        "forward_per_image_b8": percentiles(batches[8]),
+        "top1": accuracy["top1"],
+        "top5": accuracy["top5"],
+        "dangerous": accuracy["dangerous"],
+        "pipeline_latency": accuracy["latency"],
+    }
+
+
+def bench_backbones(specs, reference_folder, db_path, limit=0, folds=5):
+    # "назва" або "назва=шлях/до/ваг"; кожен екстрактор — окремий процес (своя модель, свій індекс)
+    results = []
+    for spec in specs:
+        name, _, weights = spec.partition("=")
+        env = {key: value for key, value in os.environ.items() if key not in ("MODEL_WEIGHTS_PATH", "ONNX_MODEL_PATH")}
+        env["BACKBONE"] = name
+        if weights:
+            env["MODEL_WEIGHTS_PATH"] = weights
+        command = [
+            sys.executable, os.path.abspath(__file__), "--images", reference_folder, "--db", db_path,
+            "--limit", str(limit), "--folds", str(folds), "--probe-backbone",
+        ]
+        completed = subprocess.run(command, env=env, capture_output=True, text=True)
+        if completed.returncode != 0:
+            lines = completed.stderr.strip().splitlines()
+            results.append({"backbone": name, "error": lines[-1] if lines else "помилка"})
+        else:
+            results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        print(json.dumps(results[-1], ensure_ascii=False))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare_reports(previous, current):
+    # Зміна p50/p95 по етапах відносно попереднього звіту (додатне — повільніше)
+    diff = {}
+    for stage in STAGES:
+        old = previous.get("stages", {}).get(stage, {})
+        new = current.get("stages", {}).get(stage, {})
+        if old.get("p50_ms") and new.get("p50_ms"):
+            diff[stage] = {
+                key: round((new[key] - old[key]) / old[key] * 100, 1)
+                for key in ("p50_ms", "p95_ms") if old.get(key)
+            }
+    return diff
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк конвеєра розпізнавання")
+    parser.add_argument("--images", default="weapon_images")
+    parser.add_argument("--db", default="weapons_db.json")
+    parser.add_argument("--limit", type=int, default=0, help="Скільки зображень корпусу взяти (0 — всі)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--views", type=int, nargs="+", default=[1, 3, 5], help="Кількість ракурсів TTA для порівняння")
+    parser.add_argument("--category-top-k", type=int, nargs="+", default=[1, 2, 3],
+                        help="Скільки категорій оцінювати в ієрархічному пошуку (порівняння з плоским)")
+    parser.add_argument("--backbones", nargs="+", default=None,
+                        help="Лише порівняння екстракторів ознак: назва або назва=шлях_до_ваг (див. backbones)")
+    parser.add_argument("--folds", type=int, default=5, help="Фолди для оцінки точності екстракторів")
+    parser.add_argument("--probe-backbone", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--output", default="benchmark.json", help="Куди записати JSON-звіт")
+    parser.add_argument("--compare", default=None, help="Попередній JSON-звіт для порівняння")
+    args = parser.parse_args(argv)
+
+    if args.probe_backbone:
+        print(json.dumps(probe_backbone(args.images, args.db, args.limit, args.folds), ensure_ascii=False))
+        return 0
+    if args.backbones:
+        report = {
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "commit": git_commit(),
+            "cpu_count": os.cpu_count(),
+            "backbones": bench_backbones(args.backbones, args.images, args.db, args.limit, args.folds),
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"✅ Звіт записано у {args.output}")
+        return 0
+
+    started = time.perf_counter()
+    backend = model_manager.get_backend()
+    clip_recognizer.warm_up(args.images)
+    startup_s = time.perf_counter() - started
+
+    corpus = load_corpus(args.images, args.limit)
+    report = {
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "backbone": model_manager.BACKBONE,
+        "backend": backend.name,
+        "mode": backend.mode,
+        "aggregation": clip_recognizer.SCORE_AGGREGATION,
+        "ann_index": clip_recognizer.ANN_INDEX,
+        "corpus_images": len(corpus),
+        "startup_s": round(startup_s, 3),
+        "stages": bench_stages(corpus, args.images, args.db),
+    }
+    print(json.dumps({"stages": report["stages"]}, ensure_ascii=False))
+    report["throughput"] = bench_throughput(corpus, args.images, args.db, args.batch_sizes, args.threads)
+    report["tta"] = bench_tta(corpus, args.images, args.db, args.views)
+    report["hierarchy"] = bench_hierarchy(corpus, args.images, args.category_top_k)
+
+    if args.compare and os.path.exists(args.compare):
+        with open(args.compare, "r", encoding="utf-8") as f:
+            report["compare_pct"] = compare_reports(json.load(f), report)
+        print(json.dumps({"compare_pct": report["compare_pct"]}))
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"✅ Звіт записано у {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
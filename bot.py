@@ -5,35 +5,92 @@ from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
     filters, CallbackQueryHandler, ContextTypes
 )
-from clip_recognizer import recognize_weapon
-from datetime import datetime
-from asyncio import to_thread
+from clip_recognizer import (
+    recognize_batch, warm_up, is_ready, index_version, rank_embeddings, format_result, load_weapons_db, is_dangerous
+)
+from weapons_catalog import get_catalog
+from batching import BatchingEngine
+from result_cache import ResultCache, CachedResult, content_key
+from admission import AdmissionController, Superseded, QueueFull, PRIORITY_HIGH, PRIORITY_NORMAL
+from worker_pool import RecognitionPool, RECOGNITION_WORKERS
+from user_state import UserStateStore, USER_STATE_PATH
+from recognition_log import (
+    RecognitionLog, user_history, export_history, import_legacy_log, RECOGNITION_LOG_PATH, HISTORY_PAGE_SIZE, EXPORT_FORMATS
+)
+from datetime import datetime, timedelta
+from asyncio import to_thread, get_running_loop, CancelledError
+import time
 
 # Константи
 TOKEN = os.environ.get("TOKEN")
-PHOTO_PATH = "input_photos/test.jpg"
-LOG_FILE = "user_logs.txt"
+REFERENCE_FOLDER = "weapon_images"
+DB_PATH = "weapons_db.json"
+# Мікро-пакетування: скільки фото максимум в одному прогоні моделі і скільки чекати на сусідів
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", "30"))
+# Скільки оновлень обробляється одночасно — інакше фото різних користувачів ідуть строго по черзі
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "64"))
+# Режим отримання оновлень: polling (за замовчуванням) або webhook — без затримки long-poll.
+# Webhook потребує сервісу з публічним портом (на Render — type: web, а не worker).
+# Лише одна репліка: стан користувачів, журнал (SQLite), ліміти admission і кеш результатів —
+# локальні для процесу, тож кілька реплік за балансувальником бачили б різні дані
+RUN_MODE = os.environ.get("RUN_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+# Публічна адреса сервісу, напр. https://weaponid-ua.onrender.com (шлях WEBHOOK_PATH додається сам)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+# Інша адреса Bot API — для локальної перевірки з fake_telegram.py
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
 
 # Налаштування логування
 logging.basicConfig(level=logging.INFO)
 
-# Дані користувачів
-user_langs = {}
-user_locations = {}
-user_last_result = {}
+# Сервіси бота створюються в create_services() з main(), а не під час імпорту: процеси-воркери пулу
+# (spawn) імпортують цей файл як __mp_main__ і не повинні створювати власні черги, кеш і журнали
+admission = None
+result_cache = None
+user_state = None
+recognition_log = None
+recognition_pool = None
+recognition_engine = None
+
+def create_services():
+    global admission, result_cache, user_state, recognition_log, recognition_pool, recognition_engine
+    # Ліміти на користувача і черга розпізнавання (див. admission)
+    admission = AdmissionController()
+
+    # Кеш результатів для однакових фото (file_unique_id / вміст), див. result_cache
+    result_cache = ResultCache()
+
+    # Дані користувачів (мова, локація, останній результат): обмежений кеш + SQLite, див. user_state
+    user_state = UserStateStore(USER_STATE_PATH)
+
+    # Журнал розпізнавань пишеться у фоновому потоці (див. recognition_log)
+    recognition_log = RecognitionLog(RECOGNITION_LOG_PATH)
+
+    # RECOGNITION_WORKERS > 0 — пакети обробляються в пулі процесів (по пакету на воркер одночасно),
+    # інакше — в потоці цього ж процесу
+    recognition_pool = RecognitionPool(REFERENCE_FOLDER, DB_PATH) if RECOGNITION_WORKERS > 0 else None
+    recognition_engine = BatchingEngine(
+        recognition_pool.run if recognition_pool else lambda images: recognize_batch(images, REFERENCE_FOLDER, DB_PATH, with_ranking=True),
+        max_batch_size=BATCH_MAX_SIZE,
+        max_wait_ms=BATCH_MAX_WAIT_MS,
+        max_concurrency=RECOGNITION_WORKERS or 1,
+    )
+
+def recognizer_ready():
+    return recognition_pool.is_ready() if recognition_pool else is_ready()
 
 # Функції
-def get_lang(user_id):
-    return user_langs.get(user_id, "ua")
+async def get_lang(user_id):
+    return await user_state.aget(user_id, "lang", "ua")
 
-def log_user_data(user_id, text):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(f"[{timestamp}] User: {user_id} — {text}\n")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    lang = get_lang(user_id)
+    lang = await get_lang(user_id)
 
     main_menu = ReplyKeyboardMarkup([
         ["📄 Мій журнал", "📍 Місцезнаходження"],
@@ -57,6 +114,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "\n📷 Надішліть фото — розпізнаю зброю або боєприпас."
         "\n📍 /location — Надіслати локацію (координати)."
         "\n📄 /mylog — Отримати журнал знайдених об'єктів."
+        "\n   /mylog csv 2 2024-05-01 2024-05-31 — формат, сторінка, період."
         "\n🌐 /lang — Змінити мову."
         "\nℹ️ /help — Показати цю інструкцію."
     )
@@ -72,10 +130,10 @@ async def set_language(update: Update, context: ContextTypes.DEFAULT_TYPE):
     choice = update.message.text
 
     if "Українська" in choice:
-        user_langs[user_id] = "ua"
+        await user_state.aset(user_id, "lang", "ua")
         await update.message.reply_text("✅ Мову змінено на українську.")
     elif "English" in choice:
-        user_langs[user_id] = "en"
+        await user_state.aset(user_id, "lang", "en")
         await update.message.reply_text("✅ Language set to English.")
     else:
         await update.message.reply_text("⚠️ Невідома мова. Виберіть ще раз за допомогою /lang.")
@@ -87,10 +145,13 @@ async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if message.location:
         lat = message.location.latitude
         lon = message.location.longitude
-        user_locations[user_id] = f"Широта: {lat}, Довгота: {lon}"
+        await user_state.aset(user_id, "location", f"Широта: {lat}, Довгота: {lon}")
 
-        if user_id in user_last_result:
-            log_user_data(user_id, f"{user_last_result[user_id]} | Координати: {lat},{lon}")
+        last = await user_state.aget(user_id, "last_result")
+        if last:
+            recognition_log.write(
+                user_id, "location", ranking=last["ranking"], latitude=lat, longitude=lon, result=last["result"]
+            )
 
         coords = f"{lat}, {lon}"
         text = (
@@ -112,42 +173,137 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    lang = get_lang(user_id)
+    lang = await get_lang(user_id)
+
+    # Поки модель прогрівається у фоні, не ставимо фото в чергу, а просимо зачекати
+    if not recognizer_ready():
+        text_warm = (
+            "⏳ Модель ще завантажується. Надішліть фото ще раз за хвилину."
+            if lang == "ua" else
+            "⏳ The model is still warming up. Please resend the photo in a minute."
+        )
+        await update.message.reply_text(text_warm)
+        return
 
-    photo_file = await update.message.photo[-1].get_file()
-    os.makedirs(os.path.dirname(PHOTO_PATH), exist_ok=True)
-    await photo_file.download_to_drive(PHOTO_PATH)
+    allowed, retry_after = admission.allow(user_id)
+    if not allowed:
+        seconds = max(1, int(retry_after + 0.999))
+        await update.message.reply_text(
+            f"⏳ Забагато фото поспіль. Спробуйте ще раз через {seconds} с."
+            if lang == "ua" else
+            f"⏳ Too many photos in a row. Please try again in {seconds} s."
+        )
+        return
 
-    text_wait = "🔍 Обробка зображення може зайняти 70-120с" if lang == "ua" else "🔍 Processing image..."
-    await update.message.reply_text(text_wait)
+    # Те саме фото (переслане/повторне) — відповідь з кешу без завантаження і без черги
+    started = time.perf_counter()
+    photo = update.message.photo[-1]
+    cached = result_cache.get_file(photo.file_unique_id)
+    if cached is not None:
+        found = await to_thread(cached_result, cached)
+        if found is not None:
+            await reply_recognition(update, user_id, lang, *found, started)
+            return
 
     try:
-        result = await to_thread(recognize_weapon, PHOTO_PATH, "weapon_images", "weapons_db.json")
-        user_last_result[user_id] = result.replace("\n", " | ")
-
-        if lang == "ua":
-            result += (
-                "\n\n📞 Якщо ви впевнені, що це небезпечний об’єкт:\n"
-                "Зателефонуйте до:\n"
-                "• ДСНС: +0000000000\n"
-                "• СБУ: +0000000000\n"
-                "\n📍 Бажаєте побачити координати? Введіть команду /location або скористайтесь кнопкою внизу."
-                "\n📍 Бажаєте побачити меню? Введіть команду /help"
-            )
-        else:
-            result += (
-                "\n\n📞 If you believe this object is dangerous:\n"
-                "Please call:\n"
-                "• Emergency Service: +0000000000\n"
-                "• Security Service: +0000000000\n"
-                "\n📍 Would you like to share your location? Type /location or use the button below."
-            )
+        ticket, replaced = admission.enqueue(user_id, await recognition_priority(user_id))
+    except QueueFull:
+        await update.message.reply_text(
+            "⚠️ Сервіс перевантажено. Спробуйте за хвилину." if lang == "ua" else "⚠️ The service is overloaded. Please try again in a minute."
+        )
+        return
 
-        await update.message.reply_text(result)
+    try:
+        await process_photo(update, user_id, lang, ticket, replaced, started)
+    except Superseded:
+        # Користувач уже надіслав нове фото — відповідатиме новий запит
+        pass
+    finally:
+        admission.release(ticket)
+
+async def recognition_priority(user_id):
+    # Повторна перевірка після результату «гранати»/«міни» обробляється поза чергою
+    last = await user_state.aget(user_id, "last_result")
+    if last and last.get("ranking") and is_dangerous(last["ranking"][0][1]):
+        return PRIORITY_HIGH
+    return PRIORITY_NORMAL
+
+def cached_result(entry):
+    # Текст результату з кешу; якщо галерея змінилась — ранжування перераховується з ембедінгів
+    version = index_version(REFERENCE_FOLDER)
+    ranking = entry.ranking
+    if entry.version != version:
+        if entry.features is None:
+            return None
+        ranking = rank_embeddings(entry.features, REFERENCE_FOLDER, view_counts=[len(entry.features)])[0]
+        result_cache.update(entry.key, ranking, version)
+    return format_result(ranking, load_weapons_db(DB_PATH)), ranking
+
+async def process_photo(update, user_id, lang, ticket, replaced, started):
+    # Фото завантажується в пам'ять: без спільного файлу на диску і без повторного читання
+    photo = update.message.photo[-1]
+    photo_file = await photo.get_file()
+    photo_bytes = bytes(await photo_file.download_as_bytearray())
+
+    key = content_key(photo_bytes)
+    cached = result_cache.get_content(key, photo.file_unique_id)
+    if cached is not None:
+        found = await to_thread(cached_result, cached)
+        if found is not None:
+            await reply_recognition(update, user_id, lang, *found, started)
+            return
+
+    # Час очікування — з фактичного часу пакетів і довжини черги, а не фіксована оцінка
+    position = admission.position(ticket)
+    estimate = recognition_engine.estimated_wait(position or 0)
+    if estimate is None:
+        text_wait = "🔍 Обробка зображення..." if lang == "ua" else "🔍 Processing image..."
+    else:
+        seconds = max(1, round(estimate))
+        text_wait = f"🔍 Обробка зображення займе близько {seconds} с" if lang == "ua" else f"🔍 Processing image, about {seconds} s..."
+    if replaced:
+        text_wait = ("♻️ Попереднє фото скасовано.\n" if lang == "ua" else "♻️ Previous photo cancelled.\n") + text_wait
+    if position:
+        text_wait += f"\n🕒 Ваше місце в черзі: {position}" if lang == "ua" else f"\n🕒 Your place in the queue: {position}"
+    await update.message.reply_text(text_wait)
 
+    try:
+        await admission.wait(ticket)
+        version = await to_thread(index_version, REFERENCE_FOLDER)
+        result, ranking, features = await admission.guard(ticket, recognition_engine.submit(photo_bytes))
+        result_cache.put(CachedResult(key, ranking, features, version), photo.file_unique_id)
+        await reply_recognition(update, user_id, lang, result, ranking, started)
+    except Superseded:
+        raise
     except Exception as e:
         await update.message.reply_text(f"⚠️ Помилка розпізнавання: {e}" if lang == "ua" else f"⚠️ Recognition error: {e}")
 
+async def reply_recognition(update, user_id, lang, result, ranking, started):
+    latency_ms = (time.perf_counter() - started) * 1000
+    last = {"result": result.replace("\n", " | "), "ranking": ranking}
+    await user_state.aset(user_id, "last_result", last)
+    recognition_log.write(user_id, "recognition", ranking=ranking, latency_ms=latency_ms, result=last["result"])
+
+    if lang == "ua":
+        result += (
+            "\n\n📞 Якщо ви впевнені, що це небезпечний об’єкт:\n"
+            "Зателефонуйте до:\n"
+            "• ДСНС: +0000000000\n"
+            "• СБУ: +0000000000\n"
+            "\n📍 Бажаєте побачити координати? Введіть команду /location або скористайтесь кнопкою внизу."
+            "\n📍 Бажаєте побачити меню? Введіть команду /help"
+        )
+    else:
+        result += (
+            "\n\n📞 If you believe this object is dangerous:\n"
+            "Please call:\n"
+            "• Emergency Service: +0000000000\n"
+            "• Security Service: +0000000000\n"
+            "\n📍 Would you like to share your location? Type /location or use the button below."
+        )
+
+    await update.message.reply_text(result)
+
 async def handle_other(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     if text == "📄 Мій журнал":
@@ -161,37 +317,107 @@ async def handle_other(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("ℹ️ Надішліть фото або скористайтесь кнопками в меню.")
 
+def parse_log_args(args):
+    # /mylog [txt|csv|json] [сторінка] [з YYYY-MM-DD] [по YYYY-MM-DD]
+    fmt, page, dates = "txt", 1, []
+    for arg in args or []:
+        arg = arg.lower()
+        if arg in EXPORT_FORMATS:
+            fmt = arg
+        elif arg.isdigit():
+            page = max(1, int(arg))
+        else:
+            dates.append(datetime.strptime(arg, "%Y-%m-%d"))
+    since = dates[0] if dates else None
+    # Кінцева дата включно — до початку наступного дня
+    until = dates[1] + timedelta(days=1) if len(dates) > 1 else None
+    return fmt, page, since, until
+
 async def send_user_log(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
-    if not os.path.exists(LOG_FILE):
+    if not os.path.exists(RECOGNITION_LOG_PATH):
         await update.message.reply_text("📂 Лог ще не створено.")
         return
 
-    with open(LOG_FILE, "r", encoding="utf-8") as f:
-        lines = [line for line in f if f"User: {user_id}" in line]
-
-    if not lines:
-        await update.message.reply_text("📂 У вас ще немає записів у журналі.")
+    try:
+        fmt, page, since, until = parse_log_args(context.args)
+    except ValueError:
+        await update.message.reply_text(
+            "⚠️ Формат: /mylog [txt|csv|json] [сторінка] [з YYYY-MM-DD] [по YYYY-MM-DD]"
+        )
         return
 
-    user_log_path = f"user_{user_id}_log.txt"
-    with open(user_log_path, "w", encoding="utf-8") as f:
-        f.writelines(lines)
+    rows, total = await to_thread(user_history, user_id, since, until, page, HISTORY_PAGE_SIZE, RECOGNITION_LOG_PATH)
 
-    with open(user_log_path, "rb") as doc:
-        await update.message.reply_document(InputFile(doc), filename=f"your_log_{user_id}.txt")
+    if not rows:
+        text = "📂 У вас ще немає записів у журналі." if not total else "📂 На цій сторінці записів немає."
+        await update.message.reply_text(text)
+        return
 
-    os.remove(user_log_path)
+    document = export_history(rows, fmt)
+    pages = -(-total // HISTORY_PAGE_SIZE)
+    await update.message.reply_document(
+        InputFile(document, filename=f"your_log_{user_id}_{page}.{fmt}"),
+        caption=f"📄 Сторінка {page} з {pages} (записів: {total})" if pages > 1 else None,
+    )
 
 async def request_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [[KeyboardButton(text="📍 Подивитися локацію", request_location=True)]]
     reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
     await update.message.reply_text("📍 Натисніть кнопку нижче, щоб підтвердити локацію:", reply_markup=reply_markup)
 
+async def warm_up_recognizer():
+    try:
+        if recognition_pool:
+            await to_thread(recognition_pool.start)
+            await recognition_pool.warm_up()
+        else:
+            await to_thread(warm_up, REFERENCE_FOLDER)
+        logging.info("✅ Розпізнавач готовий до роботи")
+        issues = {k: v for k, v in get_catalog(DB_PATH).validate(REFERENCE_FOLDER).items() if v}
+        if issues:
+            logging.warning("⚠️ Розбіжності між %s та %s: %s", DB_PATH, REFERENCE_FOLDER, issues)
+    except Exception as e:
+        logging.exception("❌ Не вдалося прогріти розпізнавач: %s", e)
+
+async def post_init(app):
+    # Модель та індекс вантажаться у фоні, опитування Telegram стартує одразу
+    imported = await to_thread(import_legacy_log)
+    if imported:
+        logging.info("📥 Імпортовано записів зі старого журналу: %d", imported)
+    recognition_log.start()
+    user_state.start()
+    # Задача створюється в циклі подій напряму (app.create_task до старту застосунку її не відстежує),
+    # щоб скасувати її під час зупинки, якщо прогрівання ще триває
+    app.bot_data["warm_up_task"] = get_running_loop().create_task(warm_up_recognizer())
+
+async def post_shutdown(app):
+    warm_up_task = app.bot_data.get("warm_up_task")
+    if warm_up_task and not warm_up_task.done():
+        warm_up_task.cancel()
+        try:
+            await warm_up_task
+        except CancelledError:
+            pass
+    await recognition_engine.stop()
+    logging.info("📊 Кеш результатів: %s", result_cache.metrics())
+    if recognition_pool:
+        await to_thread(recognition_pool.close)
+    await to_thread(recognition_log.close)
+    await to_thread(user_state.close)
+
 # ⚡ Головна функція
 def main():
-    app = ApplicationBuilder().token(TOKEN).build()
+    create_services()
+    builder = (
+        ApplicationBuilder().token(TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init).post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
@@ -203,8 +429,23 @@ def main():
     app.add_handler(MessageHandler(filters.TEXT, handle_other))
     app.add_handler(CallbackQueryHandler(button_handler))
 
-    logging.info("✅ Bot started successfully and polling...")
-    app.run_polling()
+    if RUN_MODE == "webhook":
+        # Без публічної адреси PTB зареєстрував би http://0.0.0.0:..., Telegram її відхиляє,
+        # і бот мовчки не отримував би жодного оновлення
+        if not WEBHOOK_URL:
+            raise SystemExit("❌ RUN_MODE=webhook потребує WEBHOOK_URL (публічна https-адреса сервісу)")
+        webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        logging.info("✅ Bot started successfully, webhook on %s:%d/%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=webhook_url,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        logging.info("✅ Bot started successfully and polling...")
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,288 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+# Навчувана «голова» над кешованими ембедінгами галереї (weapon_index.emb): замість усереднення
+# косинусних схожостей — одне множення на матрицю міток (L×D) і softmax з підібраною температурою.
+#   prototype — нормовані центроїди міток (без навчання);
+#   logreg    — мультиноміальна логістична регресія (градієнтний спуск на numpy, секунди на CPU).
+# Температура і пороги відмови по категоріях підбираються на out-of-fold передбаченнях (k-fold),
+# остаточна голова навчається на всій галереї.
+HEAD_KINDS = ("prototype", "logreg")
+HEAD_PATH = os.environ.get("HEAD_PATH", "weapon_index.head.npz")
+HEAD_KIND = os.environ.get("HEAD_KIND", "logreg")
+# Частка правильних відповідей, якої має досягати відповідь вище порогу категорії
+HEAD_TARGET_PRECISION = float(os.environ.get("HEAD_TARGET_PRECISION", "0.9"))
+# Категорії з меншою кількістю out-of-fold передбачень отримують загальний поріг
+MIN_CATEGORY_SAMPLES = 5
+TEMPERATURES = np.logspace(-3, 1, 200)
+
+
+def softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def fit_prototypes(x, y, n_labels):
+    weights = np.zeros((n_labels, x.shape[1]), dtype=np.float32)
+    np.add.at(weights, y, x)
+    weights /= np.maximum(np.linalg.norm(weights, axis=1, keepdims=True), 1e-12)
+    return weights, np.zeros(n_labels, dtype=np.float32)
+
+
+def fit_logreg(x, y, n_labels, l2=1e-3, epochs=300, lr=0.5):
+    # Повний пакет, Nesterov momentum; старт із прототипів, тож сходиться за сотні кроків
+    weights, bias = fit_prototypes(x, y, n_labels)
+    weights *= 10.0
+    targets = np.zeros((len(x), n_labels), dtype=np.float32)
+    targets[np.arange(len(x)), y] = 1.0
+    velocity_w = np.zeros_like(weights)
+    velocity_b = np.zeros_like(bias)
+    for _ in range(epochs):
+        look_w, look_b = weights + 0.9 * velocity_w, bias + 0.9 * velocity_b
+        error = (softmax(x @ look_w.T + look_b) - targets) / len(x)
+        velocity_w = 0.9 * velocity_w - lr * (error.T @ x + l2 * look_w)
+        velocity_b = 0.9 * velocity_b - lr * error.sum(axis=0)
+        weights, bias = weights + velocity_w, bias + velocity_b
+    return weights.astype(np.float32), bias.astype(np.float32)
+
+
+def fit(x, y, n_labels, kind="logreg"):
+    if kind == "prototype":
+        return fit_prototypes(x, y, n_labels)
+    if kind == "logreg":
+        return fit_logreg(x, y, n_labels)
+    raise ValueError(f"Невідомий тип голови: {kind}")
+
+
+def stratified_folds(y, folds):
+    # Зображення кожної мітки розкладаються по фолдах по черзі
+    assignment = np.empty(len(y), dtype=np.int64)
+    seen = {}
+    for i, label in enumerate(y):
+        assignment[i] = seen.get(label, 0) % folds
+        seen[label] = seen.get(label, 0) + 1
+    return assignment
+
+
+def out_of_fold_logits(x, y, n_labels, kind, folds):
+    logits = np.zeros((len(x), n_labels), dtype=np.float32)
+    assignment = stratified_folds(y, folds)
+    for fold in range(folds):
+        held = assignment == fold
+        if not held.any() or held.all():
+            continue
+        weights, bias = fit(x[~held], y[~held], n_labels, kind)
+        fold_logits = x[held] @ weights.T + bias
+        # Мітки без жодного зображення в навчальній частині передбачити неможливо
+        missing = np.setdiff1d(np.arange(n_labels), y[~held])
+        fold_logits[:, missing] = -np.inf
+        logits[held] = fold_logits
+    return logits
+
+
+def fit_temperature(logits, y):
+    # Температура з мінімальним NLL на out-of-fold передбаченнях
+    best, best_nll = 1.0, np.inf
+    for temperature in TEMPERATURES:
+        probs = softmax(logits / temperature)
+        nll = -np.mean(np.log(np.maximum(probs[np.arange(len(y)), y], 1e-12)))
+        if nll < best_nll:
+            best, best_nll = float(temperature), nll
+    return best
+
+
+def expected_calibration_error(probs, y, bins=10):
+    confidence = probs.max(axis=1)
+    correct = probs.argmax(axis=1) == y
+    edges = np.linspace(0, 1, bins + 1)
+    error = 0.0
+    for low, high in zip(edges[:-1], edges[1:]):
+        mask = (confidence > low) & (confidence <= high)
+        if mask.any():
+            error += mask.mean() * abs(correct[mask].mean() - confidence[mask].mean())
+    return float(error)
+
+
+def precision_threshold(confidence, correct, target):
+    # Найменший поріг, вище якого частка правильних відповідей не нижча за target;
+    # None — немає передбачень або точності не досягнуто за жодного порогу
+    if not len(confidence):
+        return None
+    order = np.argsort(-confidence)
+    precision = np.cumsum(correct[order]) / np.arange(1, len(order) + 1)
+    ok = np.flatnonzero(precision >= target)
+    if not len(ok):
+        return None
+    return float(confidence[order][ok[-1]])
+
+
+def category_thresholds(probs, y, label_categories, target):
+    # Повертає (пороги категорій, загальний поріг, категорії з недосяжною точністю target).
+    # Такі категорії отримують загальний поріг, а не поріг «завжди відмовляти». Якщо target
+    # недосяжна і на всій галереї, загального порогу немає (None) — голову не використовують
+    predicted = probs.argmax(axis=1)
+    confidence = probs.max(axis=1)
+    correct = predicted == y
+    categories = np.asarray(label_categories)[predicted]
+    default = precision_threshold(confidence, correct, target)
+    if default is None:
+        return {}, None, sorted(set(label_categories))
+    thresholds, fallback = {}, []
+    for category in sorted(set(label_categories)):
+        mask = categories == category
+        threshold = None
+        if mask.sum() >= MIN_CATEGORY_SAMPLES:
+            threshold = precision_threshold(confidence[mask], correct[mask], target)
+            if threshold is None:
+                fallback.append(category)
+        thresholds[category] = default if threshold is None else threshold
+    return thresholds, default, fallback
+
+
+def topk_accuracy(probs, y, k):
+    k = min(k, probs.shape[1])
+    top = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+    return float(np.mean([label in row for label, row in zip(y, top)]))
+
+
+class ClassifierHead:
+    def __init__(self, weights, bias, label_names, label_categories, temperature, thresholds, default_threshold,
+                 fingerprint="", kind="logreg"):
+        self.weights = np.ascontiguousarray(weights, dtype=np.float32)
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.label_names = list(label_names)
+        self.label_categories = list(label_categories)
+        self.temperature = float(temperature)
+        self.thresholds = dict(thresholds)
+        self.default_threshold = float(default_threshold)
+        self.fingerprint = fingerprint
+        self.kind = kind
+
+    def predict(self, features):
+        # Калібровані ймовірності міток: (N, D) → (N, L)
+        features = np.atleast_2d(np.asarray(features, dtype=np.float32))
+        return softmax((features @ self.weights.T + self.bias) / self.temperature)
+
+    def threshold(self, category):
+        return self.thresholds.get(category, self.default_threshold)
+
+    def matches(self, index):
+        # Голова придатна, лише якщо навчена саме на цій версії галереї
+        return (
+            self.fingerprint == index.fingerprint()
+            and self.label_names == list(index.label_names)
+            and self.label_categories == list(index.label_categories)
+        )
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            weights=self.weights,
+            bias=self.bias,
+            label_names=np.asarray(self.label_names, dtype=str),
+            label_categories=np.asarray(self.label_categories, dtype=str),
+            temperature=np.asarray(self.temperature),
+            thresholds=np.asarray(json.dumps(self.thresholds, ensure_ascii=False)),
+            default_threshold=np.asarray(self.default_threshold),
+            fingerprint=np.asarray(self.fingerprint),
+            kind=np.asarray(self.kind),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                data["weights"], data["bias"], data["label_names"].tolist(), data["label_categories"].tolist(),
+                float(data["temperature"]), json.loads(str(data["thresholds"])), float(data["default_threshold"]),
+                str(data["fingerprint"]), str(data["kind"]),
+            )
+
+
+def train_head(index, kind=HEAD_KIND, folds=3, target=HEAD_TARGET_PRECISION):
+    # Повертає (голова, звіт з out-of-fold метриками); голова None, якщо точність target недосяжна
+    # на всій галереї — тоді лишається пошук схожості з MIN_SIMILARITY
+    x = np.asarray(index.embeddings, dtype=np.float32)
+    y = np.repeat(np.arange(len(index.label_counts)), index.label_counts)
+    n_labels = len(index.label_names)
+    started = time.perf_counter()
+    logits = out_of_fold_logits(x, y, n_labels, kind, folds)
+    temperature = fit_temperature(logits, y)
+    probs = softmax(logits / temperature)
+    thresholds, default, fallback = category_thresholds(probs, y, index.label_categories, target)
+    head = None
+    if default is not None:
+        weights, bias = fit(x, y, n_labels, kind)
+        head = ClassifierHead(weights, bias, index.label_names, index.label_categories, temperature, thresholds,
+                              default, index.fingerprint(), kind)
+
+    confidence = probs.max(axis=1)
+    predicted = probs.argmax(axis=1)
+    accepted = np.zeros(len(x), dtype=bool)
+    if head is not None:
+        accepted = confidence >= np.asarray([head.threshold(index.label_categories[p]) for p in predicted])
+    report = {
+        "kind": kind,
+        "images": len(x),
+        "labels": n_labels,
+        "folds": folds,
+        "train_s": round(time.perf_counter() - started, 3),
+        "oof_top1": round(topk_accuracy(probs, y, 1), 4),
+        "oof_top5": round(topk_accuracy(probs, y, 5), 4),
+        "temperature": round(temperature, 5),
+        "ece_uncalibrated": round(expected_calibration_error(softmax(logits), y), 4),
+        "ece_calibrated": round(expected_calibration_error(probs, y), 4),
+        "coverage": round(float(accepted.mean()), 4),
+        "precision_when_answering": round(float((predicted == y)[accepted].mean()), 4) if accepted.any() else None,
+        "thresholds": {category: round(value, 4) for category, value in thresholds.items()},
+        "default_threshold": None if default is None else round(default, 4),
+        # Категорії, де точність target недосяжна: для них діє загальний поріг
+        "threshold_fallback": fallback,
+    }
+    return head, report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Навчання голови класифікатора над кешованими ембедінгами")
+    parser.add_argument("--images", default="weapon_images", help="Папка з еталонними зображеннями")
+    parser.add_argument("--kind", choices=HEAD_KINDS, default=HEAD_KIND)
+    parser.add_argument("--folds", type=int, default=3, help="Кількість фолдів для калібрування і порогів")
+    parser.add_argument("--target-precision", type=float, default=HEAD_TARGET_PRECISION)
+    parser.add_argument("--output", default=HEAD_PATH, help="Файл голови")
+    parser.add_argument("--compare", action="store_true", help="Звіт для всіх типів голови, без збереження")
+    args = parser.parse_args(argv)
+
+    import model_manager
+    from clip_recognizer import get_index
+    from embedding_index import tagged_index_path
+
+    index = get_index(args.images)
+    if len(index) < 2:
+        print("❌ Замало зображень у галереї для навчання")
+        return 1
+    for kind in HEAD_KINDS if args.compare else [args.kind]:
+        head, report = train_head(index, kind, max(2, args.folds), args.target_precision)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        if head is None:
+            print(f"❌ Точність {args.target_precision} недосяжна на всій галереї — голова не придатна"
+                  f" (знизьте --target-precision або лишайтесь на пошуку схожості)")
+        elif report["threshold_fallback"]:
+            print(f"⚠️ Точність {args.target_precision} недосяжна для категорій {', '.join(report['threshold_fallback'])}"
+                  f" — для них загальний поріг {report['default_threshold']}")
+    if not args.compare:
+        if head is None:
+            return 1
+        output = tagged_index_path(args.output, model_manager.embedding_tag())
+        head.save(output)
+        print(f"✅ Голову збережено у {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,30 +1,271 @@
 import os
-import json
+import io
 from pathlib import Path
 from PIL import Image
-import torch
-import torchvision.transforms as transforms
-from torchvision import models
-
-device = "cuda" if torch.cuda.is_available() else "cpu"
-# Завантаження легкої моделі MobileNetV2
-model = models.mobilenet_v2(pretrained=True)
-model.classifier = torch.nn.Identity()  # Прибираємо останній класифікатор
-model = model.to(device).eval()
-
-# Трансформації для зображення
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-])
-
-def load_image(path):
-    image = Image.open(path).convert('RGB')
-    return transform(image).unsqueeze(0).to(device)
+import time
+import threading
+import numpy as np
+import model_manager
+from embedding_index import EmbeddingIndex, load_or_build_index, tagged_index_path, DEFAULT_INDEX_PATH
+from scoring import LabelScorer, CategoryRouter, fuse_views
+from ann_index import load_or_build_ann
+from weapons_catalog import get_catalog
+
+INDEX_PATH = os.environ.get("INDEX_PATH", DEFAULT_INDEX_PATH)
+# Як часто (с) перевіряти, чи файл індексу атомарно замінили новою версією галереї
+INDEX_RELOAD_INTERVAL = float(os.environ.get("INDEX_RELOAD_INTERVAL", "5"))
+# Агрегація схожості по мітці: mean (як раніше), max або topk (середнє k найкращих)
+SCORE_AGGREGATION = os.environ.get("SCORE_AGGREGATION", "mean")
+SCORE_TOP_K = int(os.environ.get("SCORE_TOP_K", "3"))
+TOP_N = int(os.environ.get("TOP_N", "3"))
+# Пошук кандидатів: exact (повний перебір) або ivf (наближений, для великих галерей).
+# ANN_PROBE — компроміс точність/швидкість, ANN_CANDIDATES — скільки найближчих еталонів брати
+ANN_INDEX = os.environ.get("ANN_INDEX", "exact")
+ANN_PATH = os.environ.get("ANN_PATH", "weapon_index.ann.npz")
+ANN_LISTS = int(os.environ.get("ANN_LISTS", "0"))
+ANN_PROBE = int(os.environ.get("ANN_PROBE", "8"))
+ANN_CANDIDATES = int(os.environ.get("ANN_CANDIDATES", "256"))
+# Перцептивні хеші перед CNN (див. image_matcher): точний дублікат еталона повертається без моделі,
+# а PHASH_PREFILTER обмежує оцінювання короткими списками міток-кандидатів.
+# Обидва вимкнено за замовчуванням: вартість етапу видно в benchmark.py (етап hashes)
+PHASH_DUPLICATES = os.environ.get("PHASH_DUPLICATES", "0") == "1"
+PHASH_PREFILTER = os.environ.get("PHASH_PREFILTER", "0") == "1"
+PHASH_RADIUS = int(os.environ.get("PHASH_RADIUS", "12"))
+PHASH_SHORTLIST = int(os.environ.get("PHASH_SHORTLIST", "10"))
+PHASH_DUPLICATE_DISTANCE = int(os.environ.get("PHASH_DUPLICATE_DISTANCE", "0"))
+# Навчена голова класифікатора (див. classifier_head): калібровані ймовірності міток замість
+# усереднених схожостей і пороги відмови по категоріях замість єдиного MIN_SIMILARITY
+CLASSIFIER_HEAD = os.environ.get("CLASSIFIER_HEAD", "0") == "1"
+HEAD_PATH = os.environ.get("HEAD_PATH", "weapon_index.head.npz")
+# Нижче цієї схожості (без голови) результат вважається ненадійним
+MIN_SIMILARITY = float(os.environ.get("MIN_SIMILARITY", "0.7"))
+# Вище цієї схожості (без голови) результат з небезпечної категорії показується з попередженням
+DANGER_SIMILARITY = 0.8
+# Ієрархічний пошук: спершу категорії (за центроїдами міток), потім мітки лише з CATEGORY_TOP_K
+# найближчих категорій; 0 — плоский пошук по всіх мітках. Категорії з ALWAYS_SCORE_CATEGORIES
+# (назви папок галереї) оцінюються завжди, щоб гранати й міни не відсікались першим етапом.
+# Це ж єдиний список небезпечних категорій: попередження у відповіді і пріоритет у черзі бота (is_dangerous)
+CATEGORY_TOP_K = int(os.environ.get("CATEGORY_TOP_K", "0"))
+ALWAYS_SCORE_CATEGORIES = tuple(
+    name.strip() for name in os.environ.get("ALWAYS_SCORE_CATEGORIES", "grenades,mines").split(",") if name.strip()
+)
+# Кілька ракурсів одного фото (TTA): 1 — вимкнено; до 9 — оригінал, дзеркало, центральний
+# і кутові кропи, повороти ±10°. Усі ракурси йдуть одним пакетом, оцінки міток усереднюються (mean) або max
+TTA_VIEWS = int(os.environ.get("TTA_VIEWS", "1"))
+TTA_FUSION = os.environ.get("TTA_FUSION", "mean")
+TTA_CROP = 0.8
+TTA_ANGLE = 10
+TTA_MAX_VIEWS = 9
+if not 1 <= TTA_VIEWS <= TTA_MAX_VIEWS:
+    raise ValueError(f"TTA_VIEWS={TTA_VIEWS}: допустимо від 1 до {TTA_MAX_VIEWS}")
+if TTA_FUSION not in ("mean", "max"):
+    raise ValueError(f"TTA_FUSION={TTA_FUSION}: допустимо mean або max")
+
+IMAGE_SIZE = 224
+
+def preprocess(image):
+    # Те саме, що Resize((224, 224)) + ToTensor() з torchvision, але на numpy — без імпорту torch
+    image = image.convert('RGB').resize((IMAGE_SIZE, IMAGE_SIZE), Image.BILINEAR)
+    array = np.asarray(image, dtype=np.float32) / 255.0
+    return array.transpose(2, 0, 1)[None]
+
+def open_image(source):
+    # Декодує шлях або байти в PIL-зображення один раз (для хешів і для моделі); решту повертає як є
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    if isinstance(source, (str, Path, io.IOBase)):
+        with Image.open(source) as image:
+            return image.convert('RGB')
+    return source
+
+def load_image(source):
+    # Приймає шлях, байти (фото з Telegram без запису на диск), PIL-зображення, масив або тензор.
+    # Повертає масив float32 форми (1, 3, 224, 224)
+    if hasattr(source, "detach"):
+        source = source.detach().cpu().numpy()
+    if isinstance(source, np.ndarray):
+        array = source.astype(np.float32, copy=False)
+        return array if array.ndim == 4 else array[None]
+    if isinstance(source, Image.Image):
+        return preprocess(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    with Image.open(source) as image:
+        return preprocess(image)
+
+def augment_views(image, views=TTA_VIEWS):
+    # Перші views ракурсів у порядку корисності; кожен потім стискається до 224×224 як звичайно
+    if views <= 1:
+        return [image]
+    if views > TTA_MAX_VIEWS:
+        raise ValueError(f"Ракурсів TTA може бути не більше {TTA_MAX_VIEWS}, запитано {views}")
+    width, height = image.size
+    w, h = int(width * TTA_CROP), int(height * TTA_CROP)
+    left, top = (width - w) // 2, (height - h) // 2
+    makers = [
+        lambda: image,
+        lambda: image.transpose(Image.FLIP_LEFT_RIGHT),
+        lambda: image.crop((left, top, left + w, top + h)),
+        lambda: image.rotate(TTA_ANGLE, resample=Image.BILINEAR),
+        lambda: image.rotate(-TTA_ANGLE, resample=Image.BILINEAR),
+        lambda: image.crop((0, 0, w, h)),
+        lambda: image.crop((width - w, 0, width, h)),
+        lambda: image.crop((0, height - h, w, height)),
+        lambda: image.crop((width - w, height - h, width, height)),
+    ]
+    return [make() for make in makers[:views]]
+
+def load_views(source, views=TTA_VIEWS):
+    # Масив (views, 3, 224, 224) для PIL-зображень; інші джерела — як у load_image
+    if isinstance(source, Image.Image) and views > 1:
+        return np.concatenate([preprocess(view) for view in augment_views(source, views)])
+    return load_image(source)
+
+def embed_images(images):
+    # Пакетне обчислення L2-нормалізованих ознак для будь-яких джерел, які приймає load_image.
+    # Бекенд (torch або onnx) створюється ліниво при першому виклику (див. model_manager)
+    batch = np.concatenate([load_image(img) for img in images])
+    return model_manager.get_backend().embed(batch)
+
+_index = None
+_index_folder = None
+_scorer = None
+_ann = None
+_router = None
+_head = None
+_index_version = None
+_index_checked_at = 0.0
+_index_lock = threading.Lock()
+
+def index_file(index_path=INDEX_PATH):
+    # Файл індексу для активного режиму моделі (int8 має власні ембедінги)
+    return tagged_index_path(index_path, model_manager.embedding_tag())
+
+def get_index(reference_folder, index_path=INDEX_PATH):
+    # Індекс будується/оновлюється один раз на процес, далі береться з пам'яті (memmap файлу).
+    # Якщо файл замінили (інший процес оновив галерею), він перевідкривається без сканування папки
+    global _index_checked_at
+    with _index_lock:
+        if _index is None or _index_folder != reference_folder:
+            index = load_or_build_index(
+                reference_folder, embed_images, index_file(index_path),
+                model_manager.embedding_model_id(), model_manager.embedding_dim(),
+            )
+            _install_index(reference_folder, index, model_manager.embedding_tag())
+        elif time.monotonic() - _index_checked_at >= INDEX_RELOAD_INTERVAL:
+            _index_checked_at = time.monotonic()
+            if _index.is_stale():
+                try:
+                    index = EmbeddingIndex.load(_index.source[0])
+                except (OSError, ValueError) as e:
+                    print(f"⚠️ Не вдалося перевідкрити індекс: {e}")
+                else:
+                    _install_index(reference_folder, index, model_manager.embedding_tag())
+                    print(f"📦 Індекс перевідкрито: {len(index)} зображень")
+        return _index
+
+def index_version(reference_folder):
+    # Відбиток поточної галереї — щоб кешовані результати перераховувались після її оновлення
+    get_index(reference_folder)
+    return _index_version
+
+def _install_index(reference_folder, index, tag, load_head_file=True):
+    global _index, _index_folder, _scorer, _ann, _router, _head, _index_version
+    _index = index
+    _index_version = index.fingerprint()
+    _index_folder = reference_folder
+    _scorer = LabelScorer(index, top_k=SCORE_TOP_K)
+    _router = CategoryRouter(_scorer, ALWAYS_SCORE_CATEGORIES) if CATEGORY_TOP_K > 0 else None
+    _head = load_head(tagged_index_path(HEAD_PATH, tag), index) if CLASSIFIER_HEAD and load_head_file else None
+    _ann = None
+    if ANN_INDEX != "exact" and len(index):
+        _ann = load_or_build_ann(
+            tagged_index_path(ANN_PATH, tag), ANN_INDEX, index.embeddings, ANN_LISTS, ANN_PROBE, index.fingerprint()
+        )
+
+def load_head(head_path, index):
+    # Голова, навчена на іншій версії галереї, не використовується — до перенавчання працює пошук схожості
+    from classifier_head import ClassifierHead
+
+    try:
+        head = ClassifierHead.load(head_path)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"⚠️ Голову класифікатора не завантажено ({head_path}): {e}")
+        return None
+    if not head.matches(index):
+        print(f"⚠️ Голова класифікатора {head_path} навчена на іншій версії галереї — перенавчіть: python classifier_head.py")
+        return None
+    print(f"✅ Голова класифікатора: {head.kind}, {len(head.label_names)} міток")
+    return head
+
+def abstain_threshold(category):
+    # Мінімальна оцінка, з якою результат показується як розпізнаний
+    if _head is not None:
+        return _head.threshold(category)
+    return MIN_SIMILARITY
+
+def score_name():
+    # Голова повертає калібровану ймовірність, а не косинусну схожість
+    return "Впевненість" if _head is not None else "Схожість"
+
+def is_dangerous(category):
+    # category — категорія з ранжування (назва папки галереї), а не назва категорії з каталогу
+    return category in ALWAYS_SCORE_CATEGORIES
+
+def set_index(reference_folder, index, hash_filter=None, head=None, load_head_file=True):
+    # Готовий індекс ззовні (наприклад, уже відкритий файл у процесі-воркері, див. worker_pool).
+    # hash_filter і head — узгоджені з цим індексом таблиця хешів і голова (напр. для фолдів у evaluate);
+    # load_head_file=False — не читати голову з HEAD_PATH (вона навчена на іншій галереї, ніж фолд)
+    global _hash_filter, _hash_filter_version, _head
+    with _index_lock:
+        _install_index(reference_folder, index, model_manager.embedding_tag(), load_head_file)
+        if hash_filter is not None:
+            _hash_filter, _hash_filter_version = hash_filter, _index_version
+        if head is not None:
+            _head = head
+
+_hash_filter = None
+_hash_filter_version = None
+_hash_filter_failed = False
+
+def get_hash_filter(reference_folder):
+    # Таблиця перцептивних хешів; None, якщо обидва режими вимкнено або imagehash не встановлено.
+    # Після оновлення галереї (новий відбиток індексу) таблиця теж оновлюється
+    global _hash_filter, _hash_filter_version, _hash_filter_failed
+    if not (PHASH_DUPLICATES or PHASH_PREFILTER) or _hash_filter_failed:
+        return None
+    version = index_version(reference_folder)
+    if _hash_filter is None or _hash_filter_version != version:
+        try:
+            from image_matcher import get_hash_index
+            _hash_filter = get_hash_index(reference_folder, refresh=_hash_filter is not None)
+            _hash_filter_version = version
+        except Exception as e:
+            _hash_filter_failed = True
+            print(f"⚠️ Префільтр перцептивних хешів вимкнено: {e}")
+    return _hash_filter
+
+def get_scorer(reference_folder):
+    get_index(reference_folder)
+    return _scorer
+
+def warm_up(reference_folder):
+    # Завантажує модель і індекс заздалегідь, щоб перше фото не чекало
+    model_manager.get_backend()
+    get_index(reference_folder)
+    if TTA_VIEWS > 1:
+        print(f"🔍 TTA: {TTA_VIEWS} ракурсів на фото, злиття оцінок — {TTA_FUSION}")
+    if get_hash_filter(reference_folder) is not None:
+        # Перший phash підтягує scipy — нехай це станеться тут, а не на першому фото
+        from image_matcher import hash_signature
+        hash_signature(Image.new("RGB", (64, 64)))
+
+def is_ready():
+    return model_manager.is_ready() and _scorer is not None
 
 def load_weapons_db(json_path):
-    with open(json_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    # Каталог читається один раз і перечитується лише при зміні файлу (див. weapons_catalog)
+    return get_catalog(json_path)
 
 def collect_image_folders(root_path):
     folders = []
@@ -35,45 +276,80 @@ def collect_image_folders(root_path):
                 folders.append(path)
     return folders
 
-def recognize_weapon(test_image_path, reference_folder, db_path):
-    weapons_db = load_weapons_db(db_path)
-
-    # Витягуємо ознаки тестового зображення
-    test_image = load_image(test_image_path)
-    with torch.no_grad():
-        test_features = model(test_image)
-
-    best_match = None
-    best_similarity = -1
-    match_info = None
-
-    for model_path in collect_image_folders(reference_folder):
-        model_name = model_path.name
-        similarities = []
-
-        for image_path in model_path.glob("*"):
-            if image_path.suffix.lower() not in [".jpg", ".jpeg", ".png"]:
-                continue
-
-            try:
-                ref_image = load_image(str(image_path))
-                with torch.no_grad():
-                    ref_features = model(ref_image)
-                similarity = torch.nn.functional.cosine_similarity(test_features, ref_features).item()
-                similarities.append(similarity)
-            except Exception as e:
-                print(f"⚠️ Помилка обробки {image_path}: {e}")
-
-        if similarities:
-            avg_similarity = sum(similarities) / len(similarities)
-            if avg_similarity > best_similarity:
-                best_similarity = avg_similarity
-                best_match = model_name
-                match_info = next((item for item in weapons_db if item["label"] == model_name), None)
-
-    if best_similarity < 0.7:
+def get_router(reference_folder):
+    # Центроїди для ієрархічного пошуку; будуються на вимогу, якщо CATEGORY_TOP_K=0 (напр. для бенчмарку)
+    global _router
+    get_index(reference_folder)
+    if _router is None:
+        _router = CategoryRouter(_scorer, ALWAYS_SCORE_CATEGORIES)
+    return _router
+
+def rank_embeddings(features, reference_folder, top_n=TOP_N, method=SCORE_AGGREGATION, shortlists=None, view_counts=None,
+                    category_top_k=CATEGORY_TOP_K):
+    # shortlists — для кожного запиту список (категорія, мітка) з префільтра або None;
+    # view_counts — скільки рядків features (ракурсів) належить кожному запиту, None — по одному;
+    # category_top_k — скільки категорій оцінювати точно (0 — усі, плоский пошук)
+    scorer = get_scorer(reference_folder)
+    if view_counts is None:
+        view_counts = [1] * len(features)
+    head = _head
+    if head is not None:
+        # Голова — одне множення на матрицю міток, тож ANN/категорії/префільтр тут не потрібні
+        probs = fuse_views(head.predict(features), view_counts, TTA_FUSION)
+        return [scorer.rank_scores(row, top_n) for row in probs]
+    router = get_router(reference_folder) if category_top_k > 0 else None
+    if _ann is None and router is None and not any(shortlists or []):
+        # Повний перебір: одне матричне множення для всього пакета
+        scores = scorer.score(features, method)
+        if len(scores) != len(view_counts):
+            scores = fuse_views(scores, view_counts, TTA_FUSION)
+        return [scorer.rank_scores(row, top_n) for row in scores]
+
+    rankings = []
+    starts = np.cumsum(view_counts) - view_counts
+    for i, (start, count) in enumerate(zip(starts, view_counts)):
+        views = features[start:start + count]
+        query = views.mean(axis=0)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        label_ids = None
+        if _ann is not None:
+            # ANN: беремо найближчі еталони, а мітки-кандидати оцінюємо точно по всіх їхніх зображеннях
+            ids, _ = _ann.search(query, ANN_CANDIDATES)
+            label_ids = np.unique(scorer.ref_labels[ids])
+        if router is not None:
+            routed = router.route(query, category_top_k)
+            if label_ids is not None:
+                # Кандидати ANN лише з вибраних категорій; небезпечні категорії — завжди повністю
+                narrowed = np.union1d(np.intersect1d(label_ids, routed), router.always_labels)
+                routed = narrowed if len(narrowed) else routed
+            label_ids = routed
+        shortlist = shortlists[i] if shortlists else None
+        if shortlist:
+            allowed = np.asarray([scorer.label_lookup[key] for key in shortlist if key in scorer.label_lookup], dtype=np.int64)
+            if len(allowed):
+                narrowed = allowed if label_ids is None else np.intersect1d(label_ids, allowed)
+                label_ids = narrowed if len(narrowed) else allowed
+        if label_ids is None:
+            scores = fuse_views(scorer.score(views, method), [count], TTA_FUSION)[0]
+            rankings.append(scorer.rank_scores(scores, top_n))
+        else:
+            scores = np.stack([scorer.score_labels(view, label_ids, method) for view in views])
+            rankings.append(scorer.rank_scores(fuse_views(scores, [count], TTA_FUSION)[0], top_n, label_ids))
+    return rankings
+
+def rank_weapon(test_image, reference_folder, top_n=TOP_N, method=SCORE_AGGREGATION):
+    # Один прохід моделі + одне матричне множення → відсортований top-N міток
+    test_features = embed_images([test_image])
+    return rank_embeddings(test_features, reference_folder, top_n, method)[0]
+
+def format_result(ranking, catalog):
+    best_match, best_category, best_similarity = ranking[0] if ranking else (None, None, -1)
+    match_info = catalog.get(best_match)
+    score = score_name()
+
+    if best_similarity < abstain_threshold(best_category):
         return (
-            f"⚠️ Ймовірність розпізнавання низька (схожість: {best_similarity:.2f}).\n"
+            f"⚠️ Ймовірність розпізнавання низька ({score.lower()}: {best_similarity:.2f}).\n"
             f"Об’єкт не схожий на відомі зразки зброї або боєприпасів.\n"
             f"Будьте обережні!"
         )
@@ -85,13 +361,75 @@ def recognize_weapon(test_image_path, reference_folder, db_path):
         output += f"📌 Тип: {match_info['type']} ({match_info['category']})\n"
         output += f"🏳️ Країна: {match_info['country']}\n"
         output += f"🔫 Калібр: {match_info['caliber']}\n"
-        output += f"📏 Схожість: {best_similarity:.4f}\n"
+        output += f"📏 {score}: {best_similarity:.4f}\n"
 
-        if match_info["category"] in ["гранати", "міни"] and best_similarity > 0.8:
+        # З головою відповідь уже пройшла калібрований поріг своєї категорії (abstain_threshold),
+        # тож попередження показується для кожної розпізнаної небезпечної категорії — окремого порогу немає
+        if is_dangerous(best_category) and (_head is not None or best_similarity > DANGER_SIMILARITY):
             output += "⚠️ Увага! Може бути вибухонебезпечним об’єктом."
     elif best_match:
-        output += f"✅ Найбільш схожа модель: {best_match}\n📏 Схожість: {best_similarity:.4f}"
+        output += f"✅ Найбільш схожа модель: {best_match}\n📏 {score}: {best_similarity:.4f}"
     else:
         output = "❌ Жодного збігу не знайдено."
 
+    # Альтернативні варіанти, щоб користувач міг порівняти сам
+    alternatives = ranking[1:]
+    if alternatives:
+        output = output.rstrip("\n") + "\n\n🔎 Інші можливі варіанти:"
+        for label, _, similarity in alternatives:
+            info = catalog.get(label)
+            name = info["name_ua"] if info else label
+            output += f"\n• {name} — {similarity:.4f}"
+
     return output
+
+def recognize_weapon(test_image, reference_folder, db_path):
+    result = recognize_batch([test_image], reference_folder, db_path)[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def recognize_batch(test_images, reference_folder, db_path, top_n=TOP_N, method=SCORE_AGGREGATION, with_ranking=False, views=TTA_VIEWS):
+    # Пакетна версія recognize_weapon: усі зображення проходять через модель одним тензором.
+    # Для зображень, які не вдалося відкрити, повертається виняток на їхній позиції.
+    # with_ranking=True — замість тексту (текст, [(мітка, категорія, схожість), ...], ембедінги ракурсів або None)
+    # для журналу і кешу результатів
+    catalog = load_weapons_db(db_path)
+    hashes = get_hash_filter(reference_folder)
+
+    results = [None] * len(test_images)
+    tensors = []
+    positions = []
+    shortlists = []
+    for i, source in enumerate(test_images):
+        try:
+            image = open_image(source)
+            shortlist = None
+            if hashes is not None and isinstance(image, Image.Image):
+                duplicate, shortlist, _ = hashes.lookup(image, PHASH_RADIUS, PHASH_SHORTLIST, PHASH_DUPLICATE_DISTANCE)
+                if duplicate is not None and PHASH_DUPLICATES:
+                    # Точна копія еталонного фото — CNN не потрібна
+                    category, label = duplicate
+                    ranking = [(label, category, 1.0)]
+                    results[i] = _result(ranking, catalog, with_ranking, None)
+                    continue
+                if not PHASH_PREFILTER:
+                    shortlist = None
+            tensors.append(load_views(image, views))
+            positions.append(i)
+            shortlists.append(shortlist)
+        except Exception as e:
+            results[i] = e
+
+    if tensors:
+        view_counts = [len(tensor) for tensor in tensors]
+        features = embed_images(tensors)
+        rankings = rank_embeddings(features, reference_folder, top_n, method, shortlists, view_counts)
+        starts = np.cumsum(view_counts) - view_counts
+        for i, ranking, start, count in zip(positions, rankings, starts, view_counts):
+            results[i] = _result(ranking, catalog, with_ranking, features[start:start + count])
+    return results
+
+def _result(ranking, catalog, with_ranking, features):
+    text = format_result(ranking, catalog)
+    return (text, ranking, features) if with_ranking else text
@@ -0,0 +1,319 @@
+import os
+import sys
+import json
+import struct
+import hashlib
+import argparse
+from pathlib import Path
+import numpy as np
+
+# Індекс ембедінгів еталонних зображень: один L2-нормалізований вектор на файл
+# + метадані (шлях, мітка, категорія, mtime, розмір) для інкрементального оновлення.
+# Формат файлу: заголовок (magic, версія, тип, N, D, довжина метаданих), JSON-метадані,
+# матриця ембедінгів і зміщення сегментів міток, вирівняні по 64 байти. Матриця відкривається
+# через numpy.memmap — процеси бота і воркери ділять одні сторінки page cache без копіювання,
+# а оновлення галереї — це атомарна заміна файлу (os.replace).
+# У метаданих — model_id (ідентичність ваг моделі, див. model_manager.embedding_model_id): індекс,
+# порахований іншими вагами або з іншою розмірністю ознак, не доповнюється, а перебудовується повністю.
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+DEFAULT_INDEX_PATH = "weapon_index.emb"
+INDEX_MAGIC = b"WEMBIDX\0"
+INDEX_VERSION = 2
+INDEX_HEADER = struct.Struct("<8sIIQQQ")
+INDEX_ALIGN = 64
+INDEX_DTYPES = {"float32": 4, "float16": 2}
+# float16 удвічі зменшує файл і пам'ять, ціною перетворення типу при кожному множенні
+INDEX_DTYPE = os.environ.get("INDEX_DTYPE", "float32")
+EMBED_CHUNK_SIZE = 32
+
+
+def tagged_index_path(index_path, tag):
+    # weapon_index.emb + "int8" → weapon_index.int8.emb
+    if not tag:
+        return index_path
+    root, ext = os.path.splitext(index_path)
+    return f"{root}.{tag}{ext}"
+
+
+def scan_reference_images(root_path):
+    root = Path(root_path)
+    entries = []
+    for path in root.rglob('*'):
+        if not path.is_file() or path.suffix.lower() not in IMAGE_EXTENSIONS:
+            continue
+        parts = path.relative_to(root).parts
+        if len(parts) < 2:
+            continue
+        stat = path.stat()
+        entries.append({
+            "path": str(path),
+            "label": parts[-2],
+            "category": parts[-3] if len(parts) >= 3 else "",
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+        })
+    # Сортуємо так, щоб зображення однієї мітки йшли підряд (суцільні сегменти)
+    entries.sort(key=lambda e: (e["category"], e["label"], e["path"]))
+    return entries
+
+
+class EmbeddingIndex:
+    def __init__(self, embeddings, paths, labels, categories, mtimes, sizes, label_offsets=None, model_id=""):
+        # float16/float32 (у т.ч. memmap) лишаються як є, решта приводиться до float32
+        embeddings = np.asarray(embeddings)
+        if embeddings.dtype not in (np.float16, np.float32) or not embeddings.flags.c_contiguous:
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.embeddings = embeddings
+        self.paths = list(paths)
+        self.labels = list(labels)
+        self.categories = list(categories)
+        self.mtimes = np.asarray(mtimes, dtype=np.float64)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.model_id = model_id
+        self.source = None
+        self._build_segments(label_offsets)
+
+    def _build_segments(self, offsets=None):
+        # Межі сегментів: label_offsets[i] — індекс першого зображення мітки i
+        if offsets is None:
+            offsets = []
+            previous = None
+            for i, key in enumerate(zip(self.categories, self.labels)):
+                if key != previous:
+                    offsets.append(i)
+                    previous = key
+        self.label_offsets = np.asarray(offsets, dtype=np.int64)
+        self.label_names = [self.labels[i] for i in self.label_offsets]
+        self.label_categories = [self.categories[i] for i in self.label_offsets]
+        self.label_counts = np.diff(np.append(self.label_offsets, len(self.labels)))
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def dim(self):
+        return self.embeddings.shape[1] if self.embeddings.ndim == 2 else 0
+
+    def segments(self):
+        for name, start, count in zip(self.label_names, self.label_offsets, self.label_counts):
+            yield name, int(start), int(start + count)
+
+    def fingerprint(self):
+        # Відбиток вмісту галереї — для перевірки, чи похідні індекси (ANN тощо) ще актуальні
+        digest = hashlib.sha1()
+        for path, mtime, size in zip(self.paths, self.mtimes, self.sizes):
+            digest.update(f"{path}|{mtime!r}|{size}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    def save(self, index_path, dtype=None):
+        dtype = dtype or INDEX_DTYPE
+        if dtype not in INDEX_DTYPES:
+            raise ValueError(f"Непідтримуваний тип ембедінгів: {dtype}")
+        meta = json.dumps({
+            "paths": self.paths,
+            "labels": self.labels,
+            "categories": self.categories,
+            "mtimes": self.mtimes.tolist(),
+            "sizes": self.sizes.tolist(),
+            "model_id": self.model_id,
+        }, ensure_ascii=False).encode("utf-8")
+        n, d = len(self), self.dim
+        header = INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, INDEX_DTYPES[dtype], n, d, len(meta))
+        embeddings_at = _aligned(INDEX_HEADER.size + len(meta))
+        offsets_at = _aligned(embeddings_at + n * d * INDEX_DTYPES[dtype])
+
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header + meta)
+            f.seek(embeddings_at)
+            f.write(np.ascontiguousarray(self.embeddings, dtype=dtype).tobytes())
+            f.seek(offsets_at)
+            f.write(self.label_offsets.astype("<i8").tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path):
+        # Читаються лише заголовок і метадані; матриця — memmap, сторінки підвантажує ОС
+        with open(index_path, "rb") as f:
+            head = f.read(INDEX_HEADER.size)
+            if len(head) < INDEX_HEADER.size:
+                raise ValueError("Файл індексу пошкоджено")
+            magic, version, itemsize, n, d, meta_size = INDEX_HEADER.unpack(head)
+            if magic != INDEX_MAGIC:
+                raise ValueError("Невідомий формат файлу індексу")
+            if version != INDEX_VERSION:
+                raise ValueError(f"Непідтримувана версія індексу: {version}")
+            meta = json.loads(f.read(meta_size).decode("utf-8"))
+            stat = os.fstat(f.fileno())
+        dtype = {size: name for name, size in INDEX_DTYPES.items()}[itemsize]
+        embeddings_at = _aligned(INDEX_HEADER.size + meta_size)
+        offsets_at = _aligned(embeddings_at + n * d * itemsize)
+        labels = len(set(zip(meta["categories"], meta["labels"])))
+        if n and d:
+            embeddings = np.memmap(index_path, dtype=dtype, mode="r", offset=embeddings_at, shape=(n, d))
+        else:
+            embeddings = np.zeros((n, d), dtype=dtype)
+        if labels:
+            offsets = np.memmap(index_path, dtype="<i8", mode="r", offset=offsets_at, shape=(labels,))
+        else:
+            offsets = np.zeros(0, dtype=np.int64)
+        index = cls(
+            embeddings, meta["paths"], meta["labels"], meta["categories"], meta["mtimes"], meta["sizes"],
+            label_offsets=offsets, model_id=meta.get("model_id", ""),
+        )
+        index.source = (index_path, stat.st_ino, stat.st_mtime_ns)
+        return index
+
+    def is_stale(self):
+        # Чи замінили файл, з якого відкрито індекс (новий inode або mtime після os.replace)
+        if self.source is None:
+            return False
+        path, inode, mtime_ns = self.source
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return (stat.st_ino, stat.st_mtime_ns) != (inode, mtime_ns)
+
+
+def _aligned(position):
+    return -(-position // INDEX_ALIGN) * INDEX_ALIGN
+
+
+def _embed_entries(entries, embed_fn):
+    vectors = []
+    kept = []
+    for start in range(0, len(entries), EMBED_CHUNK_SIZE):
+        chunk = entries[start:start + EMBED_CHUNK_SIZE]
+        try:
+            vectors.append(np.asarray(embed_fn([e["path"] for e in chunk]), dtype=np.float32))
+            kept.extend(chunk)
+            continue
+        except Exception:
+            pass
+        # Якщо пакет не вдався — обробляємо поштучно, щоб пропустити лише зіпсовані файли
+        for entry in chunk:
+            try:
+                vectors.append(np.asarray(embed_fn([entry["path"]]), dtype=np.float32))
+                kept.append(entry)
+            except Exception as e:
+                print(f"⚠️ Помилка обробки {entry['path']}: {e}")
+    return kept, vectors
+
+
+def build_index(reference_folder, embed_fn, previous=None, model_id="", dim=0):
+    # model_id і dim — ваги й розмірність ознак поточної моделі; якщо попередній індекс порахований
+    # іншими, його ембедінги непридатні (порожній model_id — ідентичність невідома, не перевіряється)
+    if previous is not None and len(previous):
+        reason = None
+        if model_id and previous.model_id != model_id:
+            reason = f"інші ваги моделі ({previous.model_id or 'невідомі'} → {model_id})"
+        elif dim and previous.dim != dim:
+            reason = f"інша розмірність ознак ({previous.dim} → {dim})"
+        if reason:
+            print(f"⚠️ Індекс порахований для іншої моделі: {reason}. Перебудовуємо.")
+            previous = None
+    if not model_id and previous is not None:
+        model_id = previous.model_id
+    entries = scan_reference_images(reference_folder)
+    known = {}
+    if previous is not None:
+        known = {path: i for i, path in enumerate(previous.paths)}
+
+    reused = {}
+    to_embed = []
+    added = 0
+    for entry in entries:
+        i = known.get(entry["path"])
+        if i is not None and previous.mtimes[i] == entry["mtime"] and previous.sizes[i] == entry["size"]:
+            reused[entry["path"]] = previous.embeddings[i]
+        else:
+            to_embed.append(entry)
+            added += i is None
+
+    embedded_entries, vectors = _embed_entries(to_embed, embed_fn)
+    fresh = {}
+    if vectors:
+        for entry, vector in zip(embedded_entries, np.concatenate(vectors)):
+            fresh[entry["path"]] = vector
+    current_paths = {e["path"] for e in entries}
+    removed = sum(1 for path in known if path not in current_paths)
+
+    rows = [e for e in entries if e["path"] in reused or e["path"] in fresh]
+    dim = previous.dim if previous is not None and len(previous) else 0
+    if rows:
+        matrix = np.stack([reused.get(e["path"], fresh.get(e["path"])) for e in rows])
+    else:
+        matrix = np.zeros((0, dim), dtype=np.float32)
+
+    index = EmbeddingIndex(
+        matrix,
+        [e["path"] for e in rows],
+        [e["label"] for e in rows],
+        [e["category"] for e in rows],
+        [e["mtime"] for e in rows],
+        [e["size"] for e in rows],
+        model_id=model_id,
+    )
+    changed = bool(fresh) or removed > 0 or previous is None or previous.model_id != model_id
+    stats = {
+        "total": len(rows), "embedded": len(fresh), "reused": len(reused), "removed": removed,
+        "added": added, "changed": len(to_embed) - added, "failed": len(to_embed) - len(fresh),
+    }
+    return index, changed, stats
+
+
+def load_or_build_index(reference_folder, embed_fn, index_path=DEFAULT_INDEX_PATH, model_id="", dim=0):
+    index, stats = update_index(reference_folder, embed_fn, index_path, model_id, dim)
+    print(
+        f"📦 Індекс: {stats['total']} зображень, {len(index.label_names)} моделей "
+        f"(нових/змінених: {stats['embedded']}, видалених: {stats['removed']})"
+    )
+    return index
+
+
+def update_index(reference_folder, embed_fn, index_path=DEFAULT_INDEX_PATH, model_id="", dim=0):
+    # Перераховує лише нові/змінені зображення і атомарно замінює файл, якщо щось змінилось.
+    # Повертає (індекс, статистика build_index)
+    previous = None
+    if os.path.exists(index_path):
+        try:
+            previous = EmbeddingIndex.load(index_path)
+        except Exception as e:
+            print(f"⚠️ Не вдалося прочитати індекс {index_path}: {e}. Перебудовуємо.")
+
+    index, changed, stats = build_index(reference_folder, embed_fn, previous, model_id, dim)
+    if changed:
+        index.save(index_path)
+        # Далі працюємо з memmap щойно записаного файлу, а не з копією в пам'яті процесу
+        index = EmbeddingIndex.load(index_path)
+    else:
+        index = previous
+    return index, stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Побудова індексу ембедінгів еталонних зображень")
+    parser.add_argument("--images", default="weapon_images", help="Папка з еталонними зображеннями")
+    parser.add_argument("--index", default=DEFAULT_INDEX_PATH, help="Файл індексу")
+    parser.add_argument("--rebuild", action="store_true", help="Перебудувати індекс повністю")
+    args = parser.parse_args(argv)
+
+    import model_manager
+    from clip_recognizer import embed_images
+
+    args.index = tagged_index_path(args.index, model_manager.embedding_tag())
+    if args.rebuild and os.path.exists(args.index):
+        os.remove(args.index)
+    index = load_or_build_index(
+        args.images, embed_images, args.index, model_manager.embedding_model_id(), model_manager.embedding_dim()
+    )
+    summary = {"images": len(index), "labels": len(index.label_names), "dim": index.dim}
+    print(json.dumps(summary, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+import clip_recognizer
+from benchmark import percentiles
+from embedding_index import EmbeddingIndex
+
+# Офлайн-оцінка точності та швидкості розпізнавачів на галереї weapon_images:
+# k-fold (або leave-one-out) — відкладене фото проходить повний шлях розпізнавача, а галерея фолду
+# складається з решти еталонів (ембедінги й хеші беруться з кешу, модель для галереї не проганяється).
+#   recognize_weapon — конвеєр бота (хеші + CNN + оцінювання; голова/ієрархія/TTA — за налаштуваннями);
+#   image_matcher    — лише перцептивні хеші (find_closest_match).
+# Варіанти (інший бекенд, голова, ієрархічний пошук ...) запускаються окремими процесами з іншим
+# оточенням, тож їхні результати стоять поруч в одному звіті:
+#   python evaluate.py --variant onnx:INFERENCE_BACKEND=onnx --variant head:CLASSIFIER_HEAD=1
+METHODS = ("recognize_weapon", "image_matcher")
+TOP_N = 5
+
+
+def stratified_folds(labels, folds):
+    # folds=0 — leave-one-out; інакше фото кожної мітки розкладаються по фолдах по черзі
+    if folds <= 0:
+        return np.arange(len(labels)), len(labels)
+    from classifier_head import stratified_folds as assign
+
+    return assign(labels, folds), folds
+
+
+def subset_index(index, keep):
+    keep = np.flatnonzero(keep)
+    return EmbeddingIndex(
+        index.embeddings[keep], [index.paths[i] for i in keep], [index.labels[i] for i in keep],
+        [index.categories[i] for i in keep], index.mtimes[keep], index.sizes[keep], model_id=index.model_id,
+    )
+
+
+def subset_hashes(hashes, paths):
+    from image_matcher import HashIndex
+
+    position = {path: i for i, path in enumerate(hashes.paths)}
+    rows = [position[path] for path in paths if path in position]
+    return HashIndex(
+        hashes.signatures[rows], [hashes.paths[i] for i in rows], [hashes.labels[i] for i in rows],
+        [hashes.categories[i] for i in rows], hashes.mtimes[rows], hashes.sizes[rows],
+    )
+
+
+def evaluate(reference_folder, db_path, methods=METHODS, folds=5, limit=0):
+    # Повертає {метод: звіт}; фото без жодного еталона своєї мітки у фолді не оцінюються
+    clip_recognizer.warm_up(reference_folder)
+    full = clip_recognizer.get_index(reference_folder)
+    if len(full):
+        # Перший прогін (модель, хеші, каталог) повільніший — робимо його до замірів
+        clip_recognizer.recognize_batch([full.paths[0]], reference_folder, db_path)
+    hashes = clip_recognizer.get_hash_filter(reference_folder)
+    if "image_matcher" in methods:
+        from image_matcher import get_hash_index, rank_hash_labels
+        hashes = get_hash_index(reference_folder)
+    head_kind = None
+    if clip_recognizer.CLASSIFIER_HEAD:
+        from classifier_head import HEAD_KIND
+        head_kind = HEAD_KIND
+    label_ids = np.repeat(np.arange(len(full.label_counts)), full.label_counts)
+    assignment, n_folds = stratified_folds(label_ids, folds)
+    queries = np.arange(len(full))
+    if limit and len(queries) > limit:
+        queries = np.sort(np.random.default_rng(0).choice(queries, limit, replace=False))
+
+    outcomes = {method: [] for method in methods}
+    for fold in range(n_folds):
+        held = queries[assignment[queries] == fold]
+        if not len(held):
+            continue
+        keep = assignment != fold
+        fold_index = subset_index(full, keep)
+        fold_hashes = subset_hashes(hashes, fold_index.paths) if hashes is not None else None
+        head = None
+        if head_kind and len(fold_index) > 1:
+            # Голова навчається лише на галереї фолду, інакше відкладені фото «підглядали» б у навчання
+            from classifier_head import train_head
+            head, _ = train_head(fold_index, head_kind)
+        # Голова з файлу навчена на всій галереї — для фолду лише власна (або жодної)
+        clip_recognizer.set_index(reference_folder, fold_index, fold_hashes, head, load_head_file=False)
+        known = set(zip(fold_index.categories, fold_index.labels))
+        for i in held:
+            path, truth = full.paths[i], (full.categories[i], full.labels[i])
+            if truth not in known:
+                for method in methods:
+                    outcomes[method].append((truth, None, None, False))
+                continue
+            if "recognize_weapon" in methods:
+                started = time.perf_counter()
+                result = clip_recognizer.recognize_batch([path], reference_folder, db_path, top_n=TOP_N, with_ranking=True)[0]
+                elapsed = (time.perf_counter() - started) * 1000
+                ranking = [] if isinstance(result, Exception) else result[1]
+                abstained = not ranking or ranking[0][2] < clip_recognizer.abstain_threshold(ranking[0][1])
+                outcomes["recognize_weapon"].append((truth, ranking, elapsed, abstained))
+            if "image_matcher" in methods:
+                started = time.perf_counter()
+                ranking = rank_hash_labels(path, fold_hashes, TOP_N)
+                elapsed = (time.perf_counter() - started) * 1000
+                outcomes["image_matcher"].append((truth, ranking, elapsed, False))
+        print(f"📊 Фолд {fold + 1}/{n_folds}: {len(held)} фото", file=sys.stderr, flush=True)
+    # Повертаємо повний індекс, щоб процес лишився в робочому стані
+    clip_recognizer.set_index(reference_folder, full, hashes)
+    return {method: summarize(items) for method, items in outcomes.items()}
+
+
+def summarize(items):
+    evaluated = [(truth, ranking, elapsed, abstained) for truth, ranking, elapsed, abstained in items if ranking is not None]
+    n = max(len(evaluated), 1)
+    top1 = top5 = abstained_count = 0
+    per_category = {}
+    category_confusion = {}
+    label_confusion = {}
+    for (category, label), ranking, _, abstained in evaluated:
+        predicted = [(c, l) for l, c, _ in ranking]
+        best = predicted[0] if predicted else (None, None)
+        hit = best == (category, label)
+        top1 += hit
+        top5 += (category, label) in predicted[:5]
+        abstained_count += abstained
+        stats = per_category.setdefault(category, {"n": 0, "label_recall": 0, "category_recall": 0})
+        stats["n"] += 1
+        stats["label_recall"] += hit
+        stats["category_recall"] += best[0] == category
+        row = category_confusion.setdefault(category, {})
+        row[str(best[0])] = row.get(str(best[0]), 0) + 1
+        if not hit:
+            key = f"{label} → {best[1]}"
+            label_confusion[key] = label_confusion.get(key, 0) + 1
+    for stats in per_category.values():
+        stats["label_recall"] = round(stats["label_recall"] / stats["n"], 4)
+        stats["category_recall"] = round(stats["category_recall"] / stats["n"], 4)
+    return {
+        "queries": len(evaluated),
+        "no_reference": len(items) - len(evaluated),
+        "top1": round(top1 / n, 4),
+        "top5": round(top5 / n, 4),
+        "abstain_rate": round(abstained_count / n, 4),
+        "per_category": dict(sorted(per_category.items())),
+        "dangerous": {
+            category: per_category[category]
+            for category in clip_recognizer.ALWAYS_SCORE_CATEGORIES if category in per_category
+        },
+        "category_confusion": dict(sorted(category_confusion.items())),
+        "top_confusions": dict(sorted(label_confusion.items(), key=lambda item: -item[1])[:10]),
+        "latency": percentiles([elapsed for _, _, elapsed, _ in evaluated]),
+    }
+
+
+def describe_config():
+    import model_manager
+
+    backend = model_manager.get_backend()
+    return {
+        "backend": backend.name,
+        "mode": backend.mode,
+        "aggregation": clip_recognizer.SCORE_AGGREGATION,
+        "ann_index": clip_recognizer.ANN_INDEX,
+        "category_top_k": clip_recognizer.CATEGORY_TOP_K,
+        "classifier_head": clip_recognizer.CLASSIFIER_HEAD,
+        "tta_views": clip_recognizer.TTA_VIEWS,
+    }
+
+
+def run_variant(spec, args):
+    # "назва:КЛЮЧ=значення,КЛЮЧ=значення" → звіт recognize_weapon з дочірнього процесу
+    name, _, assignments = spec.partition(":")
+    env = dict(os.environ)
+    for assignment in filter(None, assignments.split(",")):
+        key, _, value = assignment.partition("=")
+        env[key.strip()] = value.strip()
+    command = [
+        sys.executable, os.path.abspath(__file__), "--images", args.images, "--db", args.db,
+        "--folds", str(args.folds), "--limit", str(args.limit), "--methods", "recognize_weapon", "--json",
+    ]
+    completed = subprocess.run(command, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        return {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "помилка"}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def print_table(rows):
+    print(f"{'варіант':<28}{'top1':>7}{'top5':>7}{'міни':>7}{'гранати':>9}{'відмова':>9}{'p50 мс':>9}{'p95 мс':>9}")
+    for name, report in rows:
+        if "error" in report:
+            print(f"{name:<28}  ❌ {report['error']}")
+            continue
+        dangerous = report["dangerous"]
+        mines = dangerous.get("mines", {}).get("label_recall", float("nan"))
+        grenades = dangerous.get("grenades", {}).get("label_recall", float("nan"))
+        latency = report["latency"]
+        print(
+            f"{name:<28}{report['top1']:>7.3f}{report['top5']:>7.3f}{mines:>7.3f}{grenades:>9.3f}"
+            f"{report['abstain_rate']:>9.3f}{latency.get('p50_ms', 0):>9.1f}{latency.get('p95_ms', 0):>9.1f}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-оцінка розпізнавачів: точність, повнота по категоріях, затримка")
+    parser.add_argument("--images", default="weapon_images")
+    parser.add_argument("--db", default="weapons_db.json")
+    parser.add_argument("--folds", type=int, default=5, help="Кількість фолдів (0 — leave-one-out)")
+    parser.add_argument("--limit", type=int, default=0, help="Скільки фото оцінювати (0 — всі)")
+    parser.add_argument("--methods", nargs="+", choices=METHODS, default=list(METHODS))
+    parser.add_argument("--variant", action="append", default=[],
+                        help="Додатковий варіант recognize_weapon: назва:КЛЮЧ=значення,...")
+    parser.add_argument("--output", default="evaluation.json", help="Куди записати JSON-звіт")
+    parser.add_argument("--json", action="store_true", help="Лише JSON у stdout (для дочірніх процесів)")
+    args = parser.parse_args(argv)
+
+    # ANN-індекси фолдів пишуться в тимчасову папку (видаляється після оцінки), а не поверх робочого
+    # weapon_index.ann.npz
+    with tempfile.TemporaryDirectory(prefix="evaluate-") as workdir:
+        clip_recognizer.ANN_PATH = os.path.join(workdir, os.path.basename(clip_recognizer.ANN_PATH))
+        reports = evaluate(args.images, args.db, args.methods, args.folds, args.limit)
+    if args.json:
+        print(json.dumps({**reports["recognize_weapon"], "config": describe_config()}, ensure_ascii=False))
+        return 0
+
+    config = describe_config()
+    rows = [(f"{method} ({config['backend']}/{config['mode']})" if method == "recognize_weapon" else method, report)
+            for method, report in reports.items()]
+    for spec in args.variant:
+        rows.append((spec.partition(":")[0], run_variant(spec, args)))
+    print_table(rows)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"folds": args.folds, "config": config, "results": dict(rows)}, f, ensure_ascii=False, indent=2)
+    print(f"✅ Звіт записано у {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Локальна заміна Telegram для перевірки webhook-режиму без мережі:
+#   api  — заглушка Bot API (getMe, setWebhook, getFile, sendMessage, ...), друкує відповіді бота;
+#   send — надсилає оновлення (текст, команда, фото, локація) на webhook бота з секретним токеном.
+# Запуск:
+#   python fake_telegram.py api --port 8081
+#   TOKEN=123:local TELEGRAM_API_URL=http://127.0.0.1:8081 RUN_MODE=webhook PORT=8443 WEBHOOK_SECRET=s python bot.py
+#   python fake_telegram.py send --secret s photo weapon_images/autogun/ak74/1.jpg
+# Фото передаються як file_id = локальний шлях: getFile повертає цей шлях, і бот читає файл напряму.
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "WeaponID", "username": "weaponid_local_bot"}
+
+
+def _message(chat_id, message_id, **fields):
+    return {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, **fields}
+
+
+class FakeBotApi(BaseHTTPRequestHandler):
+    counter = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("application/json") and body:
+            return json.loads(body)
+        if content_type.startswith("multipart/form-data"):
+            # Документи (/mylog) — вміст не розбираємо, лише адресат і розмір
+            chat_id = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body)
+            return {"chat_id": chat_id.group(1).decode() if chat_id else 0, "multipart_bytes": len(body)}
+        query = urllib.parse.urlsplit(self.path).query
+        fields = urllib.parse.parse_qs(body.decode("utf-8") + ("&" + query if query else ""))
+        return {key: values[-1] for key, values in fields.items()}
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        method = urllib.parse.urlsplit(self.path).path.rstrip("/").rsplit("/", 1)[-1]
+        params = self._params()
+        with FakeBotApi.lock:
+            FakeBotApi.counter += 1
+            message_id = FakeBotApi.counter
+        chat_id = int(params.get("chat_id") or 0)
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getFile":
+            path = params.get("file_id", "")
+            result = {
+                "file_id": path,
+                "file_unique_id": hashlib.sha1(path.encode("utf-8")).hexdigest()[:16],
+                "file_size": os.path.getsize(path) if os.path.exists(path) else 0,
+                "file_path": os.path.abspath(path),
+            }
+        elif method == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        elif method == "sendMessage":
+            print(f"💬 [{chat_id}] {params.get('text')}\n", flush=True)
+            result = _message(chat_id, message_id, text=params.get("text", ""))
+        elif method == "sendDocument":
+            print(f"📄 [{chat_id}] документ ({params.get('multipart_bytes', 0)} байт)", flush=True)
+            result = _message(chat_id, message_id, document={"file_id": "doc", "file_unique_id": "doc"})
+        else:
+            # setWebhook, deleteWebhook, answerCallbackQuery тощо
+            if method == "setWebhook":
+                print(f"🔗 setWebhook: {params.get('url')}", flush=True)
+            result = True
+
+        payload = json.dumps({"ok": True, "result": result}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def make_update(update_id, user_id, kind, value=None):
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    message = _message(user_id, update_id, **{"from": user})
+    if kind == "photo":
+        path = os.path.abspath(value)
+        unique = hashlib.sha1(path.encode("utf-8")).hexdigest()[:16]
+        message["photo"] = [{"file_id": path, "file_unique_id": unique, "width": 640, "height": 480}]
+    elif kind == "location":
+        lat, lon = (float(x) for x in value.split(","))
+        message["location"] = {"latitude": lat, "longitude": lon}
+    else:
+        message["text"] = value
+        if value.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(value.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def send_update(webhook, update, secret=None):
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+    request = urllib.request.Request(webhook, json.dumps(update).encode("utf-8"), headers)
+    started = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return response.status, (time.perf_counter() - started) * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Локальна заміна Telegram для webhook-режиму бота")
+    sub = parser.add_subparsers(dest="command", required=True)
+    api = sub.add_parser("api", help="Заглушка Bot API")
+    api.add_argument("--host", default="127.0.0.1")
+    api.add_argument("--port", type=int, default=8081)
+    send = sub.add_parser("send", help="Надіслати оновлення на webhook")
+    send.add_argument("kind", choices=["text", "photo", "location"])
+    send.add_argument("value", help="Текст/команда, шлях до фото або 'широта,довгота'")
+    send.add_argument("--webhook", default="http://127.0.0.1:8443/telegram")
+    send.add_argument("--secret", default=os.environ.get("WEBHOOK_SECRET"))
+    send.add_argument("--user", type=int, default=1000)
+    send.add_argument("--count", type=int, default=1, help="Скільки оновлень надіслати")
+    send.add_argument("--concurrency", type=int, default=1, help="Скільки одночасно (різні користувачі)")
+    args = parser.parse_args(argv)
+
+    if args.command == "api":
+        server = ThreadingHTTPServer((args.host, args.port), FakeBotApi)
+        print(f"✅ Заглушка Bot API: http://{args.host}:{args.port}", flush=True)
+        server.serve_forever()
+        return 0
+
+    base_id = int(time.time() * 1000) % 10 ** 9
+    updates = [
+        make_update(base_id + i, args.user + (i % args.concurrency), args.kind, args.value)
+        for i in range(args.count)
+    ]
+    with ThreadPoolExecutor(max(1, args.concurrency)) as executor:
+        results = list(executor.map(lambda update: send_update(args.webhook, update, args.secret), updates))
+    for status, elapsed_ms in results:
+        print(json.dumps({"status": status, "ms": round(elapsed_ms, 1)}))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
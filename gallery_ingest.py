@@ -0,0 +1,239 @@
+import os
+import sys
+import re
+import json
+import time
+import argparse
+from pathlib import Path
+
+from embedding_index import IMAGE_EXTENSIONS, DEFAULT_INDEX_PATH, update_index
+from weapons_catalog import DEFAULT_DB_PATH, REQUIRED_FIELDS
+
+# Поповнення галереї без повної перебудови: нова модель — це папка weapon_images/<категорія>/<мітка>/
+# з фото і (необов'язково) info.json із полями запису каталогу (name_ua, type, category, country, caliber).
+# Інструмент знаходить додані, змінені та видалені зображення, перераховує ембедінги лише для них,
+# атомарно замінює файл індексу і оновлює weapons_db.json записами з info.json.
+# Запущений бот підхоплює обидва файли сам (перевірка mtime/inode), без перезапуску.
+# Запуск:
+#   python gallery_ingest.py                 — одноразове оновлення
+#   python gallery_ingest.py --watch         — стежити за папкою і оновлювати при змінах
+#   python gallery_ingest.py --prune-catalog — також прибрати з каталогу записи видалених папок
+INFO_FILE = "info.json"
+# Як часто (с) перевіряти папку в режимі --watch; зміни застосовуються, коли папка не змінювалась цей час
+WATCH_INTERVAL = float(os.environ.get("GALLERY_WATCH_INTERVAL", "5"))
+# Той самий файл індексу, що й у бота (див. clip_recognizer.INDEX_PATH)
+INDEX_PATH = os.environ.get("INDEX_PATH", DEFAULT_INDEX_PATH)
+
+
+def gallery_snapshot(reference_folder):
+    # Дешевий відбиток стану папки (лише stat): чи є що оновлювати
+    snapshot = {}
+    for path in Path(reference_folder).rglob('*'):
+        if path.is_file() and (path.suffix.lower() in IMAGE_EXTENSIONS or path.name == INFO_FILE):
+            stat = path.stat()
+            snapshot[str(path)] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+def read_folder_info(reference_folder):
+    # {мітка: запис каталогу} з усіх info.json; мітка — назва папки
+    entries = {}
+    for info_path in sorted(Path(reference_folder).rglob(INFO_FILE)):
+        label = info_path.parent.name
+        try:
+            with open(info_path, 'r', encoding='utf-8') as f:
+                item = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Не вдалося прочитати {info_path}: {e}")
+            continue
+        if not isinstance(item, dict):
+            print(f"⚠️ {info_path}: очікується JSON-об'єкт")
+            continue
+        item = {"label": label, **{key: value for key, value in item.items() if key != "label"}}
+        missing = [field for field in REQUIRED_FIELDS if not isinstance(item.get(field), str) or not item.get(field)]
+        if missing:
+            print(f"⚠️ {info_path}: бракує полів {', '.join(missing)} — запис пропущено")
+            continue
+        entries[label] = item
+    return entries
+
+
+def _element_spans(text):
+    # [(початок, кінець, запис)] для кожного елемента масиву верхнього рівня — точні межі в тексті файлу
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r"\s*")
+    pos = whitespace.match(text).end()
+    if text[pos:pos + 1] != "[":
+        raise ValueError("каталог має бути JSON-масивом")
+    pos = whitespace.match(text, pos + 1).end()
+    spans = []
+    while text[pos:pos + 1] != "]":
+        item, end = decoder.raw_decode(text, pos)
+        spans.append((pos, end, item))
+        pos = whitespace.match(text, end).end()
+        if text[pos:pos + 1] == ",":
+            pos = whitespace.match(text, pos + 1).end()
+    return spans, pos
+
+
+def _entry_style(text, start, end):
+    # Відступ запису в його рядку і крок відступу полів — щоб нові записи виглядали як сусідні
+    line_start = text.rfind("\n", 0, start) + 1
+    indent = text[line_start:start] if not text[line_start:start].strip() else "  "
+    inner = re.search(r"\n([ \t]*)\S", text[start:end])
+    step = len(inner.group(1)) - len(indent) if inner and len(inner.group(1)) > len(indent) else 2
+    return indent, step
+
+
+def _format_entry(item, indent, step):
+    return json.dumps(item, ensure_ascii=False, indent=step).replace("\n", "\n" + indent)
+
+
+def _runs(indices):
+    # [0, 1, 3] → [(0, 1), (3, 3)]: межі послідовностей сусідніх індексів
+    runs = []
+    for i in indices:
+        if runs and runs[-1][1] == i - 1:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    return [tuple(run) for run in runs]
+
+
+def update_catalog(db_path, folder_info, prune_labels=()):
+    # Записи з info.json додаються або замінюють наявні з тією ж міткою; prune_labels — записи, що
+    # видаляються. Файл ведеться вручну, тож змінюються лише ці записи, решта тексту лишається як є.
+    # Запис — лише якщо щось змінилося; файл замінюється атомарно (бот не прочитає напівзаписаний каталог)
+    with open(db_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    spans, closing = _element_spans(text)
+    positions = {item.get("label"): i for i, (_, _, item) in enumerate(spans)}
+    prune_labels = set(prune_labels)
+    added, updated, removed = [], [], []
+    edits = []
+    pruned = []
+    for i, (start, end, item) in enumerate(spans):
+        label = item.get("label")
+        if label in prune_labels and label not in folder_info:
+            pruned.append(i)
+            removed.append(label)
+        elif label in folder_info and folder_info[label] != item:
+            indent, step = _entry_style(text, start, end)
+            edits.append((start, end, _format_entry(folder_info[label], indent, step)))
+            updated.append(label)
+    for first, last in _runs(pruned):
+        # Підряд видалені записи — одним вирізом разом із комами між ними (окремі вирізи перекривались би)
+        if first:
+            edits.append((spans[first - 1][1], spans[last][1], ""))
+        elif last + 1 < len(spans):
+            edits.append((spans[0][0], spans[last + 1][0], ""))
+        else:
+            edits.append((text.index("[") + 1, closing, ""))
+    dropped = set(pruned)
+    kept = [span for i, span in enumerate(spans) if i not in dropped]
+    new_items = [item for label, item in folder_info.items() if label not in positions]
+    if new_items:
+        if kept:
+            indent, step = _entry_style(text, *kept[-1][:2])
+            insert_at, prefix = kept[-1][1], ","
+        else:
+            indent, step = _entry_style(text, *spans[-1][:2]) if spans else ("  ", 2)
+            insert_at, prefix = closing, ""
+        block = "".join(f"{prefix if n == 0 else ','}\n{indent}{_format_entry(item, indent, step)}" for n, item in enumerate(new_items))
+        edits.append((insert_at, insert_at, block + ("" if kept else "\n")))
+        added = [item["label"] for item in new_items]
+    if edits:
+        for start, end, replacement in sorted(edits, reverse=True):
+            text = text[:start] + replacement + text[end:]
+        json.loads(text)  # Перевірка: зібраний текст — коректний JSON
+        tmp_path = f"{db_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, db_path)
+    return {"catalog_added": added, "catalog_updated": updated, "catalog_removed": removed}
+
+
+def ingest(reference_folder, db_path=DEFAULT_DB_PATH, index_path=INDEX_PATH, prune_catalog=False):
+    # prune_catalog=True — записи каталогу, для яких більше немає папки з фото, видаляються;
+    # інакше вони лише перелічуються у звіті (no_image_folder)
+    import model_manager
+    from clip_recognizer import embed_images, index_file
+    from weapons_catalog import image_folder_labels
+
+    started = time.perf_counter()
+    folders = image_folder_labels(reference_folder)
+    if prune_catalog and not folders:
+        # Хибний шлях до галереї зробив би «сиротами» всі записи каталогу
+        raise ValueError(f"у {reference_folder} немає жодної папки з фото — записи каталогу не видаляються")
+    with open(db_path, 'r', encoding='utf-8') as f:
+        known = {item.get("label") for item in json.load(f)}
+    orphaned = sorted(label for label in known if label not in folders)
+    # Спершу каталог: коли з'явиться новий індекс, записи для нових міток уже будуть на місці
+    report = update_catalog(db_path, read_folder_info(reference_folder), orphaned if prune_catalog else ())
+    index, stats = update_index(
+        reference_folder, embed_images, index_file(index_path),
+        model_manager.embedding_model_id(), model_manager.embedding_dim(),
+    )
+    known = (known - set(report["catalog_removed"])) | set(report["catalog_added"])
+    report.update(stats)
+    report["labels"] = len(index.label_names)
+    report["no_db_entry"] = sorted(label for label in folders if label not in known)
+    report["no_image_folder"] = [label for label in orphaned if label not in report["catalog_removed"]]
+    report["seconds"] = round(time.perf_counter() - started, 2)
+    return report
+
+
+def watch(reference_folder, db_path=DEFAULT_DB_PATH, index_path=INDEX_PATH, interval=WATCH_INTERVAL, prune_catalog=False):
+    # Опитування папки (без додаткових залежностей); зміни застосовуються після паузи,
+    # щоб не індексувати файли, які ще копіюються
+    applied = gallery_snapshot(reference_folder)
+    print(json.dumps(ingest(reference_folder, db_path, index_path, prune_catalog), ensure_ascii=False), flush=True)
+    pending = None
+    while True:
+        time.sleep(interval)
+        current = gallery_snapshot(reference_folder)
+        if current == applied:
+            pending = None
+            continue
+        if current != pending:
+            pending = current
+            continue
+        try:
+            report = ingest(reference_folder, db_path, index_path, prune_catalog)
+        except Exception as e:
+            print(f"❌ Не вдалося оновити галерею: {e}", flush=True)
+            continue
+        applied, pending = current, None
+        print(json.dumps(report, ensure_ascii=False), flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Інкрементальне поповнення галереї еталонних зображень")
+    parser.add_argument("--images", default="weapon_images", help="Папка з еталонними зображеннями")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="Каталог weapons_db.json")
+    parser.add_argument("--index", default=INDEX_PATH, help="Файл індексу")
+    parser.add_argument("--watch", action="store_true", help="Стежити за папкою і оновлювати при змінах")
+    parser.add_argument("--interval", type=float, default=WATCH_INTERVAL, help="Період перевірки в режимі --watch, с")
+    parser.add_argument("--prune-catalog", action="store_true",
+                        help="Видаляти з каталогу записи, для яких більше немає папки з фото")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.watch:
+            try:
+                watch(args.images, args.db, args.index, args.interval, args.prune_catalog)
+            except KeyboardInterrupt:
+                pass
+            return 0
+        report = ingest(args.images, args.db, args.index, args.prune_catalog)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,35 +1,332 @@
 from PIL import Image
 import imagehash
 import os
+import sys
+import json
+import time
+import argparse
+import threading
+from functools import lru_cache
+import numpy as np
+
+from embedding_index import scan_reference_images
 
 WEAPONS_FOLDER = "weapon_images"
 INPUT_IMAGE_PATH = "input_photos/test.jpg"
+HASH_INDEX_PATH = os.environ.get("HASH_INDEX_PATH", "weapon_hashes.npz")
+
+# Швидкий перший етап розпізнавання: для кожного еталона зберігаються три 64-бітні
+# перцептивні хеші (average / difference / perceptual), упаковані в uint64.
+# Пошук за відстанню Хеммінга — multi-index hashing: кожен хеш ділиться на 4 частини по 16 біт,
+# і за принципом Діріхле кандидат з відстанню ≤ r збігається хоча б в одній частині з точністю r // 4.
+HASH_FUNCTIONS = (imagehash.average_hash, imagehash.dhash, imagehash.phash)
+HASH_KINDS = ("average", "difference", "perceptual")
+CHUNKS = 4
+CHUNK_BITS = 64 // CHUNKS
+# Кількість одиничних бітів у кожному байті — для підрахунку popcount без циклів
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+# Хеші рахуються по одній зменшеній копії у відтінках сірого (64×64): самі хеш-функції стискають
+# зображення до 8×8…32×32, тож повнорозмірне фото для них — лише зайві мілісекунди
+HASH_IMAGE_SIZE = 64
+# Змінюється разом зі способом підготовки зображення — збережені підписи іншої версії перераховуються
+SIGNATURE_VERSION = 2
+# До такого розміру галереї кандидати шукаються прямим перебором (XOR + popcount по всіх підписах) —
+# це швидше за сотні звернень до таблиць multi-index; таблиці будуються лише для більших галерей
+HASH_BRUTE_FORCE_MAX = int(os.environ.get("HASH_BRUTE_FORCE_MAX", "4096"))
+
 
 def get_image_hash(path):
     with Image.open(path) as img:
         return imagehash.average_hash(img)
 
-def find_closest_match(input_img_path):
-    input_hash = get_image_hash(input_img_path)
-    closest_match = None
-    min_diff = float('inf')
 
-    for filename in os.listdir(WEAPONS_FOLDER):
-        weapon_path = os.path.join(WEAPONS_FOLDER, filename)
-        weapon_hash = get_image_hash(weapon_path)
-        diff = input_hash - weapon_hash
+def prepare_for_hashing(image):
+    # Спершу грубе цілочисельне зменшення (дешеве навіть для фото 1280×960), потім сірий 64×64
+    factor = min(image.size) // (2 * HASH_IMAGE_SIZE)
+    if factor > 1:
+        image = image.reduce(factor)
+    return image.convert("L").resize((HASH_IMAGE_SIZE, HASH_IMAGE_SIZE), Image.LANCZOS)
+
+
+def hash_signature(image):
+    # Три хеші зображення як масив uint64 форми (3,)
+    image = prepare_for_hashing(image)
+    values = []
+    for hash_function in HASH_FUNCTIONS:
+        bits = hash_function(image).hash.flatten()
+        values.append(int.from_bytes(np.packbits(bits).tobytes(), "big"))
+    return np.asarray(values, dtype=np.uint64)
+
+
+def hamming(signatures, query):
+    # Відстані Хеммінга по кожному хешу: (N, 3)
+    xor = np.bitwise_xor(signatures, query)
+    return POPCOUNT[xor.view(np.uint8)].reshape(len(signatures), len(HASH_KINDS), 8).sum(axis=2)
+
+
+@lru_cache(maxsize=None)
+def _flip_masks(max_bits):
+    # Усі 16-бітні маски з не більше ніж max_bits одиницями (сусіди частини хеша)
+    masks = [0]
+    for _ in range(max_bits):
+        masks = sorted({mask | (1 << bit) for mask in masks for bit in range(CHUNK_BITS)} | set(masks))
+    return masks
+
+
+class HashIndex:
+    def __init__(self, signatures, paths, labels, categories, mtimes, sizes):
+        self.signatures = np.asarray(signatures, dtype=np.uint64).reshape(-1, len(HASH_KINDS))
+        self.paths = list(paths)
+        self.labels = list(labels)
+        self.categories = list(categories)
+        self.mtimes = np.asarray(mtimes, dtype=np.float64)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        keys = list(zip(self.categories, self.labels))
+        self.label_keys = list(dict.fromkeys(keys))
+        key_ids = {key: i for i, key in enumerate(self.label_keys)}
+        self.ref_label_ids = np.asarray([key_ids[key] for key in keys], dtype=np.int64)
+        self.label_counts = np.bincount(self.ref_label_ids, minlength=len(self.label_keys))
+        # Таблиці multi-index будуються при першому пошуку і лише для галерей понад HASH_BRUTE_FORCE_MAX
+        self.tables = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _build_tables(self):
+        # tables[kind][chunk] : значення 16-бітної частини → індекси еталонів
+        self.tables = []
+        for kind in range(len(HASH_KINDS)):
+            per_chunk = []
+            for chunk in range(CHUNKS):
+                values = (self.signatures[:, kind] >> np.uint64(chunk * CHUNK_BITS)) & np.uint64(0xFFFF)
+                order = np.argsort(values, kind="stable")
+                keys, starts, counts = np.unique(values[order], return_index=True, return_counts=True)
+                per_chunk.append({int(k): order[s:s + c] for k, s, c in zip(keys, starts, counts)})
+            self.tables.append(per_chunk)
+
+    def candidates(self, query, radius):
+        if self.tables is None:
+            self._build_tables()
+        masks = _flip_masks(radius // CHUNKS)
+        found = []
+        for kind in range(len(HASH_KINDS)):
+            value = int(query[kind])
+            for chunk, table in enumerate(self.tables[kind]):
+                part = (value >> (chunk * CHUNK_BITS)) & 0xFFFF
+                for mask in masks:
+                    ids = table.get(part ^ mask)
+                    if ids is not None:
+                        found.append(ids)
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+    def search(self, query, radius=12, exclude=None):
+        # Повертає (індекси, сумарна відстань) кандидатів, у яких хоча б один хеш у межах radius
+        if len(self) <= HASH_BRUTE_FORCE_MAX:
+            ids = np.arange(len(self))
+        else:
+            ids = self.candidates(query, radius)
+        if exclude is not None:
+            ids = ids[ids != exclude]
+        if not len(ids):
+            return ids, np.zeros(0, dtype=np.int64)
+        distances = hamming(self.signatures[ids], query)
+        keep = (distances <= radius).any(axis=1)
+        ids, total = ids[keep], distances[keep].sum(axis=1)
+        order = np.argsort(total, kind="stable")
+        return ids[order], total[order]
+
+    def lookup(self, image, radius=12, shortlist=10, duplicate_distance=0, exclude=None):
+        # Результат: (мітка-дублікат або None, список (категорія, мітка) кандидатів, частка відсіяних еталонів)
+        query = image if isinstance(image, np.ndarray) else hash_signature(image)
+        ids, total = self.search(query, radius, exclude)
+        if len(ids) and total[0] <= duplicate_distance:
+            best = ids[0]
+            return (self.categories[best], self.labels[best]), [], 1.0
+        if not len(ids):
+            # Кандидатів немає — розпізнавач шукатиме по всій галереї
+            return None, [], 0.0
+        # Унікальні мітки в порядку зростання відстані
+        label_ids = self.ref_label_ids[ids]
+        _, first = np.unique(label_ids, return_index=True)
+        selected = label_ids[np.sort(first)][:shortlist]
+        kept = int(self.label_counts[selected].sum())
+        pruned = 1.0 - kept / len(self) if len(self) else 0.0
+        return None, [self.label_keys[i] for i in selected], pruned
+
+    def save(self, path):
+        # Унікальна назва: кілька процесів можуть зберігати ту саму таблицю одночасно
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            signatures=self.signatures,
+            paths=np.asarray(self.paths, dtype=str),
+            labels=np.asarray(self.labels, dtype=str),
+            categories=np.asarray(self.categories, dtype=str),
+            mtimes=self.mtimes,
+            sizes=self.sizes,
+            version=np.asarray(SIGNATURE_VERSION),
+        )
+        os.replace(tmp_path, path)
 
-        if diff < min_diff:
-            min_diff = diff
-            closest_match = filename
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            version = int(data["version"]) if "version" in data.files else 1
+            if version != SIGNATURE_VERSION:
+                raise ValueError(f"підписи версії {version}, потрібна {SIGNATURE_VERSION}")
+            return cls(
+                data["signatures"], data["paths"].tolist(), data["labels"].tolist(),
+                data["categories"].tolist(), data["mtimes"], data["sizes"],
+            )
+
+
+def build_hash_index(reference_folder, previous=None):
+    # Перераховуються лише нові/змінені файли (шлях + mtime + розмір), як і в індексі ембедінгів
+    known = {}
+    if previous is not None:
+        known = {path: i for i, path in enumerate(previous.paths)}
+    rows = []
+    signatures = []
+    for entry in scan_reference_images(reference_folder):
+        i = known.get(entry["path"])
+        if i is not None and previous.mtimes[i] == entry["mtime"] and previous.sizes[i] == entry["size"]:
+            signatures.append(previous.signatures[i])
+        else:
+            try:
+                with Image.open(entry["path"]) as img:
+                    signatures.append(hash_signature(img))
+            except Exception as e:
+                print(f"⚠️ Помилка обробки {entry['path']}: {e}")
+                continue
+        rows.append(entry)
+    return HashIndex(
+        np.asarray(signatures, dtype=np.uint64).reshape(-1, len(HASH_KINDS)),
+        [e["path"] for e in rows], [e["label"] for e in rows], [e["category"] for e in rows],
+        [e["mtime"] for e in rows], [e["size"] for e in rows],
+    )
+
+
+_hash_index = None
+_hash_index_lock = threading.Lock()
+
+
+def get_hash_index(reference_folder=WEAPONS_FOLDER, index_path=HASH_INDEX_PATH, refresh=False):
+    # refresh=True — галерею оновлено: перераховуються лише нові/змінені файли
+    global _hash_index
+    with _hash_index_lock:
+        if _hash_index is None or refresh:
+            previous = _hash_index
+            if os.path.exists(index_path):
+                try:
+                    previous = HashIndex.load(index_path)
+                except Exception as e:
+                    print(f"⚠️ Не вдалося прочитати {index_path}: {e}")
+            _hash_index = build_hash_index(reference_folder, previous)
+            if previous is None or previous.paths != _hash_index.paths or not np.array_equal(previous.mtimes, _hash_index.mtimes):
+                _hash_index.save(index_path)
+        return _hash_index
+
+
+def find_closest_match(input_img_path, index=None):
+    # Найближчий еталон за сумарною відстанню трьох хешів (без CNN)
+    ranking = rank_hash_labels(input_img_path, index, top_n=1)
+    if not ranking:
+        return None, float('inf')
+    label, _, distance = ranking[0]
+    return label, distance
+
+
+def rank_hash_labels(input_img_path, index=None, top_n=5):
+    # Повний перебір: [(мітка, категорія, відстань)] за зростанням найменшої відстані до еталонів мітки
+    index = index if index is not None else get_hash_index(WEAPONS_FOLDER)
+    with Image.open(input_img_path) as img:
+        query = hash_signature(img)
+    if not len(index):
+        return []
+    distances = hamming(index.signatures, query).sum(axis=1)
+    ranking = []
+    seen = set()
+    for i in np.argsort(distances, kind="stable"):
+        key = (index.categories[i], index.labels[i])
+        if key in seen:
+            continue
+        seen.add(key)
+        ranking.append((index.labels[i], index.categories[i], int(distances[i])))
+        if len(ranking) >= top_n:
+            break
+    return ranking
+
+
+def prefilter_report(reference_folder=WEAPONS_FOLDER, radius=12, shortlist=10, with_cnn=False):
+    # Leave-one-out по еталонах: скільки галереї відсікає префільтр і чи лишається правильна мітка
+    index = get_hash_index(reference_folder)
+    duplicates = hits = fallbacks = 0
+    pruned = []
+    lookup_ms = []
+    cnn_full = cnn_pref = 0
+    scorer = None
+    if with_cnn:
+        import clip_recognizer
+
+        scorer = clip_recognizer.get_scorer(reference_folder)
+        position = {path: i for i, path in enumerate(scorer.index.paths)}
+    for i in range(len(index)):
+        truth = (index.categories[i], index.labels[i])
+        started = time.perf_counter()
+        duplicate, labels, share = index.lookup(index.signatures[i], radius, shortlist, exclude=i)
+        lookup_ms.append((time.perf_counter() - started) * 1000)
+        pruned.append(share)
+        if duplicate is not None:
+            duplicates += 1
+            labels = [duplicate]
+        if not labels:
+            fallbacks += 1
+        hits += not labels or truth in labels
+        if scorer is not None and index.paths[i] in position:
+            # Найближчий інший еталон — по всій галереї та лише серед міток-кандидатів
+            row = position[index.paths[i]]
+            sims = scorer.index.embeddings @ scorer.index.embeddings[row]
+            sims[row] = -np.inf
+            keys = list(zip(scorer.index.categories, scorer.index.labels))
+            cnn_full += keys[int(np.argmax(sims))] == truth
+            allowed = np.array([key in labels for key in keys]) if labels else np.ones(len(keys), dtype=bool)
+            sims[~allowed] = -np.inf
+            cnn_pref += np.isfinite(sims).any() and keys[int(np.argmax(sims))] == truth
+    n = max(len(index), 1)
+    report = {
+        "references": len(index),
+        "radius": radius,
+        "shortlist": shortlist,
+        "duplicates": duplicates,
+        "full_search_fallbacks": fallbacks,
+        "mean_pruned": round(float(np.mean(pruned)) if pruned else 0.0, 4),
+        "shortlist_recall": round(hits / n, 4),
+        "lookup_p50_ms": round(float(np.percentile(lookup_ms, 50)), 4) if lookup_ms else 0.0,
+    }
+    if scorer is not None:
+        report["cnn_top1_full"] = round(cnn_full / n, 4)
+        report["cnn_top1_prefiltered"] = round(cnn_pref / n, 4)
+    return report
 
-    return closest_match, min_diff
 
 if __name__ == "__main__":
-    match, difference = find_closest_match(INPUT_IMAGE_PATH)
+    parser = argparse.ArgumentParser(description="Пошук за перцептивними хешами та звіт префільтра")
+    parser.add_argument("image", nargs="?", default=INPUT_IMAGE_PATH)
+    parser.add_argument("--report", action="store_true", help="Звіт leave-one-out по галереї")
+    parser.add_argument("--radius", type=int, default=12)
+    parser.add_argument("--shortlist", type=int, default=10)
+    parser.add_argument("--with-cnn", action="store_true", help="Порівняти точність CNN з префільтром і без")
+    args = parser.parse_args()
+
+    if args.report:
+        print(json.dumps(prefilter_report(WEAPONS_FOLDER, args.radius, args.shortlist, args.with_cnn), ensure_ascii=False))
+        sys.exit(0)
+
+    match, difference = find_closest_match(args.image)
     if match:
         print(f"✅ Найбільш схоже зображення: {match}")
         print(f"📏 Різниця хешів: {difference}")
     else:
         print("❌ Не вдалося знайти збіг.")
-
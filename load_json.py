@@ -1,13 +1,11 @@
-import json
+from weapons_catalog import get_catalog
 
-with open('weapons_db.json', 'r', encoding='utf-8') as file:
-    weapons = json.load(file)
+weapons = get_catalog('weapons_db.json').entries
 
 for weapon in weapons:
-    print(f"Model: {weapon['name']}")
-    print(f"Country: {weapon['country']}")
-    print(f"Years of production: {weapon['years']}")
-    print(f"Caliber: {weapon['caliber']}")
-    print(f"Type: {weapon['type']}")
+    print(f"Model: {weapon.get('name_ua', weapon['label'])}")
+    print(f"Country: {weapon.get('country', '-')}")
+    print(f"Years of production: {weapon.get('years', '-')}")
+    print(f"Caliber: {weapon.get('caliber', '-')}")
+    print(f"Type: {weapon.get('type', '-')}")
     print("-" * 30)
-
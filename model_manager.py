@@ -0,0 +1,201 @@
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+
+from backbones import BACKBONE, BACKBONES, default_weights_path, backbone_tag, build_backbone
+
+# Лінивe завантаження моделі: ваги читаються з локального файлу (без мережі),
+# модель створюється при першому зверненні або у фоновому прогріванні бота.
+# Бекенд "torch" — PyTorch-модель, "onnx" — експортована модель в onnxruntime (без torch).
+# Сама модель (екстрактор ознак) вибирається через BACKBONE, див. backbones
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+MODEL_WEIGHTS_PATH = os.environ.get("MODEL_WEIGHTS_PATH", default_weights_path(BACKBONE))
+# Дозволити одноразове завантаження ваг з інтернету, якщо локального файлу немає.
+# Вимкнено за замовчуванням: ваги завантажує крок збірки (model_manager.py --download, див. render.yaml)
+MODEL_ALLOW_DOWNLOAD = os.environ.get("MODEL_ALLOW_DOWNLOAD", "0") == "1"
+# Оптимізований CPU-інференс (див. optimized_inference): eager, torchscript, compile або int8
+INFERENCE_MODE = os.environ.get("INFERENCE_MODE", "eager")
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", "0"))
+CHANNELS_LAST = os.environ.get("CHANNELS_LAST", "0") == "1"
+INFERENCE_VALIDATE = os.environ.get("INFERENCE_VALIDATE", "1") == "1"
+INFERENCE_MIN_AGREEMENT = float(os.environ.get("INFERENCE_MIN_AGREEMENT", "0.98"))
+REFERENCE_FOLDER = os.environ.get("REFERENCE_FOLDER", "weapon_images")
+
+_backend = None
+_lock = threading.Lock()
+_ready = threading.Event()
+_error = None
+_load_seconds = None
+
+
+def download_weights(weights_path=MODEL_WEIGHTS_PATH):
+    from backbones import download_weights as download_backbone_weights
+
+    return download_backbone_weights(BACKBONE, weights_path)
+
+
+def build_fp32_model(weights_path=MODEL_WEIGHTS_PATH):
+    if not os.path.exists(weights_path):
+        if not MODEL_ALLOW_DOWNLOAD:
+            raise FileNotFoundError(
+                f"Немає локальних ваг моделі {weights_path}. Запустіть: python model_manager.py --download"
+            )
+        logging.warning("⚠️ Локальних ваг %s немає — завантажуємо один раз", weights_path)
+        download_weights(weights_path)
+
+    return build_backbone(BACKBONE, weights_path)
+
+
+class TorchBackend:
+    name = "torch"
+
+    def __init__(self, model, device, mode, memory_format):
+        self.model = model
+        self.device = device
+        self.mode = mode
+        self.memory_format = memory_format
+
+    def embed(self, batch):
+        import torch
+
+        tensor = torch.from_numpy(batch).to(self.device).contiguous(memory_format=self.memory_format)
+        with torch.no_grad():
+            features = self.model(tensor)
+        return torch.nn.functional.normalize(features, dim=1).cpu().numpy()
+
+    def set_num_threads(self, num_threads):
+        from optimized_inference import configure_threads
+
+        configure_threads(num_threads)
+
+
+def _build_torch_backend(weights_path):
+    import torch
+    from optimized_inference import configure_threads, build_optimized
+
+    configure_threads(TORCH_THREADS)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = build_fp32_model(weights_path)
+    if device != "cpu":
+        return TorchBackend(model.to(device), device, "eager", torch.contiguous_format)
+    model, mode, memory_format, report = build_optimized(
+        model, INFERENCE_MODE, REFERENCE_FOLDER, CHANNELS_LAST, INFERENCE_MIN_AGREEMENT, INFERENCE_VALIDATE
+    )
+    if report:
+        logging.info("📊 Перевірка режиму %s: %s", INFERENCE_MODE, report)
+    return TorchBackend(model, device, mode, memory_format)
+
+
+def _build_backend():
+    if INFERENCE_BACKEND == "onnx":
+        from onnx_backend import OnnxBackend, ONNX_MODEL_PATH
+
+        return OnnxBackend(ONNX_MODEL_PATH, TORCH_THREADS)
+    if INFERENCE_BACKEND == "torch":
+        return _build_torch_backend(MODEL_WEIGHTS_PATH)
+    raise ValueError(f"Невідомий бекенд інференсу: {INFERENCE_BACKEND}")
+
+
+def get_backend():
+    global _backend, _error, _load_seconds
+    if _backend is not None:
+        return _backend
+    with _lock:
+        if _backend is None:
+            started = time.perf_counter()
+            try:
+                _backend = _build_backend()
+            except Exception as e:
+                _error = e
+                raise
+            _error = None
+            _load_seconds = time.perf_counter() - started
+            _ready.set()
+            logging.info("✅ Модель %s завантажено за %.2f с (%s, %s)", BACKBONE, _load_seconds, _backend.name, _backend.mode)
+    return _backend
+
+
+def active_mode():
+    return get_backend().mode
+
+
+def embedding_tag():
+    # Окремий індекс для кожного екстрактора, а int8-ембедінги відрізняються від fp32 — ще й для них.
+    # Тег визначається налаштуваннями без завантаження моделі; лише для INFERENCE_MODE=int8 потрібен
+    # фактичний режим (int8 може не пройти перевірку і лишитися eager)
+    int8 = INFERENCE_BACKEND == "torch" and INFERENCE_MODE == "int8" and active_mode() == "int8"
+    tags = [backbone_tag(BACKBONE), "int8" if int8 else ""]
+    return ".".join(tag for tag in tags if tag)
+
+
+def embedding_dim():
+    return BACKBONES[BACKBONE]["dim"]
+
+
+_model_ids = {}
+
+
+def embedding_model_id():
+    # Ідентичність файлу, з якого активний бекенд вантажить модель (назва, розмір, SHA1 вмісту):
+    # інші ваги того ж екстрактора дають інші ембедінги, і індекс треба перебудувати.
+    # Порожній рядок — файлу ще немає (ваги завантажаться пізніше), перевірка пропускається
+    if INFERENCE_BACKEND == "onnx":
+        from onnx_backend import ONNX_MODEL_PATH as path
+    else:
+        path = MODEL_WEIGHTS_PATH
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return ""
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in _model_ids:
+        import hashlib
+
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        _model_ids[key] = f"{os.path.basename(path)}:{stat.st_size}:{digest.hexdigest()[:16]}"
+    return _model_ids[key]
+
+
+def is_ready():
+    return _ready.is_set()
+
+
+def last_error():
+    return _error
+
+
+def wait_until_ready(timeout=None):
+    return _ready.wait(timeout)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Керування локальними вагами моделі")
+    parser.add_argument("--download", action="store_true", help="Завантажити ваги в локальний кеш")
+    parser.add_argument("--weights", default=MODEL_WEIGHTS_PATH, help="Шлях до файлу ваг")
+    parser.add_argument("--list", action="store_true", help="Показати доступні екстрактори ознак")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, spec in BACKBONES.items():
+            marker = "→" if name == BACKBONE else " "
+            note = "  (експериментальний)" if spec.get("experimental") else ""
+            print(f"{marker} {name:<20} {spec['kind']:<12} dim={spec['dim']:<5} {default_weights_path(name)}{note}")
+        return 0
+
+    if args.download and not os.path.exists(args.weights):
+        download_weights(args.weights)
+    if not os.path.exists(args.weights):
+        print(f"❌ Файл ваг не знайдено: {args.weights}")
+        return 1
+    print(f"✅ Ваги моделі {BACKBONE}: {args.weights}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
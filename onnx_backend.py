@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+from backbones import BACKBONE
+
+# Бекенд onnxruntime (CPU): той самий екстрактор ознак (BACKBONE, див. backbones), експортований в ONNX.
+# Для роботи бота потрібні лише onnxruntime, numpy і Pillow — torch імпортується тільки при експорті.
+ONNX_MODEL_PATH = os.environ.get("ONNX_MODEL_PATH", f"models/{BACKBONE}.onnx")
+ONNX_OPSET = 13
+PARITY_SAMPLE = 64
+
+
+class OnnxBackend:
+    name = "onnx"
+    mode = "onnx"
+
+    def __init__(self, model_path=ONNX_MODEL_PATH, num_threads=0):
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Немає ONNX-моделі {model_path}. Запустіть: python onnx_backend.py export")
+        self.model_path = model_path
+        self.set_num_threads(num_threads)
+
+    def set_num_threads(self, num_threads):
+        # Кількість потоків задається при створенні сесії, тому сесія створюється заново
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(self.model_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def embed(self, batch):
+        features = self.session.run(None, {self.input_name: np.ascontiguousarray(batch, dtype=np.float32)})[0]
+        norms = np.linalg.norm(features, axis=1, keepdims=True)
+        return features / np.maximum(norms, 1e-12)
+
+
+def export_onnx(output_path=ONNX_MODEL_PATH):
+    import torch
+    import model_manager
+
+    model = model_manager.build_fp32_model()
+    example = torch.rand(1, 3, 224, 224)
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    tmp_path = f"{output_path}.tmp"
+    torch.onnx.export(
+        model, example, tmp_path,
+        input_names=["images"], output_names=["features"],
+        dynamic_axes={"images": {0: "batch"}, "features": {0: "batch"}},
+        opset_version=ONNX_OPSET,
+    )
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def parity_report(model_path=ONNX_MODEL_PATH, reference_folder="weapon_images", sample=PARITY_SAMPLE):
+    # Порівняння ембедінгів torch та onnxruntime на еталонних зображеннях
+    import torch
+    import model_manager
+    from clip_recognizer import load_image
+    from optimized_inference import reference_sample
+
+    paths = [e["path"] for e in reference_sample(reference_folder, sample)]
+    batch = np.concatenate([load_image(path) for path in paths])
+    torch_backend = model_manager.TorchBackend(model_manager.build_fp32_model(), "cpu", "eager", torch.contiguous_format)
+    expected = torch_backend.embed(batch)
+    found = OnnxBackend(model_path).embed(batch)
+    cosine = np.sum(expected * found, axis=1)
+    top1 = np.argmax(expected @ expected.T - 2 * np.eye(len(paths)), axis=1)
+    top1_onnx = np.argmax(found @ found.T - 2 * np.eye(len(paths)), axis=1)
+    return {
+        "images": len(paths),
+        "max_abs_diff": float(np.abs(expected - found).max()),
+        "min_cosine": round(float(cosine.min()), 6),
+        "nearest_neighbour_agreement": round(float(np.mean(top1 == top1_onnx)), 4),
+    }
+
+
+def _timed_subprocess(code):
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], check=True, capture_output=True)
+    return round(time.perf_counter() - started, 3)
+
+
+def startup_report(model_path=ONNX_MODEL_PATH):
+    # Холодний старт в окремому процесі: імпорт бібліотек + створення моделі
+    return {
+        "torch_startup_s": _timed_subprocess("import model_manager; model_manager.build_fp32_model()"),
+        "onnx_startup_s": _timed_subprocess(f"import onnx_backend; onnx_backend.OnnxBackend({model_path!r})"),
+    }
+
+
+def latency_report(model_path=ONNX_MODEL_PATH, batch_size=1, repeats=20):
+    import torch
+    import model_manager
+
+    batch = np.random.default_rng(0).random((batch_size, 3, 224, 224), dtype=np.float32)
+    backends = {
+        "torch": model_manager.TorchBackend(model_manager.build_fp32_model(), "cpu", "eager", torch.contiguous_format),
+        "onnx": OnnxBackend(model_path),
+    }
+    report = {"batch_size": batch_size}
+    for name, backend in backends.items():
+        backend.embed(batch)
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            backend.embed(batch)
+            timings.append((time.perf_counter() - started) * 1000)
+        report[f"{name}_ms"] = round(float(np.median(timings)), 2)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Експорт в ONNX і порівняння з torch-бекендом")
+    parser.add_argument("command", choices=["export", "check"])
+    parser.add_argument("--output", default=ONNX_MODEL_PATH, help="Шлях до ONNX-моделі")
+    parser.add_argument("--images", default="weapon_images")
+    parser.add_argument("--batch-size", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        print(f"✅ ONNX-модель: {export_onnx(args.output)}")
+        return 0
+
+    report = parity_report(args.output, args.images)
+    report.update(startup_report(args.output))
+    report.update(latency_report(args.output, args.batch_size))
+    print(json.dumps(report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
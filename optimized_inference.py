@@ -0,0 +1,209 @@
+import sys
+import copy
+import time
+import json
+import logging
+import argparse
+import numpy as np
+
+# Оптимізований CPU-інференс: int8-квантизація, TorchScript / torch.compile,
+# channels-last та налаштування кількості потоків. Режим вмикається лише після
+# перевірки, що top-1 мітки збігаються з fp32-моделлю на еталонних зображеннях.
+INFERENCE_MODES = ("eager", "torchscript", "compile", "int8")
+CALIBRATION_IMAGES = 64
+VALIDATE_SAMPLE = 200
+VALIDATE_BATCH = 16
+
+
+def configure_threads(num_threads):
+    import torch
+
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+        try:
+            torch.set_num_interop_threads(max(1, min(num_threads, 4)))
+        except RuntimeError:
+            # Потоки міжопераційного пулу можна задати лише до першого паралельного виклику
+            pass
+
+
+def reference_sample(reference_folder, limit):
+    from embedding_index import scan_reference_images
+
+    entries = scan_reference_images(reference_folder)
+    if len(entries) > limit:
+        rng = np.random.default_rng(0)
+        entries = [entries[i] for i in sorted(rng.choice(len(entries), limit, replace=False))]
+    return entries
+
+
+def _load_batches(paths, batch_size=VALIDATE_BATCH):
+    import torch
+    from clip_recognizer import load_image
+
+    for start in range(0, len(paths), batch_size):
+        yield torch.from_numpy(np.concatenate([load_image(path) for path in paths[start:start + batch_size]]))
+
+
+def _quantize_int8(model, calibration_paths):
+    import torch
+    from torchvision.models.quantization import mobilenet_v2 as quantizable_mobilenet_v2
+    from backbones import BACKBONE
+
+    if BACKBONE != "mobilenet_v2":
+        raise ValueError(f"int8-квантизація підтримується лише для mobilenet_v2, а не {BACKBONE}")
+
+    engine = "fbgemm" if "fbgemm" in torch.backends.quantized.supported_engines else "qnnpack"
+    torch.backends.quantized.engine = engine
+
+    qmodel = quantizable_mobilenet_v2(weights=None, quantize=False)
+    qmodel.classifier = torch.nn.Identity()
+    qmodel.load_state_dict(model.state_dict())
+    qmodel.eval()
+    qmodel.fuse_model(is_qat=False)
+    qmodel.qconfig = torch.ao.quantization.get_default_qconfig(engine)
+    torch.ao.quantization.prepare(qmodel, inplace=True)
+    # Калібрування діапазонів активацій на еталонних зображеннях
+    with torch.no_grad():
+        for batch in _load_batches(calibration_paths):
+            qmodel(batch)
+    torch.ao.quantization.convert(qmodel, inplace=True)
+    return qmodel
+
+
+def optimize_model(model, mode, reference_folder, channels_last=False):
+    import torch
+
+    # Працюємо з копією, щоб fp32-модель лишилась незмінною для перевірки і відкату
+    model = copy.deepcopy(model)
+    if mode == "int8":
+        calibration = [e["path"] for e in reference_sample(reference_folder, CALIBRATION_IMAGES)]
+        model = _quantize_int8(model, calibration)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    example = torch.rand(1, 3, 224, 224)
+    if channels_last:
+        example = example.contiguous(memory_format=torch.channels_last)
+    if mode in ("torchscript", "int8"):
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example)
+            model = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+    elif mode == "compile":
+        model = torch.compile(model)
+    # Перший прогін робить трасування/компіляцію, щоб запити користувачів не чекали на неї
+    with torch.no_grad():
+        model(example)
+    return model
+
+
+def _embed_paths(model, paths, memory_format):
+    import torch
+
+    features = []
+    with torch.no_grad():
+        for batch in _load_batches(paths):
+            output = model(batch.contiguous(memory_format=memory_format))
+            features.append(torch.nn.functional.normalize(output, dim=1).numpy())
+    return np.concatenate(features)
+
+
+def _nearest_labels(features, labels):
+    # Мітка найближчого іншого еталона (leave-one-out)
+    sims = features @ features.T
+    np.fill_diagonal(sims, -np.inf)
+    return [labels[i] for i in np.argmax(sims, axis=1)]
+
+
+def validate_against_fp32(reference_model, candidate_model, reference_folder, memory_format, sample=VALIDATE_SAMPLE):
+    import torch
+
+    entries = reference_sample(reference_folder, sample)
+    paths = [e["path"] for e in entries]
+    labels = [e["label"] for e in entries]
+    if len(paths) < 2:
+        return {"images": len(paths), "top1_agreement": 1.0, "min_cosine": 1.0}
+
+    reference = _embed_paths(reference_model, paths, torch.contiguous_format)
+    candidate = _embed_paths(candidate_model, paths, memory_format)
+    expected = _nearest_labels(reference, labels)
+    found = _nearest_labels(candidate, labels)
+    agreement = sum(a == b for a, b in zip(expected, found)) / len(paths)
+    cosine = np.sum(reference * candidate, axis=1)
+    return {
+        "images": len(paths),
+        "top1_agreement": round(float(agreement), 4),
+        "min_cosine": round(float(cosine.min()), 4),
+        "mean_cosine": round(float(cosine.mean()), 4),
+    }
+
+
+def build_optimized(model, mode, reference_folder, channels_last=False, min_agreement=0.98, validate=True):
+    # Повертає (модель, фактичний режим, формат пам'яті входу, звіт перевірки).
+    # Якщо оптимізація не вдалась або не пройшла перевірку — лишається fp32 eager.
+    import torch
+
+    fallback = (model, "eager", torch.contiguous_format, None)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    if mode == "eager" and not channels_last:
+        return fallback
+    try:
+        candidate = optimize_model(model, mode, reference_folder, channels_last)
+        report = None
+        if validate:
+            report = validate_against_fp32(model, candidate, reference_folder, memory_format)
+            if report["top1_agreement"] < min_agreement:
+                logging.warning("⚠️ Режим %s не пройшов перевірку (%s) — використовуємо fp32", mode, report)
+                return model, "eager", torch.contiguous_format, report
+        return candidate, mode, memory_format, report
+    except Exception as e:
+        logging.warning("⚠️ Не вдалося увімкнути режим %s: %s — використовуємо fp32", mode, e)
+        return fallback
+
+
+def _latency_ms(model, memory_format, batch_size, repeats):
+    import torch
+
+    batch = torch.rand(batch_size, 3, 224, 224).contiguous(memory_format=memory_format)
+    timings = []
+    with torch.no_grad():
+        model(batch)
+        for _ in range(repeats):
+            started = time.perf_counter()
+            model(batch)
+            timings.append((time.perf_counter() - started) * 1000)
+    return round(float(np.median(timings)), 2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Перевірка та порівняння оптимізованих режимів інференсу")
+    parser.add_argument("--modes", nargs="+", default=["torchscript", "int8"], choices=INFERENCE_MODES)
+    parser.add_argument("--images", default="weapon_images")
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--channels-last", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    import torch
+    import model_manager
+
+    configure_threads(args.threads)
+    fp32 = model_manager.build_fp32_model()
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    print(json.dumps({
+        "mode": "eager", "threads": torch.get_num_threads(),
+        "latency_ms": _latency_ms(fp32, torch.contiguous_format, args.batch_size, args.repeats),
+    }))
+    for mode in args.modes:
+        candidate = optimize_model(fp32, mode, args.images, args.channels_last)
+        report = validate_against_fp32(fp32, candidate, args.images, memory_format)
+        report.update({
+            "mode": mode, "channels_last": args.channels_last, "threads": torch.get_num_threads(),
+            "latency_ms": _latency_ms(candidate, memory_format, args.batch_size, args.repeats),
+        })
+        print(json.dumps(report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
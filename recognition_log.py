@@ -0,0 +1,240 @@
+import io
+import os
+import re
+import csv
+import json
+import time
+import queue
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+# Структурований журнал розпізнавань у SQLite (WAL): обробники бота лише кладуть запис у чергу,
+# а окремий потік пише їх пакетами — запис на диск ніколи не блокує event loop.
+RECOGNITION_LOG_PATH = os.environ.get("RECOGNITION_LOG_PATH", "recognition_log.sqlite3")
+# Як часто (с) скидати накопичені записи і скільки записів максимум в одній транзакції
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "1.0"))
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", "500"))
+# Межа черги: при переповненні записи відкидаються (з лічильником), а не гальмують бота
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recognitions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    user_id INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    label TEXT,
+    category TEXT,
+    score REAL,
+    top_k TEXT,
+    latitude REAL,
+    longitude REAL,
+    latency_ms REAL,
+    result TEXT
+)
+"""
+# Історія користувача (/mylog) читається за індексом (user_id, ts): час запиту залежить від
+# кількості записів цього користувача, а не від розміру всього журналу
+INDEX = "CREATE INDEX IF NOT EXISTS recognitions_user_ts ON recognitions (user_id, ts)"
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "200"))
+EXPORT_FORMATS = ("txt", "csv", "json")
+COLUMNS = ("ts", "user_id", "event", "label", "category", "score", "top_k", "latitude", "longitude", "latency_ms", "result")
+# Старий текстовий журнал (до SQLite) імпортується один раз, щоб /mylog показував і давню історію.
+# Факт імпорту зберігається в таблиці imports, сам файл не змінюється
+LEGACY_LOG_PATH = os.environ.get("LEGACY_LOG_PATH", "user_logs.txt")
+IMPORTS = "CREATE TABLE IF NOT EXISTS imports (source TEXT PRIMARY KEY, ts REAL NOT NULL, records INTEGER NOT NULL)"
+LEGACY_LINE = re.compile(r"^\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\] User: (-?\d+) — (.*)$")
+LEGACY_COORDS = re.compile(r" \| Координати: (-?[\d.]+),\s*(-?[\d.]+)$")
+_STOP = object()
+
+
+def connect(path=RECOGNITION_LOG_PATH):
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(SCHEMA)
+    connection.execute(INDEX)
+    return connection
+
+
+def parse_legacy_line(line):
+    # "[2024-05-01 12:00:00] User: 42 — Модель: ... | Координати: 50.4,30.5" → запис журналу або None
+    match = LEGACY_LINE.match(line.rstrip("\n"))
+    if not match:
+        return None
+    timestamp, user_id, text = match.groups()
+    latitude = longitude = None
+    coords = LEGACY_COORDS.search(text)
+    if coords:
+        latitude, longitude = float(coords.group(1)), float(coords.group(2))
+        text = text[:coords.start()]
+    ts = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").timestamp()
+    # У старому журналі записувалися лише підтвердження локації з останнім результатом
+    return (ts, int(user_id), "location", None, None, None, None, latitude, longitude, None, text)
+
+
+def import_legacy_log(legacy_path=LEGACY_LOG_PATH, path=RECOGNITION_LOG_PATH):
+    # Повертає кількість імпортованих записів; повторний виклик нічого не робить
+    if not os.path.exists(legacy_path):
+        return 0
+    source = os.path.abspath(legacy_path)
+    connection = connect(path)
+    try:
+        connection.execute(IMPORTS)
+        if connection.execute("SELECT 1 FROM imports WHERE source = ?", (source,)).fetchone():
+            return 0
+        records = []
+        skipped = 0
+        with open(legacy_path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                record = parse_legacy_line(line)
+                if record is None:
+                    skipped += line.strip() != ""
+                else:
+                    records.append(record)
+        placeholders = ", ".join("?" for _ in COLUMNS)
+        # Записи й позначка імпорту — в одній транзакції: після збою імпорт просто повториться
+        with connection:
+            connection.executemany(f"INSERT INTO recognitions ({', '.join(COLUMNS)}) VALUES ({placeholders})", records)
+            connection.execute("INSERT INTO imports (source, ts, records) VALUES (?, ?, ?)", (source, time.time(), len(records)))
+    finally:
+        connection.close()
+    if skipped:
+        logging.warning("⚠️ %s: пропущено нерозпізнаних рядків: %d", legacy_path, skipped)
+    return len(records)
+
+
+def make_record(user_id, event, ranking=None, latitude=None, longitude=None, latency_ms=None, result=None):
+    # ranking — [(мітка, категорія, схожість), ...]; перший елемент — найкращий збіг
+    label, category, score = ranking[0] if ranking else (None, None, None)
+    top_k = json.dumps([[l, c, round(float(s), 4)] for l, c, s in ranking], ensure_ascii=False) if ranking else None
+    return (
+        time.time(), int(user_id), event, label, category,
+        None if score is None else float(score), top_k,
+        latitude, longitude, None if latency_ms is None else round(float(latency_ms), 1), result,
+    )
+
+
+class RecognitionLog:
+    def __init__(self, path=RECOGNITION_LOG_PATH, flush_interval=LOG_FLUSH_INTERVAL,
+                 batch_size=LOG_BATCH_SIZE, max_queue=LOG_QUEUE_SIZE):
+        self.path = path
+        self.flush_interval = max(0.01, float(flush_interval))
+        self.batch_size = max(1, int(batch_size))
+        self._queue = queue.Queue(maxsize=max(1, int(max_queue)))
+        self._thread = None
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="recognition-log", daemon=True)
+            self._thread.start()
+
+    def write(self, user_id, event, **fields):
+        # Неблокуючий запис з будь-якого обробника
+        try:
+            self._queue.put_nowait(make_record(user_id, event, **fields))
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logging.warning("⚠️ Черга журналу переповнена, відкинуто записів: %d", self.dropped)
+
+    def _run(self):
+        connection = connect(self.path)
+        placeholders = ", ".join("?" for _ in COLUMNS)
+        sql = f"INSERT INTO recognitions ({', '.join(COLUMNS)}) VALUES ({placeholders})"
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if record is _STOP:
+                    stopping = True
+                    break
+                batch.append(record)
+            if not batch:
+                continue
+            try:
+                with connection:
+                    connection.executemany(sql, batch)
+                self.written += len(batch)
+                self.flushes += 1
+            except sqlite3.Error as e:
+                self.dropped += len(batch)
+                logging.error("❌ Не вдалося записати журнал розпізнавань: %s", e)
+        connection.close()
+
+    def close(self, timeout=10):
+        # Дописує все, що лишилося в черзі, і зупиняє потік
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def metrics(self):
+        return {
+            "written": self.written,
+            "dropped": self.dropped,
+            "pending": self._queue.qsize(),
+            "flushes": self.flushes,
+        }
+
+
+def user_history(user_id, since=None, until=None, page=1, page_size=HISTORY_PAGE_SIZE, path=RECOGNITION_LOG_PATH):
+    # Сторінка 1 — найновіші записи; since/until — datetime або None. Повертає (записи за часом, усього)
+    conditions = ["user_id = ?"]
+    params = [int(user_id)]
+    if since is not None:
+        conditions.append("ts >= ?")
+        params.append(since.timestamp())
+    if until is not None:
+        conditions.append("ts < ?")
+        params.append(until.timestamp())
+    where = " AND ".join(conditions)
+    page_size = max(1, int(page_size))
+    connection = connect(path)
+    try:
+        total = connection.execute(f"SELECT COUNT(*) FROM recognitions WHERE {where}", params).fetchone()[0]
+        cursor = connection.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM recognitions WHERE {where} ORDER BY ts DESC, id DESC LIMIT ? OFFSET ?",
+            params + [page_size, (max(1, int(page)) - 1) * page_size],
+        )
+        rows = [dict(zip(COLUMNS, row)) for row in cursor]
+    finally:
+        connection.close()
+    rows.reverse()
+    return rows, total
+
+
+def export_history(rows, fmt="txt"):
+    # Документ формується в пам'яті й віддається байтами (без тимчасових файлів)
+    for row in rows:
+        row["time"] = datetime.fromtimestamp(row["ts"]).strftime("%Y-%m-%d %H:%M:%S")
+    if fmt == "json":
+        items = [{**row, "top_k": json.loads(row["top_k"]) if row["top_k"] else []} for row in rows]
+        return json.dumps(items, ensure_ascii=False, indent=2).encode("utf-8")
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        fields = ("time",) + COLUMNS[1:]
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow([row[field] for field in fields])
+        # BOM, щоб Excel правильно показав кирилицю
+        return buffer.getvalue().encode("utf-8-sig")
+    if fmt != "txt":
+        raise ValueError(f"Невідомий формат експорту: {fmt}")
+    lines = []
+    for row in rows:
+        coords = f" | Координати: {row['latitude']},{row['longitude']}" if row["latitude"] is not None else ""
+        lines.append(f"[{row['time']}] User: {row['user_id']} — {row['result']}{coords}\n")
+    return "".join(lines).encode("utf-8")
@@ -0,0 +1,123 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Кеш результатів розпізнавання для однакових фото: пересланий або повторно надісланий файл
+# має той самий file_unique_id у Telegram (тоді не потрібне навіть завантаження),
+# а інший файл з тим самим вмістом знаходиться за SHA-1 байтів (пропускається лише модель).
+# Зберігаються ембедінги запиту і ранжування — після оновлення галереї результат
+# перераховується з ембедінгів без прогону моделі.
+RESULT_CACHE_MAX_MB = float(os.environ.get("RESULT_CACHE_MAX_MB", "64"))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", "86400"))
+# Орієнтовні накладні витрати Python-об'єктів на один запис
+ENTRY_OVERHEAD = 512
+
+
+def content_key(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class CachedResult:
+    def __init__(self, key, ranking, features, version):
+        self.key = key
+        self.ranking = ranking
+        self.features = features
+        self.version = version
+        self.file_ids = set()
+        self.created = time.monotonic()
+        # Розмір фіксується при створенні, щоб облік байтів не «плив»
+        self.size = ENTRY_OVERHEAD + (features.nbytes if features is not None else 0) + 64 * len(ranking)
+
+
+class ResultCache:
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_MB * 2 ** 20, ttl=RESULT_CACHE_TTL):
+        self.max_bytes = int(max_bytes)
+        self.ttl = float(ttl)
+        self._entries = OrderedDict()
+        self._by_file = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.file_hits = 0
+        self.content_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_file(self, file_id):
+        # Пошук за file_unique_id — до завантаження фото; промах не рахується, бо далі буде пошук за вмістом
+        with self._lock:
+            key = self._by_file.get(file_id)
+            entry = self._touch(key) if key is not None else None
+            if entry is not None:
+                self.file_hits += 1
+            return entry
+
+    def get_content(self, key, file_id=None):
+        with self._lock:
+            entry = self._touch(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.content_hits += 1
+            if file_id and file_id not in entry.file_ids:
+                entry.file_ids.add(file_id)
+                self._by_file[file_id] = key
+            return entry
+
+    def put(self, entry, file_id=None):
+        if self.max_bytes <= 0:
+            return
+        key = entry.key
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._forget(key, old)
+            if file_id:
+                entry.file_ids.add(file_id)
+                self._by_file[file_id] = key
+            self._entries[key] = entry
+            self._bytes += entry.size
+            self._evict()
+
+    def update(self, key, ranking, version):
+        # Ранжування перераховано під нову версію галереї
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.ranking, entry.version = ranking, version
+
+    def _touch(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created > self.ttl:
+            del self._entries[key]
+            self._forget(key, entry)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _forget(self, key, entry):
+        self._bytes -= entry.size
+        for file_id in entry.file_ids:
+            if self._by_file.get(file_id) == key:
+                del self._by_file[file_id]
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            key, entry = self._entries.popitem(last=False)
+            self._forget(key, entry)
+            self.evictions += 1
+
+    def metrics(self):
+        lookups = self.file_hits + self.content_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "file_hits": self.file_hits,
+            "content_hits": self.content_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.file_hits + self.content_hits) / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
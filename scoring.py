@@ -0,0 +1,134 @@
+import numpy as np
+
+# Векторизоване оцінювання схожості: одна матрична операція запит×еталони
+# і агрегація по сегментах міток (mean / max / topk) без циклів Python.
+AGGREGATIONS = ("mean", "max", "topk")
+
+
+def padded_layout(offsets, counts):
+    # Таблиця індексів [мітка, позиція] для topk: короткі сегменти доповнюються маскою
+    width = int(counts.max()) if len(counts) else 0
+    positions = np.arange(width)
+    mask = positions[None, :] < counts[:, None]
+    gather = np.where(mask, offsets[:, None] + positions[None, :], 0)
+    return gather, mask
+
+
+def segment_ids(offsets, counts):
+    # Індекси всіх еталонів з вибраних сегментів одним масивом (без циклу по мітках)
+    total = int(counts.sum())
+    starts = np.repeat(offsets - (np.cumsum(counts) - counts), counts)
+    return np.arange(total) + starts
+
+
+def aggregate_segments(sims, offsets, counts, method="mean", top_k=3, layout=None):
+    sims = np.atleast_2d(sims)
+    if not len(offsets):
+        return np.zeros((sims.shape[0], 0), dtype=np.float32)
+    if method == "mean":
+        return np.add.reduceat(sims, offsets, axis=1) / counts
+    if method == "max":
+        return np.maximum.reduceat(sims, offsets, axis=1)
+    if method == "topk":
+        gather, mask = layout if layout is not None else padded_layout(offsets, counts)
+        values = np.where(mask, sims[:, gather], -np.inf)
+        k = min(top_k, values.shape[-1])
+        best = -np.partition(-values, k - 1, axis=-1)[..., :k]
+        best = np.where(np.isfinite(best), best, 0.0)
+        return best.sum(axis=-1) / np.minimum(counts, k)
+    raise ValueError(f"Невідомий метод агрегації: {method}")
+
+
+def fuse_views(scores, view_counts, method="mean"):
+    # Об'єднання оцінок кількох ракурсів одного фото: рядки scores ідуть групами по view_counts
+    view_counts = np.asarray(view_counts, dtype=np.int64)
+    offsets = np.cumsum(view_counts) - view_counts
+    if method == "max":
+        return np.maximum.reduceat(scores, offsets, axis=0)
+    return np.add.reduceat(scores, offsets, axis=0) / view_counts[:, None]
+
+
+class LabelScorer:
+    def __init__(self, index, top_k=3):
+        self.index = index
+        self.top_k = max(1, int(top_k))
+        self.label_names = index.label_names
+        self.label_categories = index.label_categories
+        self.offsets = index.label_offsets
+        self.counts = index.label_counts
+        self.label_lookup = {key: i for i, key in enumerate(zip(self.label_categories, self.label_names))}
+        # Номер мітки для кожного еталонного зображення
+        self.ref_labels = np.repeat(np.arange(len(self.counts)), self.counts)
+        self._layout = None
+
+    def similarities(self, queries):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        return queries @ self.index.embeddings.T
+
+    def aggregate(self, sims, method="mean"):
+        if method == "topk" and self._layout is None:
+            self._layout = padded_layout(self.offsets, self.counts)
+        return aggregate_segments(sims, self.offsets, self.counts, method, self.top_k, self._layout)
+
+    def score(self, queries, method="mean"):
+        return self.aggregate(self.similarities(queries), method)
+
+    def score_labels(self, query, label_ids, method="mean"):
+        # Точна оцінка лише для підмножини міток (наприклад, кандидатів з ANN-індексу)
+        label_ids = np.asarray(label_ids, dtype=np.int64)
+        counts = self.counts[label_ids]
+        ids = segment_ids(self.offsets[label_ids], counts)
+        sims = self.index.embeddings[ids] @ np.asarray(query, dtype=np.float32).ravel()
+        local_offsets = np.cumsum(counts) - counts
+        return aggregate_segments(sims, local_offsets, counts, method, self.top_k)[0]
+
+    def rank(self, query, method="mean", top_n=5):
+        scores = self.score(query, method)[0]
+        return self.rank_scores(scores, top_n)
+
+    def rank_scores(self, scores, top_n=5, label_ids=None):
+        top_n = min(top_n, len(scores))
+        if top_n <= 0:
+            return []
+        order = np.argpartition(-scores, top_n - 1)[:top_n]
+        order = order[np.argsort(-scores[order], kind="stable")]
+        labels = order if label_ids is None else np.asarray(label_ids)[order]
+        return [
+            (self.label_names[label], self.label_categories[label], float(scores[i]))
+            for label, i in zip(labels, order)
+        ]
+
+
+class CategoryRouter:
+    # Перший етап ієрархічного пошуку: запит порівнюється з центроїдами міток (одна маленька матриця),
+    # категорія оцінюється найкращою своєю міткою, а точне оцінювання йде лише в top-k категоріях.
+    # Категорії з always (гранати, міни) оцінюються завжди, щоб небезпечні об'єкти не відсікались
+    def __init__(self, scorer, always=()):
+        offsets, counts = scorer.offsets, scorer.counts
+        if len(offsets):
+            sums = np.add.reduceat(scorer.index.embeddings, offsets, axis=0, dtype=np.float32)
+        else:
+            sums = np.zeros((0, scorer.index.dim), dtype=np.float32)
+        self.centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        # Мітки відсортовані за категорією, тож кожна категорія — суцільний діапазон міток
+        categories = scorer.label_categories
+        starts = [i for i in range(len(categories)) if i == 0 or categories[i] != categories[i - 1]]
+        self.categories = [categories[i] for i in starts]
+        self.category_offsets = np.asarray(starts, dtype=np.int64)
+        self.category_counts = np.diff(np.append(self.category_offsets, len(categories)))
+        self.always = np.asarray([i for i, name in enumerate(self.categories) if name in always], dtype=np.int64)
+        self.always_labels = segment_ids(self.category_offsets[self.always], self.category_counts[self.always])
+
+    def category_scores(self, queries):
+        sims = np.atleast_2d(np.asarray(queries, dtype=np.float32)) @ self.centroids.T
+        if not len(self.category_offsets):
+            return np.zeros((sims.shape[0], 0), dtype=np.float32)
+        return np.maximum.reduceat(sims, self.category_offsets, axis=1)
+
+    def route(self, query, top_k):
+        # Номери міток з top_k найближчих категорій і категорій, що оцінюються завжди
+        scores = self.category_scores(query)[0]
+        k = min(max(1, int(top_k)), len(scores))
+        chosen = np.argpartition(-scores, k - 1)[:k] if k else np.zeros(0, dtype=np.int64)
+        chosen = np.union1d(chosen, self.always)
+        return segment_ids(self.category_offsets[chosen], self.category_counts[chosen])
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+import admission
+from admission import AdmissionController, Superseded, QueueFull, PRIORITY_HIGH, PRIORITY_NORMAL
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_token_bucket_burst_and_refill(clock):
+    controller = AdmissionController(rate=0.5, burst=2)
+    assert controller.allow(1) == (True, 0.0)
+    assert controller.allow(1) == (True, 0.0)
+    allowed, retry_after = controller.allow(1)
+    assert not allowed and retry_after == pytest.approx(2.0)
+    assert controller.allow(2)[0]  # ліміт окремий для кожного користувача
+    clock[0] += 2.0
+    assert controller.allow(1)[0]
+    assert not controller.allow(1)[0]
+    assert controller.rate_limited == 2
+
+
+def test_bucket_table_is_bounded(clock):
+    controller = AdmissionController(burst=1, max_users=2)
+    for user_id in (1, 2, 3):
+        controller.allow(user_id)
+    assert list(controller._buckets) == [2, 3]
+    assert controller.allow(1)[0]  # відкинутий користувач починає з повного відра
+
+
+def test_priority_order_and_positions():
+    async def scenario():
+        controller = AdmissionController(max_active=1, max_queue=10)
+        running, _ = controller.enqueue(1)
+        normal, _ = controller.enqueue(2, PRIORITY_NORMAL)
+        urgent, _ = controller.enqueue(3, PRIORITY_HIGH)
+        assert running.granted.done()
+        assert controller.position(running) == 0
+        assert controller.position(urgent) == 1
+        assert controller.position(normal) == 2
+        controller.release(running)
+        assert urgent.granted.done() and not normal.granted.done()
+        controller.release(urgent)
+        assert normal.granted.done()
+        controller.release(normal)
+        assert controller.metrics()["active"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_new_photo_supersedes_previous_request():
+    async def scenario():
+        controller = AdmissionController(max_active=1, max_queue=10)
+        blocker, _ = controller.enqueue(1)
+        first, superseded = controller.enqueue(2)
+        assert not superseded
+        second, superseded = controller.enqueue(2)
+        assert superseded
+        with pytest.raises(Superseded):
+            await controller.wait(first)
+        controller.release(blocker)
+        assert second.granted.done()
+
+        # Уже запущений запит переривається через guard
+        third, _ = controller.enqueue(3)
+        work = asyncio.ensure_future(controller.guard(second, asyncio.sleep(10)))
+        await asyncio.sleep(0)
+        controller.enqueue(2)
+        with pytest.raises(Superseded):
+            await work
+        assert controller.superseded == 2
+        controller.release(third)
+
+    asyncio.run(scenario())
+
+
+def test_queue_full():
+    async def scenario():
+        controller = AdmissionController(max_active=1, max_queue=1)
+        controller.enqueue(1)
+        controller.enqueue(2)
+        with pytest.raises(QueueFull):
+            controller.enqueue(3)
+        assert controller.rejected == 1
+
+    asyncio.run(scenario())
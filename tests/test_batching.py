@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from batching import BatchingEngine
+
+
+def run(engine, items):
+    async def scenario():
+        try:
+            return await asyncio.gather(*(engine.submit(item) for item in items), return_exceptions=True)
+        finally:
+            await engine.stop()
+
+    return asyncio.run(asyncio.wait_for(scenario(), 5))
+
+
+def test_concurrent_requests_share_a_batch():
+    batches = []
+
+    def run_batch(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    results = run(BatchingEngine(run_batch, max_batch_size=8, max_wait_ms=50), [1, 2, 3])
+    assert results == [2, 4, 6]
+    assert batches == [[1, 2, 3]]
+
+
+def test_async_backend_and_per_item_errors():
+    async def run_batch(items):
+        return [ValueError(item) if item < 0 else item for item in items]
+
+    results = run(BatchingEngine(run_batch, max_wait_ms=20), [1, -1])
+    assert results[0] == 1
+    assert isinstance(results[1], ValueError)
+
+
+def test_backend_exception_fails_the_whole_batch():
+    def run_batch(items):
+        raise OSError("модель недоступна")
+
+    results = run(BatchingEngine(run_batch, max_wait_ms=20), [1, 2])
+    assert all(isinstance(result, OSError) for result in results)
+
+
+@pytest.mark.parametrize("returned", [1, 3])
+def test_wrong_number_of_results_resolves_every_request(returned):
+    def run_batch(items):
+        return list(range(returned))
+
+    results = run(BatchingEngine(run_batch, max_batch_size=8, max_wait_ms=50), [10, 20])
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_estimated_wait_after_first_batch():
+    engine = BatchingEngine(lambda items: items, max_wait_ms=10)
+    assert engine.estimated_wait() is None
+    run(engine, [1])
+    assert engine.estimated_wait() >= 0.01
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from classifier_head import ClassifierHead, precision_threshold, category_thresholds, train_head, MIN_CATEGORY_SAMPLES
+from embedding_index import EmbeddingIndex
+
+
+def test_precision_threshold_reachable():
+    confidence = np.array([0.9, 0.8, 0.7, 0.6])
+    correct = np.array([True, True, False, False])
+    assert precision_threshold(confidence, correct, 0.9) == pytest.approx(0.8)
+
+
+def test_precision_threshold_unreachable():
+    confidence = np.array([0.9, 0.8])
+    correct = np.array([False, True])
+    assert precision_threshold(confidence, correct, 0.9) is None
+    assert precision_threshold(np.array([]), np.array([], dtype=bool), 0.9) is None
+
+
+def test_unreachable_category_falls_back_to_default():
+    # Категорія a: усі передбачення правильні; b: усі хибні, але вибірка достатня; c: замало прикладів
+    n = MIN_CATEGORY_SAMPLES
+    probs = np.zeros((3 * n + 1, 3))
+    probs[:2 * n, 0] = 0.9  # a, правильно
+    probs[2 * n:3 * n, 1] = 0.95  # b, хибно
+    probs[3 * n:, 2] = 0.8  # c, правильно
+    y = np.array([0] * 2 * n + [0] * n + [2])
+    thresholds, default, fallback = category_thresholds(probs, y, ["a", "b", "c"], 0.6)
+    assert default is not None and default > 0
+    assert fallback == ["b"]
+    assert thresholds["b"] == default
+    assert thresholds["c"] == default
+    assert thresholds["a"] == pytest.approx(0.9)
+
+
+def test_unreachable_everywhere_has_no_default():
+    probs = np.array([[0.9, 0.1]] * 10)
+    y = np.ones(10, dtype=np.int64)
+    thresholds, default, fallback = category_thresholds(probs, y, ["a", "b"], 0.9)
+    assert default is None
+    assert thresholds == {}
+    assert fallback == ["a", "b"]
+
+
+def make_index(embeddings, labels):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    categories = [f"c{label[-1]}" for label in labels]
+    n = len(labels)
+    return EmbeddingIndex(embeddings, [f"{i}.jpg" for i in range(n)], labels, categories, np.zeros(n), np.zeros(n))
+
+
+def test_train_head_refuses_unreachable_precision():
+    # Третє фото кожної мітки схоже на іншу мітку: у своєму фолді воно передбачається хибно і найвпевненіше
+    x, y = [1, 0], [0, 1]
+    index = make_index([x, x, y, y, y, x], ["l0", "l0", "l0", "l1", "l1", "l1"])
+    head, report = train_head(index, "prototype", folds=3, target=0.9)
+    assert head is None
+    assert report["default_threshold"] is None
+    assert report["coverage"] == 0.0
+
+
+def test_train_head_and_save(tmp_path):
+    rng = np.random.default_rng(0)
+    embeddings = np.repeat(np.eye(4, 8), 6, axis=0) + rng.normal(0, 0.01, (24, 8))
+    index = make_index(embeddings, [f"l{i}" for i in range(4) for _ in range(6)])
+    head, report = train_head(index, "prototype", folds=3, target=0.9)
+    assert head is not None and head.matches(index)
+    assert report["oof_top1"] == 1.0
+    path = str(tmp_path / "head.npz")
+    head.save(path)
+    loaded = ClassifierHead.load(path)
+    assert loaded.thresholds == head.thresholds
+    assert np.allclose(loaded.predict(index.embeddings), head.predict(index.embeddings))
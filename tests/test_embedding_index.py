@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from embedding_index import EmbeddingIndex, update_index
+
+
+@pytest.fixture
+def gallery(tmp_path):
+    root = tmp_path / "weapon_images"
+    for category, label, count in [("grenades", "f1", 2), ("autogun", "ak74", 3)]:
+        folder = root / category / label
+        folder.mkdir(parents=True)
+        for i in range(count):
+            (folder / f"{i}.jpg").write_bytes(f"{label}{i}".encode())
+    return root
+
+
+def embedder(dim, calls):
+    def embed(paths):
+        calls.extend(paths)
+        vectors = np.zeros((len(paths), dim), dtype=np.float32)
+        vectors[:, 0] = 1.0
+        return vectors
+    return embed
+
+
+def test_save_load_round_trip(gallery, tmp_path):
+    path = str(tmp_path / "index.emb")
+    index, stats = update_index(str(gallery), embedder(8, []), path, "w:1", 8)
+    assert stats["embedded"] == 5
+    loaded = EmbeddingIndex.load(path)
+    assert loaded.model_id == "w:1"
+    assert loaded.label_names == ["ak74", "f1"]
+    assert list(loaded.label_counts) == [3, 2]
+    assert np.array_equal(np.asarray(loaded.embeddings), np.asarray(index.embeddings))
+
+
+def test_unchanged_model_reuses_embeddings(gallery, tmp_path):
+    path = str(tmp_path / "index.emb")
+    update_index(str(gallery), embedder(8, []), path, "w:1", 8)
+    calls = []
+    _, stats = update_index(str(gallery), embedder(8, calls), path, "w:1", 8)
+    assert calls == [] and stats["reused"] == 5
+
+
+@pytest.mark.parametrize("model_id, dim", [("w:2", 8), ("w:1", 16)])
+def test_other_model_rebuilds(gallery, tmp_path, model_id, dim):
+    path = str(tmp_path / "index.emb")
+    update_index(str(gallery), embedder(8, []), path, "w:1", 8)
+    calls = []
+    index, stats = update_index(str(gallery), embedder(dim, calls), path, model_id, dim)
+    assert len(calls) == 5 and stats["reused"] == 0
+    assert index.dim == dim and EmbeddingIndex.load(path).model_id == model_id
+
+
+def test_index_without_model_id_is_rebuilt_once(gallery, tmp_path):
+    path = str(tmp_path / "index.emb")
+    update_index(str(gallery), embedder(8, []), path)
+    calls = []
+    update_index(str(gallery), embedder(8, calls), path, "w:1", 8)
+    assert len(calls) == 5
+    calls.clear()
+    update_index(str(gallery), embedder(8, calls), path, "w:1", 8)
+    assert calls == []
@@ -0,0 +1,98 @@
+import json
+
+import pytest
+
+from gallery_ingest import update_catalog, ingest
+
+CATALOG = """[
+    {
+      "label": "a",
+      "name_ua": "А",
+      "type": "Автомат",
+      "category": "автомати",
+      "country": "СРСР",
+      "caliber": "7.62"
+    },
+  {
+    "label": "b",
+    "name_ua": "Б",
+    "type": "Автомат",
+    "category": "автомати",
+    "country": "СРСР",
+    "caliber": "5.45"
+  },
+  {
+    "label": "c",
+    "name_ua": "В",
+    "type": "Граната",
+    "category": "гранати",
+    "country": "СРСР",
+    "caliber": "-"
+  }
+]
+"""
+
+
+def entry(label):
+    return {"label": label, "name_ua": label, "type": "Міна", "category": "міни", "country": "СРСР", "caliber": "-"}
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = tmp_path / "weapons_db.json"
+    path.write_text(CATALOG, encoding="utf-8")
+    return path
+
+
+def labels(path):
+    return [item["label"] for item in json.loads(path.read_text(encoding="utf-8"))]
+
+
+def test_unchanged_catalog_is_not_rewritten(db):
+    before = db.stat().st_mtime_ns
+    report = update_catalog(db, {}, ())
+    assert report == {"catalog_added": [], "catalog_updated": [], "catalog_removed": []}
+    assert db.stat().st_mtime_ns == before
+    assert db.read_text(encoding="utf-8") == CATALOG
+
+
+@pytest.mark.parametrize("pruned, left", [
+    (["a"], ["b", "c"]),
+    (["a", "b"], ["c"]),
+    (["b", "c"], ["a"]),
+    (["a", "c"], ["b"]),
+    (["a", "b", "c"], []),
+])
+def test_prune(db, pruned, left):
+    report = update_catalog(db, {}, pruned)
+    assert report["catalog_removed"] == pruned
+    assert labels(db) == left
+
+
+def test_prune_keeps_formatting_of_other_entries(db):
+    update_catalog(db, {}, ["a", "b"])
+    assert db.read_text(encoding="utf-8") == "[\n    " + CATALOG[CATALOG.index('{\n    "label": "c"'):]
+
+
+def test_prune_all_and_add(db):
+    report = update_catalog(db, {"d": entry("d")}, ["a", "b", "c"])
+    assert report["catalog_added"] == ["d"]
+    assert json.loads(db.read_text(encoding="utf-8")) == [entry("d")]
+
+
+def test_prune_tail_and_add(db):
+    update_catalog(db, {"d": entry("d"), "e": entry("e")}, ["b", "c"])
+    assert labels(db) == ["a", "d", "e"]
+
+
+def test_update_next_to_pruned(db):
+    changed = {**entry("b"), "name_ua": "Нова"}
+    report = update_catalog(db, {"b": changed}, ["a", "c"])
+    assert report["catalog_updated"] == ["b"]
+    assert json.loads(db.read_text(encoding="utf-8")) == [changed]
+
+
+def test_prune_refused_without_gallery(db, tmp_path):
+    with pytest.raises(ValueError):
+        ingest(str(tmp_path / "missing"), str(db), str(tmp_path / "index.emb"), prune_catalog=True)
+    assert db.read_text(encoding="utf-8") == CATALOG
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import image_matcher
+from image_matcher import HashIndex, hamming, hash_signature, HASH_KINDS
+
+
+def random_index(n, seed=0):
+    rng = np.random.default_rng(seed)
+    signatures = rng.integers(0, 2 ** 63, size=(n, len(HASH_KINDS)), dtype=np.uint64)
+    labels = [f"l{i // 3}" for i in range(n)]
+    categories = [f"c{i // 9}" for i in range(n)]
+    return HashIndex(signatures, [f"{i}.jpg" for i in range(n)], labels, categories, np.zeros(n), np.zeros(n))
+
+
+def flip(value, bits):
+    for bit in bits:
+        value ^= np.uint64(1) << np.uint64(bit)
+    return value
+
+
+def test_hamming_distances():
+    signatures = np.array([[0, 0, 0], [1, 3, 2 ** 63]], dtype=np.uint64)
+    assert hamming(signatures, np.zeros(3, dtype=np.uint64)).tolist() == [[0, 0, 0], [1, 2, 1]]
+
+
+@pytest.mark.parametrize("radius", [0, 4, 12])
+def test_multi_index_matches_brute_force(monkeypatch, radius):
+    index = random_index(60)
+    rng = np.random.default_rng(1)
+    for row in range(0, 60, 7):
+        query = index.signatures[row].copy()
+        query[0] = flip(query[0], rng.choice(64, radius, replace=False))
+        monkeypatch.setattr(image_matcher, "HASH_BRUTE_FORCE_MAX", 10 ** 6)
+        brute = index.search(query, radius)
+        monkeypatch.setattr(image_matcher, "HASH_BRUTE_FORCE_MAX", 0)
+        tables = index.search(query, radius)
+        assert row in brute[0]
+        assert brute[0].tolist() == tables[0].tolist() and brute[1].tolist() == tables[1].tolist()
+
+
+def test_lookup_duplicate_shortlist_and_exclude():
+    index = random_index(30)
+    query = index.signatures[4]
+    duplicate, shortlist, pruned = index.lookup(query, radius=12)
+    assert duplicate == ("c0", "l1") and shortlist == [] and pruned == 1.0
+
+    # Той самий еталон виключено (leave-one-out) — лишаються лише короткі списки міток
+    near = query.copy()
+    near[1] = flip(near[1], [0, 1])
+    index.signatures[5] = near
+    duplicate, shortlist, pruned = index.lookup(query, radius=12, exclude=4)
+    assert duplicate is None
+    assert shortlist[0] == ("c0", "l1")
+    assert pruned == pytest.approx(1 - 3 / 30)
+
+
+def test_no_candidates_means_full_search():
+    index = random_index(30)
+    query = ~index.signatures[0]
+    assert index.lookup(query, radius=2) == (None, [], 0.0)
+
+
+def test_signature_is_stable_across_sizes():
+    gradient = np.tile(np.linspace(0, 255, 256, dtype=np.uint8), (256, 1))
+    image = Image.fromarray(np.stack([gradient, gradient.T, gradient], axis=2))
+    small = hash_signature(image)
+    large = hash_signature(image.resize((1024, 1024)))
+    assert hamming(small[None], large).max() <= 4
+
+
+def test_save_and_load(tmp_path):
+    index = random_index(12)
+    path = str(tmp_path / "hashes.npz")
+    index.save(path)
+    loaded = HashIndex.load(path)
+    assert np.array_equal(loaded.signatures, index.signatures)
+    assert loaded.label_keys == index.label_keys
+
+
+def test_load_rejects_old_signatures(tmp_path, monkeypatch):
+    path = str(tmp_path / "hashes.npz")
+    random_index(3).save(path)
+    monkeypatch.setattr(image_matcher, "SIGNATURE_VERSION", image_matcher.SIGNATURE_VERSION + 1)
+    with pytest.raises(ValueError):
+        HashIndex.load(path)
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+import result_cache
+from result_cache import ResultCache, CachedResult, content_key, ENTRY_OVERHEAD
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(result_cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def entry(data, dim=4):
+    return CachedResult(content_key(data), [("ak74", "autogun", 0.9)], np.zeros((1, dim), dtype=np.float32), "v1")
+
+
+def test_lookup_by_file_id_and_content(clock):
+    cache = ResultCache()
+    cached = entry(b"photo")
+    cache.put(cached, "file-1")
+    assert cache.get_file("file-1") is cached
+    assert cache.get_file("file-2") is None
+    # Той самий вміст під іншим file_unique_id — знаходиться за хешем і запам'ятовує новий id
+    assert cache.get_content(content_key(b"photo"), "file-2") is cached
+    assert cache.get_file("file-2") is cached
+    assert cache.get_content(content_key(b"other")) is None
+    metrics = cache.metrics()
+    assert (metrics["file_hits"], metrics["content_hits"], metrics["misses"]) == (2, 1, 1)
+
+
+def test_ttl_expiry(clock):
+    cache = ResultCache(ttl=60)
+    cache.put(entry(b"photo"), "file-1")
+    clock[0] += 61
+    assert cache.get_file("file-1") is None
+    assert cache.get_content(content_key(b"photo")) is None
+    assert cache.metrics()["entries"] == 0 and cache.metrics()["bytes"] == 0
+
+
+def test_byte_cap_evicts_least_recently_used(clock):
+    size = entry(b"a").size
+    cache = ResultCache(max_bytes=2 * size)
+    cache.put(entry(b"a"), "file-a")
+    cache.put(entry(b"b"), "file-b")
+    cache.get_file("file-a")  # a свіжіший за b
+    cache.put(entry(b"c"), "file-c")
+    assert cache.get_file("file-b") is None
+    assert cache.get_file("file-a") is not None and cache.get_file("file-c") is not None
+    assert cache.metrics()["bytes"] == 2 * size
+    assert cache.evictions == 1
+
+
+def test_replacing_entry_keeps_byte_count(clock):
+    cache = ResultCache()
+    cache.put(entry(b"a"), "file-a")
+    cache.put(entry(b"a", dim=8), "file-b")
+    assert cache.metrics()["entries"] == 1
+    assert cache.metrics()["bytes"] == ENTRY_OVERHEAD + 8 * 4 + 64
+    assert cache.get_file("file-a") is None
+    assert cache.get_file("file-b") is not None
+
+
+def test_disabled_cache_stores_nothing(clock):
+    cache = ResultCache(max_bytes=0)
+    cache.put(entry(b"a"), "file-a")
+    assert cache.get_file("file-a") is None
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+# Стан користувачів (мова, локація, останній результат): у пам'яті лише обмежений LRU-кеш
+# активних користувачів з TTL, а все інше — у SQLite. Зміни пишуться у фоні пакетами (write-behind),
+# тож обробники не чекають на диск, а стан переживає перезапуск/редеплой.
+# З async-обробників — aget/aset: промах кешу читає SQLite в потоці, а не в event loop.
+USER_STATE_PATH = os.environ.get("USER_STATE_PATH", "user_state.sqlite3")
+USER_STATE_MAX_ENTRIES = int(os.environ.get("USER_STATE_MAX_ENTRIES", "50000"))
+# Скільки (с) неактивний користувач тримається в кеші пам'яті
+USER_STATE_CACHE_TTL = float(os.environ.get("USER_STATE_CACHE_TTL", "3600"))
+USER_STATE_FLUSH_INTERVAL = float(os.environ.get("USER_STATE_FLUSH_INTERVAL", "2.0"))
+# Через скільки днів без активності стан видаляється і з бази (0 — зберігати завжди)
+USER_STATE_RETENTION_DAYS = float(os.environ.get("USER_STATE_RETENTION_DAYS", "180"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_state (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+)
+"""
+
+
+def connect(path=USER_STATE_PATH):
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(SCHEMA)
+    return connection
+
+
+class UserStateStore:
+    def __init__(self, path=USER_STATE_PATH, max_entries=USER_STATE_MAX_ENTRIES, ttl=USER_STATE_CACHE_TTL,
+                 flush_interval=USER_STATE_FLUSH_INTERVAL, retention_days=USER_STATE_RETENTION_DAYS):
+        self.path = path
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = float(ttl)
+        self.flush_interval = max(0.01, float(flush_interval))
+        self.retention_days = float(retention_days)
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._reader = None
+        self._reader_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def start(self):
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="user-state", daemon=True)
+            self._thread.start()
+
+    def get(self, user_id, key, default=None):
+        return self._state(user_id).get(key, default)
+
+    async def aget(self, user_id, key, default=None):
+        state = self._cached(user_id)
+        if state is None:
+            state = await asyncio.to_thread(self._state, user_id)
+        return state.get(key, default)
+
+    async def aset(self, user_id, key, value):
+        if self._cached(user_id) is None:
+            await asyncio.to_thread(self._state, user_id)
+        self.set(user_id, key, value)
+
+    def set(self, user_id, key, value):
+        now = time.monotonic()
+        state = dict(self._state(user_id))
+        state[key] = value
+        with self._lock:
+            # Словник стану замінюється цілком — знімок у _dirty не змінюється після постановки в чергу
+            self._cache[user_id] = (state, now)
+            self._cache.move_to_end(user_id)
+            self._dirty[user_id] = state
+            self._evict(now)
+
+    def _cached(self, user_id):
+        # Стан з кешу пам'яті; None — потрібне звернення до бази
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(user_id)
+            if cached is not None and now - cached[1] <= self.ttl:
+                self._cache[user_id] = (cached[0], now)
+                self._cache.move_to_end(user_id)
+                self.hits += 1
+                return cached[0]
+        return None
+
+    def _state(self, user_id):
+        state = self._cached(user_id)
+        if state is not None:
+            return state
+        now = time.monotonic()
+        with self._lock:
+            # Ще не записаний на диск стан важливіший за базу
+            state = self._dirty.get(user_id)
+            if state is None:
+                state = self._flushing.get(user_id)
+        self.misses += 1
+        if state is None:
+            state = self._load(user_id)
+        with self._lock:
+            self._cache[user_id] = (state, now)
+            self._cache.move_to_end(user_id)
+            self._evict(now)
+        return state
+
+    def _evict(self, now):
+        # Спершу найдавніші за доступом: прострочені за TTL і все понад ліміт
+        while self._cache:
+            user_id, (_, accessed) = next(iter(self._cache.items()))
+            if len(self._cache) <= self.max_entries and now - accessed <= self.ttl:
+                break
+            del self._cache[user_id]
+            self.evictions += 1
+
+    def _load(self, user_id):
+        with self._reader_lock:
+            if self._reader is None:
+                self._reader = connect(self.path)
+            row = self._reader.execute("SELECT data FROM user_state WHERE user_id = ?", (int(user_id),)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def _run(self):
+        connection = connect(self.path)
+        self._purge(connection)
+        purged_at = time.monotonic()
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._flush(connection)
+            if self._stopping:
+                break
+            if time.monotonic() - purged_at > 3600:
+                self._purge(connection)
+                purged_at = time.monotonic()
+        connection.close()
+
+    def _flush(self, connection):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            self._flushing = dirty
+        if not dirty:
+            return
+        now = time.time()
+        rows = [(int(user_id), json.dumps(state, ensure_ascii=False), now) for user_id, state in dirty.items()]
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO user_state (user_id, data, updated) VALUES (?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            # Повертаємо незаписане в чергу, якщо за цей час не з'явилося новіших змін
+            with self._lock:
+                for user_id, state in dirty.items():
+                    self._dirty.setdefault(user_id, state)
+            logging.error("❌ Не вдалося зберегти стан користувачів: %s", e)
+        finally:
+            with self._lock:
+                self._flushing = {}
+
+    def _purge(self, connection):
+        if self.retention_days <= 0:
+            return
+        try:
+            with connection:
+                connection.execute("DELETE FROM user_state WHERE updated < ?", (time.time() - self.retention_days * 86400,))
+        except sqlite3.Error as e:
+            logging.warning("⚠️ Не вдалося очистити застарілий стан користувачів: %s", e)
+
+    def close(self, timeout=10):
+        # Дописує всі зміни перед зупинкою
+        if self._thread is not None:
+            self._stopping = True
+            self._wake.set()
+            self._thread.join(timeout)
+            self._thread = None
+        else:
+            connection = connect(self.path)
+            self._flush(connection)
+            connection.close()
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def metrics(self):
+        return {
+            "cached": len(self._cache),
+            "pending_writes": len(self._dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
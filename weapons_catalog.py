@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from pathlib import Path
+
+# Єдиний каталог weapons_db.json для всього проєкту: файл читається один раз,
+# записи індексуються за міткою та категорією, а при зміні mtime файл перечитується.
+DEFAULT_DB_PATH = "weapons_db.json"
+REQUIRED_FIELDS = ("label", "name_ua", "type", "category", "country", "caliber")
+# Як часто (с) перевіряти mtime файлу, щоб не робити stat на кожен запит
+RELOAD_CHECK_INTERVAL = 2.0
+
+
+class WeaponsCatalog:
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0.0
+        self.entries = []
+        self._by_label = {}
+        self._by_category = {}
+        self.reload()
+
+    def reload(self):
+        with open(self.db_path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        by_label = {}
+        by_category = {}
+        for item in entries:
+            by_label.setdefault(item.get("label"), item)
+            by_category.setdefault(item.get("category"), []).append(item)
+        # Нові словники підставляються цілком, тож паралельні читачі бачать або стару, або нову версію
+        self.entries, self._by_label, self._by_category = entries, by_label, by_category
+        self._mtime = os.stat(self.db_path).st_mtime
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._checked_at < RELOAD_CHECK_INTERVAL:
+            return False
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.db_path).st_mtime
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        with self._lock:
+            if mtime != self._mtime:
+                try:
+                    self.reload()
+                except (OSError, ValueError) as e:
+                    # Напівзаписаний або зіпсований файл — лишаємо попередню версію
+                    print(f"⚠️ Не вдалося перечитати {self.db_path}: {e}")
+                    return False
+        return True
+
+    def get(self, label):
+        return self._by_label.get(label)
+
+    def by_category(self, category):
+        return list(self._by_category.get(category, []))
+
+    def labels(self):
+        return list(self._by_label)
+
+    def categories(self):
+        return list(self._by_category)
+
+    def validate(self, reference_folder=None):
+        issues = {"missing_fields": [], "duplicate_labels": [], "no_image_folder": [], "no_db_entry": []}
+        seen = set()
+        for i, item in enumerate(self.entries):
+            missing = [field for field in REQUIRED_FIELDS if not isinstance(item.get(field), str) or not item.get(field)]
+            if missing:
+                issues["missing_fields"].append({"index": i, "label": item.get("label"), "fields": missing})
+            label = item.get("label")
+            if label in seen:
+                issues["duplicate_labels"].append(label)
+            seen.add(label)
+
+        if reference_folder:
+            folders = image_folder_labels(reference_folder)
+            issues["no_image_folder"] = sorted(label for label in seen if label not in folders)
+            issues["no_db_entry"] = sorted(label for label in folders if label not in seen)
+        return issues
+
+
+def image_folder_labels(reference_folder):
+    from embedding_index import IMAGE_EXTENSIONS
+
+    labels = set()
+    for path in Path(reference_folder).rglob('*'):
+        if path.is_file() and path.suffix.lower() in IMAGE_EXTENSIONS and path.parent != Path(reference_folder):
+            labels.add(path.parent.name)
+    return labels
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(db_path=DEFAULT_DB_PATH):
+    # Спільний екземпляр на шлях; перевірка mtime — не частіше ніж раз на RELOAD_CHECK_INTERVAL
+    catalog = _catalogs.get(db_path)
+    if catalog is None:
+        with _catalogs_lock:
+            catalog = _catalogs.get(db_path)
+            if catalog is None:
+                catalog = _catalogs[db_path] = WeaponsCatalog(db_path)
+                return catalog
+    catalog.refresh()
+    return catalog
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Перевірка каталогу weapons_db.json")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH)
+    parser.add_argument("--images", default="weapon_images")
+    args = parser.parse_args(argv)
+
+    catalog = get_catalog(args.db)
+    issues = catalog.validate(args.images)
+    print(json.dumps({"entries": len(catalog.entries), **issues}, ensure_ascii=False, indent=2))
+    return 1 if any(issues.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,4 @@
 # weapons_database.py
-import json
+from weapons_catalog import get_catalog
 
-with open('weapons_db.json', 'r', encoding='utf-8') as f:
-    weapons_data = json.load(f)
+weapons_data = get_catalog('weapons_db.json').entries
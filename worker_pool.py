@@ -0,0 +1,165 @@
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Пул процесів для розпізнавання: кожен воркер тримає власну модель і обмежену кількість
+# потоків torch/onnxruntime, тож пакети з різних процесів не змагаються за одні ядра через GIL.
+# Файл індексу ембедінгів відкривається воркерами через memmap (див. embedding_index) —
+# сторінки спільні в page cache, а не копіюються в кожен процес.
+RECOGNITION_WORKERS = int(os.environ.get("RECOGNITION_WORKERS", "0"))
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", "1"))
+# Скільки пакетів може одночасно чекати на пул; решта запитів чекає перед ним (back-pressure)
+WORKER_MAX_PENDING = int(os.environ.get("WORKER_MAX_PENDING", "16"))
+# Після стількох пакетів на воркер пул плавно перезапускається (захист від витоків пам'яті);
+# WORKER_MAX_RSS_MB — те саме за обсягом пам'яті будь-якого воркера. 0 — вимкнено
+WORKER_MAX_TASKS = int(os.environ.get("WORKER_MAX_TASKS", "500"))
+WORKER_MAX_RSS_MB = int(os.environ.get("WORKER_MAX_RSS_MB", "0"))
+
+# Точки входу воркерів (_init_worker, _ping, _recognize) — тут, у модулі без побічних ефектів під час
+# імпорту; головний файл процесу (bot.py) воркер теж імпортує (spawn), тож той нічого не створює на рівні модуля
+_worker = {}
+
+
+def _rss_mb():
+    # Поточна резидентна пам'ять процесу; без /proc — пікова з getrusage
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _init_worker(index_path, reference_folder, db_path, threads):
+    import model_manager
+    import clip_recognizer
+    from embedding_index import EmbeddingIndex
+
+    model_manager.TORCH_THREADS = threads
+    # Без сканування папки: індекс уже зібрав батьківський процес, заміни файлу підхоплює get_index
+    clip_recognizer.set_index(reference_folder, EmbeddingIndex.load(index_path))
+    clip_recognizer.warm_up(reference_folder)
+    _worker.update(reference_folder=reference_folder, db_path=db_path)
+
+
+def _ping():
+    return os.getpid(), _rss_mb()
+
+
+def _recognize(images):
+    import clip_recognizer
+
+    # (текст, ранжування, ембедінги), як recognize_batch(..., with_ranking=True) — для журналу і кешу в боті
+    results = clip_recognizer.recognize_batch(images, _worker["reference_folder"], _worker["db_path"], with_ranking=True)
+    return results, _rss_mb()
+
+
+class RecognitionPool:
+    def __init__(self, reference_folder, db_path, workers=RECOGNITION_WORKERS, threads=WORKER_THREADS,
+                 max_pending=WORKER_MAX_PENDING, max_tasks=WORKER_MAX_TASKS, max_rss_mb=WORKER_MAX_RSS_MB):
+        self.reference_folder = reference_folder
+        self.db_path = db_path
+        self.workers = max(1, int(workers))
+        self.threads = max(1, int(threads))
+        self.max_pending = max(1, int(max_pending))
+        self.max_tasks = int(max_tasks)
+        self.max_rss_mb = int(max_rss_mb)
+        self._executor = None
+        self._initargs = None
+        self._slots = None
+        self._tasks = 0
+        self._ready = False
+        self.restarts = 0
+        self.recycles = 0
+
+    def start(self):
+        # Індекс, ANN-індекс і таблиця хешів будуються/оновлюються в батьківському процесі один раз,
+        # воркери лише відкривають готові файли (інакше кожен воркер перебудовував і зберігав би їх сам).
+        # Модель тут вантажиться, лише якщо в галереї є нові фото, для яких потрібні ембедінги
+        import clip_recognizer
+
+        clip_recognizer.get_index(self.reference_folder)
+        clip_recognizer.get_hash_filter(self.reference_folder)
+        self._initargs = (clip_recognizer.index_file(), self.reference_folder, self.db_path, self.threads)
+        self._executor = self._new_executor()
+
+    def _new_executor(self):
+        # spawn, а не fork: дочірні процеси не успадковують стан потоків torch і event loop бота
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=self._initargs,
+        )
+
+    async def warm_up(self):
+        # Запуск усіх воркерів заздалегідь: ініціалізатор вантажить модель у кожному процесі
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._executor, _ping) for _ in range(self.workers)))
+        self._ready = True
+
+    def is_ready(self):
+        return self._ready
+
+    async def run(self, images):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        loop = asyncio.get_running_loop()
+        async with self._slots:
+            # Одна повторна спроба: якщо воркер впав (OOM, segfault), пул створюється заново
+            for attempt in range(2):
+                executor = self._executor
+                try:
+                    results, rss_mb = await loop.run_in_executor(executor, _recognize, images)
+                except BrokenProcessPool:
+                    logging.warning("⚠️ Процес-воркер розпізнавання завершився аварійно, пул перезапускається")
+                    self._replace(executor)
+                    self.restarts += 1
+                    continue
+                self._after_task(executor, rss_mb)
+                return results
+        raise RuntimeError("Пул розпізнавання недоступний")
+
+    def _after_task(self, executor, rss_mb):
+        self._tasks += 1
+        worn_out = self.max_tasks > 0 and self._tasks >= self.max_tasks * self.workers
+        too_big = self.max_rss_mb > 0 and rss_mb > self.max_rss_mb
+        if (worn_out or too_big) and executor is self._executor:
+            logging.info("♻️ Перезапуск пулу розпізнавання (пакетів: %d, пам'ять воркера: %.0f МБ)", self._tasks, rss_mb)
+            self._replace(executor)
+            self.recycles += 1
+
+    def _replace(self, executor):
+        # Новий пул приймає запити одразу, старий завершує вже розпочаті пакети у фоні
+        if executor is not self._executor:
+            return
+        self._executor = self._new_executor()
+        self._tasks = 0
+        executor.shutdown(wait=False)
+        asyncio.get_running_loop().create_task(self._prestart(self._executor))
+
+    async def _prestart(self, executor):
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.gather(*(loop.run_in_executor(executor, _ping) for _ in range(self.workers)))
+        except Exception as e:
+            logging.warning("⚠️ Не вдалося запустити воркери розпізнавання: %s", e)
+
+    def metrics(self):
+        return {
+            "workers": self.workers,
+            "threads_per_worker": self.threads,
+            "tasks_since_start": self._tasks,
+            "restarts": self.restarts,
+            "recycles": self.recycles,
+        }
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        self._ready = False